@@ -26,6 +26,7 @@ Super-resolution GUI elements are also implemented here.
 
 import sys 
 import os
+import atexit
 from pathlib import Path
 import time
 import numpy as np
@@ -54,6 +55,22 @@ from cas_gui.base import CAS_GUI
 from cas_gui.subclasses.cas_bundle import CAS_GUI_Bundle
 
 from processors.inline_bundle_processor_class import InlineBundleProcessorClass
+from processors.metrics import MetricsChannel, default_metrics_file
+from processors.telemetry import LatencyTelemetry
+from processors.display_stage import DisplayChannel, default_display_file
+from processors import backpressure
+from processors import chunked_store
+from processors.chunked_store import ChunkedStore
+from processors.focus_cache import write_stack_tif
+from processors.capture_buffer import CaptureBuffer
+from processors import shift_calibration
+from processors import frame_publisher
+from processors import parameter_sweep
+from processors.checkpoint import Checkpoint
+from processors.raw_archive import RawArchive
+from processors.frame_history import default_history_file, remove_history_file
+from processors.synthetic import SyntheticBundleHologram, ReplaySource, read_tif_frames, soak_test
+from processors.array_cache import default_cache_folder
 
 import pyholoscope
 
@@ -66,6 +83,10 @@ SEQUENTIAL = 0
 SINGLE = 1
 resPath = "../../cas/res"
 
+# Depth stack file types
+TIF_STACK_FILTER = "Tif stack (*.tif)"
+CHUNKED_STACK_FILTER = "HoloBundle chunked store (*" + chunked_store.EXTENSION + ")"
+
 class Holo_Bundle(CAS_GUI_Bundle):
     
     authorName = "AOG"
@@ -84,6 +105,18 @@ class Holo_Bundle(CAS_GUI_Bundle):
     mosaicingEnabled = False
     sr_single_led_id = 1  
     serial = None
+    metricsChannel = None
+    displayChannel = None
+    displayTelemetry = None
+    lastDisplayedFrameNumber = -1
+    lastLatencyUpdate = 0
+    lastDisplayedImage = None
+    displaySize = None
+    sr_param_holograms = None
+    srCaptureMemoryBudget = 512 * 2**20    # Bytes of SR shift stacks held in memory before spilling to disk
+    historyEntries = []
+    historyImage = None
+    statusMessage = ""
     #restoreGUI = False
     
     def __init__(self,parent=None):        
@@ -100,14 +133,29 @@ class Holo_Bundle(CAS_GUI_Bundle):
                  time.sleep(1)    # Otherwise it seems not to work, not sure why
                  
              except:
-                 print("cannot open serial")
+                 self.set_status_message("Cannot open serial port " + self.srCOMPort.text())
                  self.serial = None
           
         
-        # Simulated camera used this file for images
+        # Simulated camera used this file for images. If it is not available
+        # on this machine, synthetic holograms are generated when the 
+        # simulated camera is started
         self.sourceFilename = r"C:\Users\mrh40\Dropbox\Programming\Python\holoBundle\tests\test_data\sr_test_1.tif"
         #self.sourceFilename = r"C:\Users\mrh40\Dropbox\Programming\Python\holoBundle\tests\test_data\sr_test_1_background.tif"
         self.rawImageBufferSize = 20
+        
+        # Processor writes queue and latency metrics to this file for display,
+        # deleted at exit
+        self.metricsChannel = MetricsChannel(default_metrics_file(), create = True)
+        atexit.register(self.metricsChannel.close, remove = True)
+        
+        # With fast display on, the processor writes the display image here
+        self.displayChannel = DisplayChannel(default_display_file())
+        atexit.register(self.displayChannel.close, remove = True)
+        
+        # The processor writes the frame history here, deleted at exit
+        atexit.register(remove_history_file, default_history_file())
+        self.displayTelemetry = LatencyTelemetry()
 
         # Call these functions to update things based on the default GUI options
         self.sr_clear_shifts_clicked()
@@ -124,9 +172,60 @@ class Holo_Bundle(CAS_GUI_Bundle):
         except:
             pass
         
+        # Restore the core removal calibration from the calibration cache if
+        # it was calibrated before with the same bundle and settings, or 
+        # store it if it has just been calibrated
+        if self.imageProcessor is not None:
+            try:
+                self.imageProcessor.get_processor().calibrate_bundle(restoreOnly = True)
+                self.imageProcessor.update_settings()
+            except Exception as e:
+                self.set_status_message("Calibration cache not used: " + str(e))
+                
+        # Periodic checkpoints so that a long acquisition can be resumed. 
+        # Starting with --resume restores the last checkpoint.
+        self.checkpointTimer = QTimer()
+        self.checkpointTimer.timeout.connect(self.write_checkpoint)
+        self.processing_options_changed()
+        if '--resume' in sys.argv:
+            self.resume_checkpoint()
+        
 
  
     
+    def synthetic_source_file(self, numSequences = 10):
+        """ Returns filename of a TIF of synthetic SR hologram sequences for
+        the simulated camera, generating it the first time.
+        """
+        folder = default_cache_folder('synthetic')
+        filename = os.path.join(folder, f"synthetic_sr_{numSequences}.tif")
+        if not os.path.exists(filename):
+            os.makedirs(folder, exist_ok = True)
+            generator = SyntheticBundleHologram()
+            generator.add_random_objects(10, (100e-6, 1000e-6))
+            generator.add_phase_object(generator.size / 2, generator.size / 2, 500e-6)
+            generator.write_tif(filename, numSequences, sr = True)
+        return filename
+    
+    
+    def replay_source_file(self):
+        """ Returns the simulated camera source file if it exists on this 
+        machine, otherwise the synthetic hologram file.
+        """
+        if self.sourceFilename is not None and os.path.exists(self.sourceFilename):
+            return self.sourceFilename
+        return self.synthetic_source_file()
+    
+    
+    def start_acquire(self):
+        """ Overrides CAS_GUI to use synthetic holograms for the simulated
+        camera if its source file is not available.
+        """
+        if self.camTypes[self.camSourceCombo.currentIndex()] == self.SIM_TYPE:
+            self.sourceFilename = self.replay_source_file()
+        super().start_acquire()
+    
+    
     def create_layout(self):
         """ Called by parent class to assemble the GUI from Qt Widgets"""
         
@@ -150,6 +249,12 @@ class Holo_Bundle(CAS_GUI_Bundle):
         # Create the long depth slider
         self.create_focus_panel()
         
+        # Latency overlay shown on top of the main display
+        self.latencyOverlay = QLabel("", self.mainDisplay)
+        self.latencyOverlay.setStyleSheet("QLabel{background-color: rgba(0, 0, 0, 150); color: white; padding: 4px}")
+        self.latencyOverlay.move(10, 10)
+        self.latencyOverlay.setVisible(False)
+        
         
 
     def create_focus_panel(self): 
@@ -184,6 +289,17 @@ class Holo_Bundle(CAS_GUI_Bundle):
         self.longFocusWidgetLayout.addWidget(self.holoDepthInput,alignment=QtCore.Qt.AlignHCenter)  
         self.longFocusWidget.setStyleSheet("QWidget{padding:0px; margin:0px;background-color:rgba(30, 30, 60, 255)}")
         self.holoDepthInput.setMaximumWidth(90)
+        
+        # Scrubbing back through the frame history
+        self.holoHistorySlider = QSlider(QtCore.Qt.Horizontal)
+        self.holoHistorySlider.setInvertedAppearance(True)
+        self.holoHistorySlider.setMaximum(0)
+        self.holoHistoryLabel = QLabel("Live")
+        self.longFocusWidgetLayout.addWidget(QLabel('History'), alignment=QtCore.Qt.AlignHCenter)
+        self.longFocusWidgetLayout.addWidget(self.holoHistorySlider)
+        self.longFocusWidgetLayout.addWidget(self.holoHistoryLabel, alignment=QtCore.Qt.AlignHCenter)
+        self.holoHistorySlider.sliderPressed.connect(self.refresh_history)
+        self.holoHistorySlider.valueChanged[int].connect(self.history_slider_changed)
 
         self.holoDepthInput.valueChanged[float].connect(self.holo_depth_changed)
         self.holoDepthInput.setStyleSheet("QDoubleSpinBox{padding: 5px; background-color: rgba(255, 255, 255, 255); color: black; font-size:9pt}")
@@ -206,6 +322,7 @@ class Holo_Bundle(CAS_GUI_Bundle):
         self.holoRefocusCheck = QCheckBox("Refocus", objectName='holoRefocusCheck')
         self.holoDifferentialCheck = QCheckBox("Differential", objectName='holoDifferentialCheck')
         self.holoPhaseCheck = QCheckBox("Show Phase", objectName='holoPhaseCheck')
+        self.holoUnwrapPhaseCheck = QCheckBox("Unwrap Phase", objectName='holoUnwrapPhaseCheck')
         self.holoInvertCheck = QCheckBox("Invert Image", objectName='holoInvertCheck')
         
         self.holoWavelengthInput = QDoubleSpinBox(objectName='holoWavelengthInput')
@@ -244,9 +361,98 @@ class Holo_Bundle(CAS_GUI_Bundle):
         self.holoSliderMaxInput.setMaximum(10**6)
         self.holoSliderMaxInput.setMinimum(0)
         self.holoSliderMaxInput.setKeyboardTracking(False)
+        
+        self.holoHistoryLengthInput = QDoubleSpinBox(objectName='holoHistoryLengthInput')
+        self.holoHistoryLengthInput.setMaximum(600)
+        self.holoHistoryLengthInput.setMinimum(0)
+        self.holoHistoryLengthInput.setKeyboardTracking(False)
+        
+        self.holoSweepParamCombo = QComboBox(objectName='holoSweepParamCombo')
+        self.holoSweepParamCombo.addItems(['Pixel Size', 'Wavelength'])
+        self.holoSweepTargetDepthInput = QDoubleSpinBox(objectName='holoSweepTargetDepthInput')
+        self.holoSweepTargetDepthInput.setMaximum(10**6)
+        self.holoSweepTargetDepthInput.setMinimum(-10**6)
+        self.holoSweepRangeInput = QDoubleSpinBox(objectName='holoSweepRangeInput')
+        self.holoSweepRangeInput.setMaximum(90)
+        self.holoSweepRangeInput.setMinimum(0.1)
+        self.holoSweepRangeInput.setValue(10)
+        self.holoSweepStepsInput = QSpinBox(objectName='holoSweepStepsInput')
+        self.holoSweepStepsInput.setMaximum(1000)
+        self.holoSweepStepsInput.setMinimum(3)
+        self.holoSweepStepsInput.setValue(41)
+        self.holoSweepPlanesInput = QSpinBox(objectName='holoSweepPlanesInput')
+        self.holoSweepPlanesInput.setMaximum(1000)
+        self.holoSweepPlanesInput.setMinimum(3)
+        self.holoSweepPlanesInput.setValue(50)
+        self.holoSweepBtn = QPushButton("Fit to Target Depth")
+        
+        self.holoRawArchiveCheck = QCheckBox("Record Raw Archive", objectName='holoRawArchiveCheck')
+        self.holoRawArchiveFolderInput = QLineEdit(objectName='holoRawArchiveFolderInput')
+        
+        self.holoBackpressureCombo = QComboBox(objectName='holoBackpressureCombo')
+        self.holoBackpressureCombo.addItems(backpressure.MODE_NAMES)
+        
+        self.holoBackpressureNInput = QSpinBox(objectName='holoBackpressureNInput')
+        self.holoBackpressureNInput.setMaximum(1000)
+        self.holoBackpressureNInput.setMinimum(1)
+        
+        self.holoPoolWorkersInput = QSpinBox(objectName='holoPoolWorkersInput')
+        self.holoPoolWorkersInput.setMaximum(64)
+        self.holoPoolWorkersInput.setMinimum(1)
+        self.holoPoolWorkersInput.setKeyboardTracking(False)
+        
+        self.holoAdaptiveQualityCheck = QCheckBox("Adaptive Quality", objectName='holoAdaptiveQualityCheck')
+        self.holoTargetFpsInput = QDoubleSpinBox(objectName='holoTargetFpsInput')
+        self.holoTargetFpsInput.setMaximum(1000)
+        self.holoTargetFpsInput.setMinimum(0.1)
+        self.holoTargetFpsInput.setValue(20)
+        
+        self.holoPublishCheck = QCheckBox("Publish Frames to Local Port", objectName='holoPublishCheck')
+        self.holoPublishPortInput = QSpinBox(objectName='holoPublishPortInput')
+        self.holoPublishPortInput.setMaximum(65535)
+        self.holoPublishPortInput.setMinimum(1024)
+        self.holoPublishPortInput.setValue(frame_publisher.DEFAULT_PORT)
+        self.holoPublishPortInput.setKeyboardTracking(False)
+        
+        self.holoCheckpointCheck = QCheckBox("Checkpoint for Resume", objectName='holoCheckpointCheck')
+        self.holoCheckpointIntervalInput = QSpinBox(objectName='holoCheckpointIntervalInput')
+        self.holoCheckpointIntervalInput.setMaximum(3600)
+        self.holoCheckpointIntervalInput.setMinimum(5)
+        self.holoCheckpointIntervalInput.setValue(60)
+        self.holoCheckpointIntervalInput.setKeyboardTracking(False)
+        self.holoCheckpointFolderInput = QLineEdit(objectName='holoCheckpointFolderInput')
+        self.holoResumeBtn = QPushButton("Resume From Checkpoint")
+        
+        self.holoSoakDurationInput = QSpinBox(objectName='holoSoakDurationInput')
+        self.holoSoakDurationInput.setMaximum(3600)
+        self.holoSoakDurationInput.setMinimum(1)
+        self.holoSoakDurationInput.setValue(10)
+        self.holoSoakTestBtn = QPushButton("Run Soak Test")
+        
+        self.holoLatencyOverlayCheck = QCheckBox("Show Latency Overlay", objectName='holoLatencyOverlayCheck')
+        self.holoLatencyCsvInput = QLineEdit(objectName='holoLatencyCsvInput')
+        self.holoFastDisplayCheck = QCheckBox("Fast Display (display resolution)", objectName='holoFastDisplayCheck')
+        self.holoMosaicCheck = QCheckBox("Mosaic Refocused Images", objectName='holoMosaicCheck')
+        self.holoShowMosaicCheck = QCheckBox("Show Mosaic", objectName='holoShowMosaicCheck')
+        self.holoResetMosaicBtn = QPushButton("Reset Mosaic")
+        
+        self.holoParticleCheck = QCheckBox("Track Particles in 3D", objectName='holoParticleCheck')
+        self.holoParticleMinDepthInput = QDoubleSpinBox(objectName='holoParticleMinDepthInput')
+        self.holoParticleMinDepthInput.setMaximum(10**6)
+        self.holoParticleMinDepthInput.setMinimum(-10**6)
+        self.holoParticleMaxDepthInput = QDoubleSpinBox(objectName='holoParticleMaxDepthInput')
+        self.holoParticleMaxDepthInput.setMaximum(10**6)
+        self.holoParticleMaxDepthInput.setMinimum(-10**6)
+        self.holoParticleNumDepthsInput = QSpinBox(objectName='holoParticleNumDepthsInput')
+        self.holoParticleNumDepthsInput.setMaximum(1000)
+        self.holoParticleNumDepthsInput.setMinimum(2)
+        self.holoParticleCsvInput = QLineEdit(objectName='holoParticleCsvInput')
+        self.holoResetTracksBtn = QPushButton("Reset Tracks")
       
         layout.addWidget(self.holoRefocusCheck)
+        layout.addWidget(self.holoFastDisplayCheck)
         layout.addWidget(self.holoPhaseCheck)
+        layout.addWidget(self.holoUnwrapPhaseCheck)
         layout.addWidget(self.holoInvertCheck)    
         layout.addWidget(self.holoDifferentialCheck)           
         
@@ -277,10 +483,80 @@ class Holo_Bundle(CAS_GUI_Bundle):
         layout.addWidget(QLabel("Depth Slider Max (microns):"))
         layout.addWidget(self.holoSliderMaxInput)
         
+        layout.addWidget(QLabel("Frame History (s, 0 for off):"))
+        layout.addWidget(self.holoHistoryLengthInput)
+        
         layout.addWidget(QLabel("Adjusted Pixel Size (microns):"))
         self.adjustedPixelSizeLabel = QLabel("")
         layout.addWidget(self.adjustedPixelSizeLabel)
         self.adjustedPixelSizeLabel.setProperty('status', 'true')
+        
+        layout.addWidget(QLabel("Calibrate From Target:"))
+        layout.addWidget(self.holoSweepParamCombo)
+        layout.addWidget(QLabel("Target Depth (microns):"))
+        layout.addWidget(self.holoSweepTargetDepthInput)
+        layout.addWidget(QLabel("Sweep Range (+/- %):"))
+        layout.addWidget(self.holoSweepRangeInput)
+        layout.addWidget(QLabel("Sweep Steps:"))
+        layout.addWidget(self.holoSweepStepsInput)
+        layout.addWidget(QLabel("Depth Planes (autofocus range):"))
+        layout.addWidget(self.holoSweepPlanesInput)
+        layout.addWidget(self.holoSweepBtn)
+        
+        layout.addWidget(self.holoRawArchiveCheck)
+        layout.addWidget(QLabel("Raw Archive Folder:"))
+        layout.addWidget(self.holoRawArchiveFolderInput)
+        
+        layout.addWidget(self.holoMosaicCheck)
+        layout.addWidget(self.holoShowMosaicCheck)
+        layout.addWidget(self.holoResetMosaicBtn)
+        
+        layout.addWidget(self.holoParticleCheck)
+        layout.addWidget(QLabel("Particle Min Depth (microns):"))
+        layout.addWidget(self.holoParticleMinDepthInput)
+        layout.addWidget(QLabel("Particle Max Depth (microns):"))
+        layout.addWidget(self.holoParticleMaxDepthInput)
+        layout.addWidget(QLabel("Particle Search Planes:"))
+        layout.addWidget(self.holoParticleNumDepthsInput)
+        layout.addWidget(QLabel("Particle CSV File:"))
+        layout.addWidget(self.holoParticleCsvInput)
+        layout.addWidget(self.holoResetTracksBtn)
+        
+        layout.addWidget(QLabel("Backpressure Policy:"))
+        layout.addWidget(self.holoBackpressureCombo)
+        
+        layout.addWidget(QLabel("Keep Every Nth, N:"))
+        layout.addWidget(self.holoBackpressureNInput)
+        
+        layout.addWidget(QLabel("Processor Workers (1 for single process):"))
+        layout.addWidget(self.holoPoolWorkersInput)
+        
+        layout.addWidget(self.holoAdaptiveQualityCheck)
+        layout.addWidget(QLabel("Target Frame Rate (fps):"))
+        layout.addWidget(self.holoTargetFpsInput)
+        
+        layout.addWidget(self.holoPublishCheck)
+        layout.addWidget(QLabel("Publish Port:"))
+        layout.addWidget(self.holoPublishPortInput)
+        
+        layout.addWidget(self.holoCheckpointCheck)
+        layout.addWidget(QLabel("Checkpoint Interval (s):"))
+        layout.addWidget(self.holoCheckpointIntervalInput)
+        layout.addWidget(QLabel("Checkpoint Folder (blank for default):"))
+        layout.addWidget(self.holoCheckpointFolderInput)
+        layout.addWidget(self.holoResumeBtn)
+        
+        layout.addWidget(QLabel("Soak Test Duration (s):"))
+        layout.addWidget(self.holoSoakDurationInput)
+        layout.addWidget(self.holoSoakTestBtn)
+        
+        self.processingStatusLabel = QLabel("")
+        layout.addWidget(self.processingStatusLabel)
+        self.processingStatusLabel.setProperty('status', 'true')
+        
+        layout.addWidget(self.holoLatencyOverlayCheck)
+        layout.addWidget(QLabel("Latency CSV File:"))
+        layout.addWidget(self.holoLatencyCsvInput)
 
         layout.addStretch()
         
@@ -290,11 +566,39 @@ class Holo_Bundle(CAS_GUI_Bundle):
         self.holoPixelSizeInput.valueChanged[float].connect(self.processing_options_changed)
         self.holoRefocusCheck.stateChanged.connect(self.processing_options_changed)
         self.holoPhaseCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoUnwrapPhaseCheck.stateChanged.connect(self.processing_options_changed)
         self.holoDifferentialCheck.stateChanged.connect(self.processing_options_changed)
         self.holoInvertCheck.stateChanged.connect(self.processing_options_changed)
         self.holoWindowThicknessInput.valueChanged[float].connect(self.processing_options_changed)
         self.holoWindowCombo.currentIndexChanged[int].connect(self.processing_options_changed)
         self.holoSliderMaxInput.valueChanged[int].connect(self.processing_options_changed)
+        self.holoHistoryLengthInput.valueChanged[float].connect(self.processing_options_changed)
+        self.holoRawArchiveCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoRawArchiveFolderInput.editingFinished.connect(self.processing_options_changed)
+        self.holoBackpressureCombo.currentIndexChanged[int].connect(self.processing_options_changed)
+        self.holoBackpressureNInput.valueChanged[int].connect(self.processing_options_changed)
+        self.holoPoolWorkersInput.valueChanged[int].connect(self.processing_options_changed)
+        self.holoAdaptiveQualityCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoTargetFpsInput.valueChanged[float].connect(self.processing_options_changed)
+        self.holoPublishCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoPublishPortInput.valueChanged[int].connect(self.processing_options_changed)
+        self.holoCheckpointCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoCheckpointIntervalInput.valueChanged[int].connect(self.processing_options_changed)
+        self.holoResumeBtn.clicked.connect(self.resume_checkpoint_clicked)
+        self.holoSweepBtn.clicked.connect(self.parameter_sweep_clicked)
+        self.holoSoakTestBtn.clicked.connect(self.soak_test_clicked)
+        self.holoLatencyOverlayCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoFastDisplayCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoMosaicCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoShowMosaicCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoResetMosaicBtn.clicked.connect(self.reset_mosaic_clicked)
+        self.holoLatencyCsvInput.editingFinished.connect(self.processing_options_changed)
+        self.holoParticleCheck.stateChanged.connect(self.processing_options_changed)
+        self.holoParticleMinDepthInput.valueChanged[float].connect(self.processing_options_changed)
+        self.holoParticleMaxDepthInput.valueChanged[float].connect(self.processing_options_changed)
+        self.holoParticleNumDepthsInput.valueChanged[int].connect(self.processing_options_changed)
+        self.holoParticleCsvInput.editingFinished.connect(self.processing_options_changed)
+        self.holoResetTracksBtn.clicked.connect(self.reset_tracks_clicked)
 
         return widget  
 
@@ -323,7 +627,10 @@ class Holo_Bundle(CAS_GUI_Bundle):
         self.srMultiNormalisationCheck = QCheckBox('Use Normalisation Stack', objectName = 'srMultiNormalisation')
         self.srCaptureShiftBtn = QPushButton('Capture Shift')
         self.srGenerateLUTBtn = QPushButton('Generate Calibration LUT')
+        self.srFastShiftCheck = QCheckBox('Fast Shift Estimation', objectName = 'srFastShiftCheck')
+        self.srCompareShiftCheck = QCheckBox('Compare Shift Estimation Timing', objectName = 'srCompareShiftCheck')
         self.srUseLUTCheck = QCheckBox('Use Calibration LUT')
+        self.srSparseCheck = QCheckBox('Fast SR Reconstruction (precomputed matrix)', objectName = 'srSparseCheck')
         self.srLUTMinInput = QDoubleSpinBox(objectName = 'srLUTMinInput')
         self.srLUTMinInput.setMaximum(10000)
         self.srLUTMaxInput = QDoubleSpinBox(objectName = 'srLUTMaxInput')
@@ -352,9 +659,12 @@ class Holo_Bundle(CAS_GUI_Bundle):
         layout.addWidget(self.srMultiBackgroundsCheck)
         layout.addWidget(self.srMultiNormalisationCheck)
         layout.addWidget(self.srUseLUTCheck)
+        layout.addWidget(self.srSparseCheck)
         layout.addWidget(self.srCaptureShiftBtn)
 
         layout.addWidget(self.srGenerateLUTBtn)
+        layout.addWidget(self.srFastShiftCheck)
+        layout.addWidget(self.srCompareShiftCheck)
         
         layout.addWidget(QLabel('LUT Min Depth (microns):'))
         layout.addWidget(self.srLUTMinInput)
@@ -380,6 +690,7 @@ class Holo_Bundle(CAS_GUI_Bundle):
         self.srMultiBackgroundsCheck.stateChanged.connect(self.processing_options_changed)
         self.srMultiNormalisationCheck.stateChanged.connect(self.processing_options_changed)
         self.srUseLUTCheck.stateChanged.connect(self.processing_options_changed)
+        self.srSparseCheck.stateChanged.connect(self.processing_options_changed)
         
         self.holoWindowThicknessInput.valueChanged[float].connect(self.processing_options_changed)
         self.srGenerateLUTBtn.clicked.connect(self.sr_generate_LUT_clicked)
@@ -418,18 +729,122 @@ class Holo_Bundle(CAS_GUI_Bundle):
 
     def update_image_display(self):
         """ Puts either raw or (if available) processed image on display"""       
-        if self.bundleShowRaw.isChecked():
+        if self.holoHistorySlider.value() > 0 and self.historyImage is not None:
+           self.set_display_image(self.historyImage)
+        elif self.bundleShowRaw.isChecked():
            if self.currentImage is not None:
-               self.mainDisplay.set_mono_image(self.currentImage)
+               self.set_display_image(self.currentImage)
+        elif self.holoFastDisplayCheck.isChecked() and self.displayChannel is not None and self.currentProcessedImage is not None:
+           # The processor only writes a new display image when it changes
+           latest = self.displayChannel.read()
+           if latest is not None:
+               self.set_display_image(latest[1])
+           elif self.lastDisplayedImage is None:
+               self.set_display_image(self.currentProcessedImage)
         else:
            if self.currentProcessedImage is not None:
-               self.mainDisplay.set_mono_image(self.currentProcessedImage)
+               self.set_display_image(self.currentProcessedImage)
            else:
                if self.currentImage is not None:
-                   self.mainDisplay.set_mono_image(self.currentImage)
-                   
-                   
-    
+                   self.set_display_image(self.currentImage)
+        
+        self.check_display_size()
+
+        self.update_latency_telemetry()
+        self.update_processing_status()
+        
+        
+    def set_display_image(self, img):
+        """ Sends image to the main display unless it is the same image as
+        last time.
+        """
+        if img is self.lastDisplayedImage:
+            return
+        self.lastDisplayedImage = img
+        self.mainDisplay.set_mono_image(img)
+        
+        
+    def check_display_size(self):
+        """ With fast display on, tells the processor if the display has 
+        been resized.
+        """
+        if self.imageProcessor is None or not self.holoFastDisplayCheck.isChecked():
+            return
+        displaySize = (self.mainDisplay.width(), self.mainDisplay.height())
+        if displaySize != self.displaySize:
+            self.displaySize = displaySize
+            self.imageProcessor.get_processor().set_display_size(*displaySize)
+            self.imageProcessor.pipe_message('set_display_size', displaySize)
+        
+        
+    def update_latency_telemetry(self):
+        """ Records the time at which the latest processed frame was displayed
+        and updates the latency overlay.
+        """
+        if self.metricsChannel is None or self.displayTelemetry is None:
+            return
+        if self.bundleShowRaw.isChecked() or self.currentProcessedImage is None:
+            return
+        frameNumber = int(self.metricsChannel.get('frameNumber'))
+        if frameNumber != self.lastDisplayedFrameNumber:
+            self.lastDisplayedFrameNumber = frameNumber
+            frame = {'frame': frameNumber, 
+                     'received': self.metricsChannel.get('frameReceived'),
+                     'output': self.metricsChannel.get('frameOutput'),
+                     'displayed': time.time()}
+            # Acquisition time is 0 if the source does not record it
+            if self.metricsChannel.get('frameAcquired') > 0:
+                frame['acquired'] = self.metricsChannel.get('frameAcquired')
+            self.displayTelemetry.add_frame(frame)
+        
+        if time.time() - self.lastLatencyUpdate > 0.5:
+            self.lastLatencyUpdate = time.time()
+            title = "Camera to display"
+            percentiles = self.displayTelemetry.percentiles('acquired', 'displayed')
+            if percentiles is None:
+                title = "Processor input to display"
+                percentiles = self.displayTelemetry.percentiles('received', 'displayed')
+            if percentiles is not None and self.holoLatencyOverlayCheck.isChecked():
+                self.latencyOverlay.setText(f"{title} latency (ms) p50: {percentiles[0] * 1000:.0f}  p90: {percentiles[1] * 1000:.0f}  p99: {percentiles[2] * 1000:.0f}\n"
+                                            f"Sort: {self.metricsChannel.get('sortTime') * 1000:.1f}  "
+                                            f"Core removal: {self.metricsChannel.get('bundleTime') * 1000:.1f}  "
+                                            f"Refocus: {self.metricsChannel.get('refocusTime') * 1000:.1f}  "
+                                            f"Post: {self.metricsChannel.get('postTime') * 1000:.1f}  "
+                                            f"Processor p50: {self.metricsChannel.get('latencyP50') * 1000:.0f}")
+                self.latencyOverlay.adjustSize()
+            
+
+    def update_processing_status(self):
+        """ Shows queue depth and latency metrics written by the processor.
+        """
+        if self.metricsChannel is None:
+            return
+        metrics = self.metricsChannel.as_dict()
+        if metrics['updated'] == 0:
+            return
+        status = (f"Queue: {int(metrics['queueDepth'])} (max {int(metrics['queueDepthMax'])})\n"
+                  f"Latency: {metrics['latency'] * 1000:.0f} ms\n"
+                  f"Skipped: {int(metrics['skipped'])} of {int(metrics['processed'] + metrics['skipped'])}")
+        if metrics['saturated']:
+            status = status + "\nProcessing saturated"
+        if self.holoAdaptiveQualityCheck.isChecked() and metrics['qualityLevel'] > 0:
+            status = status + f"\nReduced quality (level {int(metrics['qualityLevel'])}) to hold frame rate"
+        if self.holoParticleCheck.isChecked():
+            status = status + f"\nParticles: {int(metrics['particleCount'])}  Tracks: {int(metrics['trackCount'])}"
+        if self.statusMessage:
+            status = status + "\n" + self.statusMessage
+        self.processingStatusLabel.setText(status)
+        
+        
+    def set_status_message(self, message):
+        """ Shows message below the processing status, until it is replaced
+        by another message.
+        """
+        self.statusMessage = message
+        self.processingStatusLabel.setText(message)
+
+
+
     def processing_options_changed(self):   
         """Called when changes are made to the options pane. Updates the processor thread."""
         
@@ -440,6 +855,7 @@ class Holo_Bundle(CAS_GUI_Bundle):
         # Holography specific processing
         if self.imageProcessor is not None:
             self.imageProcessor.get_processor().showPhase = self.holoPhaseCheck.isChecked()
+            self.imageProcessor.get_processor().unwrapPhase = self.holoUnwrapPhaseCheck.isChecked()
             self.imageProcessor.get_processor().invert = self.holoInvertCheck.isChecked()
             self.imageProcessor.get_processor().holo.cuda = self.cuda   
             if self.holoRefocusCheck.isChecked():
@@ -458,18 +874,83 @@ class Holo_Bundle(CAS_GUI_Bundle):
                 
                 # Depth
                 if self.holoDepthInput.value() != self.imageProcessor.get_processor().holo.depth / 10**6:
-                    self.imageProcessor.get_processor().holo.set_depth(self.holoDepthInput.value()/ 10**6)
+                    self.imageProcessor.get_processor().set_depth(self.holoDepthInput.value()/ 10**6)
                 
                 # Windowing
                 if self.holoWindowCombo.currentText() == "Circular":
-                    self.imageProcessor.get_processor().holo.set_auto_window(True)
-                    self.imageProcessor.get_processor().holo.set_window_shape('circle')                    
-                    self.imageProcessor.get_processor().holo.set_window_radius(None)
-                    self.imageProcessor.get_processor().holo.set_window_thickness(self.holoWindowThicknessInput.value())
+                    self.imageProcessor.get_processor().set_window('circle', None, self.holoWindowThicknessInput.value())
                 else:
-                    self.imageProcessor.get_processor().holo.window = None
+                    self.imageProcessor.get_processor().set_window(None)
             else:
                 self.imageProcessor.get_processor().refocus = False
+                
+            # Backpressure and metrics
+            self.imageProcessor.get_processor().set_backpressure(self.holoBackpressureCombo.currentIndex(), everyN = self.holoBackpressureNInput.value())
+            self.imageProcessor.get_processor().poolWorkers = self.holoPoolWorkersInput.value()
+            self.imageProcessor.get_processor().adaptiveQuality = self.holoAdaptiveQualityCheck.isChecked()
+            self.imageProcessor.get_processor().targetFps = self.holoTargetFpsInput.value()
+            if self.metricsChannel is not None:
+                self.imageProcessor.get_processor().metricsFile = self.metricsChannel.filename
+            
+            # Latency telemetry, the processor streams per-stage timestamps to the
+            # CSV file and we stream display timestamps to a second file
+            if self.holoLatencyCsvInput.text() != "":
+                csvFile = self.holoLatencyCsvInput.text()
+                self.imageProcessor.get_processor().telemetryCsvFile = csvFile
+                if self.displayTelemetry is not None:
+                    self.displayTelemetry.set_csv_file(os.path.splitext(csvFile)[0] + '_display.csv')
+            else:
+                self.imageProcessor.get_processor().telemetryCsvFile = None
+                if self.displayTelemetry is not None:
+                    self.displayTelemetry.set_csv_file(None)
+            self.latencyOverlay.setVisible(self.holoLatencyOverlayCheck.isChecked())
+            
+            # Mosaicing
+            self.imageProcessor.get_processor().mosaicRefocus = self.holoMosaicCheck.isChecked()
+            self.imageProcessor.get_processor().showMosaic = self.holoShowMosaicCheck.isChecked()
+            
+            # Particle tracking
+            self.imageProcessor.get_processor().trackParticles = self.holoParticleCheck.isChecked()
+            self.imageProcessor.get_processor().particleDepthRange = (self.holoParticleMinDepthInput.value() / 10**6, self.holoParticleMaxDepthInput.value() / 10**6)
+            self.imageProcessor.get_processor().particleNumDepths = self.holoParticleNumDepthsInput.value()
+            if self.holoParticleCsvInput.text() != "":
+                self.imageProcessor.get_processor().set_particle_csv(self.holoParticleCsvInput.text())
+            else:
+                self.imageProcessor.get_processor().set_particle_csv(None)
+            
+            # Publishing to other processes
+            if self.holoPublishCheck.isChecked():
+                self.imageProcessor.get_processor().set_publish_port(self.holoPublishPortInput.value())
+            else:
+                self.imageProcessor.get_processor().set_publish_port(None)
+            
+            # Frame history
+            self.imageProcessor.get_processor().historyFile = default_history_file()
+            self.imageProcessor.get_processor().historySeconds = self.holoHistoryLengthInput.value()
+            
+            # Checkpoints. The timer is only restarted if the interval changes,
+            # otherwise frequent settings changes would prevent checkpoints.
+            if getattr(self, 'checkpointTimer', None) is not None:
+                if self.holoCheckpointCheck.isChecked():
+                    interval = self.holoCheckpointIntervalInput.value() * 1000
+                    if not self.checkpointTimer.isActive() or self.checkpointTimer.interval() != interval:
+                        self.checkpointTimer.start(interval)
+                else:
+                    self.checkpointTimer.stop()
+            
+            # Fast display
+            self.imageProcessor.get_processor().fastDisplay = self.holoFastDisplayCheck.isChecked()
+            if self.displayChannel is not None:
+                self.imageProcessor.get_processor().displayFile = self.displayChannel.filename
+            self.displaySize = (self.mainDisplay.width(), self.mainDisplay.height())
+            self.imageProcessor.get_processor().set_display_size(*self.displaySize)
+                
+            # Raw archive
+            if self.holoRawArchiveCheck.isChecked() and self.holoRawArchiveFolderInput.text() != "":
+                self.imageProcessor.get_processor().archiveSettings = {'srSingleLED': self.sr_single_led_id}
+                self.imageProcessor.get_processor().set_raw_archive(self.holoRawArchiveFolderInput.text())
+            else:
+                self.imageProcessor.get_processor().set_raw_archive(None)
         
         # The basic bundle processing is defined in CAS_GUI_Bundle
         super().processing_options_changed()
@@ -506,6 +987,7 @@ class Holo_Bundle(CAS_GUI_Bundle):
                 self.imageProcessor.get_processor().pyb.set_sr_multi_backgrounds(self.srMultiBackgroundsCheck.isChecked())
                 self.imageProcessor.set_batch_process_num(self.srNumShiftsInput.value() + 1)
                 self.imageProcessor.get_processor().pyb.set_sr_use_lut(self.srUseLUTCheck.isChecked())
+                self.imageProcessor.get_processor().sparseSR = self.srSparseCheck.isChecked()
                 self.imageProcessor.get_processor().pyb.set_sr_param_value(self.holoDepthInput.value()/ 10**6)
 
                 if self.imageThread is not None:
@@ -526,15 +1008,197 @@ class Holo_Bundle(CAS_GUI_Bundle):
                 self.imageProcessor.get_processor().set_differential(False)
                 self.update_file_processing()
 
+            self.imageProcessor.get_processor().settings_changed()
             self.imageProcessor.update_settings()
 
 
+    def reset_mosaic_clicked(self):
+        """ Clears the mosaic of refocused images.
+        """
+        if self.imageProcessor is not None:
+            self.imageProcessor.get_processor().reset_mosaic()
+            self.imageProcessor.update_settings()
+            
+            
+    def reset_tracks_clicked(self):
+        """ Ends all particle tracks.
+        """
+        if self.imageProcessor is not None:
+            self.imageProcessor.get_processor().reset_particle_tracks()
+            self.imageProcessor.update_settings()
+            
+            
+    def get_checkpoint(self):
+        folder = self.holoCheckpointFolderInput.text()
+        return Checkpoint(folder if folder != "" else None)
+    
+    
+    def widget_values(self):
+        """ Returns dictionary of the values of all named input widgets.
+        """
+        values = {}
+        for widget in self.findChildren(QWidget):
+            name = widget.objectName()
+            if name == "":
+                continue
+            if isinstance(widget, QCheckBox):
+                values[name] = widget.isChecked()
+            elif isinstance(widget, (QSpinBox, QDoubleSpinBox)):
+                values[name] = widget.value()
+            elif isinstance(widget, QComboBox):
+                values[name] = widget.currentIndex()
+            elif isinstance(widget, QLineEdit):
+                values[name] = widget.text()
+        return values
+    
+    
+    def set_widget_values(self, values):
+        """ Sets values of named input widgets from a dictionary returned by
+        widget_values, without triggering their signals.
+        """
+        for widget in self.findChildren(QWidget):
+            name = widget.objectName()
+            if name not in values:
+                continue
+            widget.blockSignals(True)
+            if isinstance(widget, QCheckBox):
+                widget.setChecked(bool(values[name]))
+            elif isinstance(widget, (QSpinBox, QDoubleSpinBox)):
+                widget.setValue(values[name])
+            elif isinstance(widget, QComboBox):
+                widget.setCurrentIndex(int(values[name]))
+            elif isinstance(widget, QLineEdit):
+                widget.setText(str(values[name]))
+            widget.blockSignals(False)
+            
+            
+    def write_checkpoint(self):
+        """ Writes settings, backgrounds and calibrations to the checkpoint 
+        folder. Only those which have changed since the last checkpoint are
+        written.
+        """
+        if self.imageProcessor is None:
+            return
+        processor = self.imageProcessor.get_processor()
+        state = {'widgets': self.widget_values(),
+                 'processor': processor.get_settings_dict(),
+                 'rawArchiveFolder': processor.rawArchiveFolder}
+        objects = processor.checkpoint_objects()
+        objects.update({'gui.backgroundImage': self.backgroundImage, 
+                        'gui.srBackgrounds': self.srBackgrounds})
+        try:
+            self.get_checkpoint().save(state, objects)
+        except OSError as e:
+            self.set_status_message("Checkpoint failed: " + str(e))
+            
+            
+    def resume_checkpoint_clicked(self):
+        if not self.resume_checkpoint():
+            QMessageBox.about(self, "Error", "No checkpoint found.")
+            
+            
+    def resume_checkpoint(self):
+        """ Restores the last checkpoint. Raw archiving, if it was on, 
+        continues by appending to the same archive. Returns False if there is
+        no checkpoint.
+        """
+        checkpoint = self.get_checkpoint().load()
+        if checkpoint is None or self.imageProcessor is None:
+            return False
+        checkpointTime, state, objects = checkpoint
+        self.set_widget_values(state['widgets'])
+        if 'gui.backgroundImage' in objects:
+            self.backgroundImage = objects['gui.backgroundImage']
+        if 'gui.srBackgrounds' in objects:
+            self.srBackgrounds = objects['gui.srBackgrounds']
+        self.handle_sr_enabled()
+        
+        # Calibrations are restored after the settings, which could 
+        # otherwise clear them
+        self.imageProcessor.get_processor().restore_checkpoint_objects(objects)
+        self.imageProcessor.update_settings()
+        
+        message = f"Resumed from checkpoint of {time.ctime(checkpointTime)}"
+        folder = state.get('rawArchiveFolder')
+        if folder is not None and os.path.exists(os.path.join(folder, 'header.json')):
+            message = message + f", appending to raw archive of {len(RawArchive(folder))} frames"
+        self.set_status_message(message)
+        return True
+        
+        
     def holo_depth_changed(self):
         if self.imageProcessor is not None:
             if self.holoDepthInput.value() != self.imageProcessor.get_processor().holo.depth / 10**6:
-                self.imageProcessor.get_processor().holo.set_depth(self.holoDepthInput.value()/ 10**6)
+                self.imageProcessor.get_processor().set_depth(self.holoDepthInput.value()/ 10**6)
                 self.update_file_processing()
                 self.imageProcessor.pipe_message('set_depth', self.holoDepthInput.value()/ 10**6)
+                if self.holoHistorySlider.value() > 0:
+                    self.show_history_frame()
+                    
+                    
+    def refresh_history(self):
+        """ Takes a snapshot of the frames in the history, so that the 
+        history slider selects from these even as new frames are added.
+        """
+        if self.imageProcessor is None:
+            return
+        history = self.imageProcessor.get_processor().get_history_reader()
+        self.historyEntries = [] if history is None else history.available(self.holoHistoryLengthInput.value())
+        self.holoHistorySlider.setMaximum(max(len(self.historyEntries) - 1, 0))
+        
+        
+    def selected_history_frame(self):
+        """ Returns (frameNumber, timestamp) of frame selected with the
+        history slider, or None if showing live frames.
+        """
+        back = self.holoHistorySlider.value()
+        if back == 0 or back >= len(self.historyEntries):
+            return None
+        return self.historyEntries[-1 - back]
+        
+        
+    def history_slider_changed(self):
+        if self.holoHistorySlider.value() == 0:
+            self.holoHistoryLabel.setText("Live")
+            self.historyImage = None
+        else:
+            self.show_history_frame()
+        self.update_image_display()
+        
+        
+    def show_history_frame(self):
+        """ Refocuses the frame selected with the history slider to the 
+        current depth and displays it.
+        """
+        selected = self.selected_history_frame()
+        if selected is None or self.imageProcessor is None:
+            return
+        frameNumber, timestamp = selected
+        processor = self.imageProcessor.get_processor()
+        if self.holoRefocusCheck.isChecked():
+            img = processor.refocus_history_frame(frameNumber)
+            if img is not None:
+                img = processor.get_post_chain().run(img)
+        else:
+            img = processor.history_frame(frameNumber)
+        if img is None:
+            self.holoHistoryLabel.setText("Frame no longer available")
+            return
+        self.holoHistoryLabel.setText(f"Frame {frameNumber} ({timestamp - time.time():.1f} s)")
+        self.historyImage = img
+        self.set_display_image(img)
+        
+        
+    def selected_hologram(self):
+        """ Returns the core-removed hologram selected with the history
+        slider, or the latest hologram if showing live frames.
+        """
+        selected = self.selected_history_frame()
+        if selected is not None:
+            img = self.imageProcessor.get_processor().history_frame(selected[0])
+            if img is not None:
+                return img
+        return self.imageProcessor.preProcessFrame
 
 
     def handle_sr_enabled(self):        
@@ -577,8 +1241,8 @@ class Holo_Bundle(CAS_GUI_Bundle):
             roi = pyholoscope.Roi(self.mainDisplay.roi[0], self.mainDisplay.roi[1], self.even(self.mainDisplay.roi[2] - self.mainDisplay.roi[0]), self.even(self.mainDisplay.roi[3] - self.mainDisplay.roi[1]))
         else:
             roi = None
-        autofocusMax = self.holoAutoFocusMaxInput.value() / 1000
-        autofocusMin = self.holoAutoFocusMinInput.value() / 1000
+        autofocusMax = self.holoAutoFocusMaxInput.value() / 10**6
+        autofocusMin = self.holoAutoFocusMinInput.value() / 10**6
         if self.holoAutoFocusCoarseDivisionsInput.value() > 1:
             numSearchDivisions = int(self.holoAutoFocusCoarseDivisionsInput.value())
         else:
@@ -586,34 +1250,124 @@ class Holo_Bundle(CAS_GUI_Bundle):
         autofocusROIMargin = self.holoAutoFocusROIMarginInput.value()
         if self.imageThread is not None:
             self.imageThread.pause()
-        autoFocus = (self.imageProcessor.auto_focus(roi = roi, method = 'Peak', margin = None, depthRange = (autofocusMin, autofocusMax), coarseSearchInterval =  numSearchDivisions))
-        self.holoDepthInput.setValue(autoFocus * 1000) 
+            
+        # Autofocus is done here rather than by the processor so that the
+        # planes are kept in this process for a following depth stack export.
+        # The whole frame is refocused (no ROI margin) so that these planes
+        # can be reused by the export.
+        img = self.selected_hologram()
+        if img is not None:
+            autoFocus = self.imageProcessor.get_processor().auto_focus_frame(img, (autofocusMin, autofocusMax), numSearchDivisions, roi,
+                                                                             metric = 'Peak', margin = None)
+            self.holoDepthInput.setValue(autoFocus * 10**6) 
 
         if self.imageThread is not None:
             self.imageThread.resume()
 
+
+    def soak_test_clicked(self):
+        """ Replays the simulated camera source file (or synthetic holograms)
+        through a copy of the processor at the target frame rate, and reports
+        the throughput.
+        """
+        if self.imageProcessor is None:
+            QMessageBox.about(self, "Error", "Processor is not running.")
+            return
+        processor = self.imageProcessor.get_processor().worker_copy()
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        self.imageProcessor.pause()
+        try:
+            frames = read_tif_frames(self.replay_source_file(), processor.batchProcessNum if processor.sr else None)
+            stats = soak_test(processor, ReplaySource(frames, fps = self.holoTargetFpsInput.value()),
+                              duration = self.holoSoakDurationInput.value(), report = None)
+        finally:
+            self.imageProcessor.resume()
+            QApplication.restoreOverrideCursor()
+        QMessageBox.about(self, "Soak Test", f"{stats['frames']} frames at {stats['fps']:.1f} fps, {stats['late']} late\n"
+                                             f"Process time p50 {stats['processTimeP50'] * 1000:.1f} ms, "
+                                             f"p99 {stats['processTimeP99'] * 1000:.1f} ms, max {stats['processTimeMax'] * 1000:.1f} ms")
+        
+        
+    def parameter_sweep_clicked(self):
+        """ Fits the pixel size or wavelength so that the selected hologram,
+        of a target at a known depth, comes into best focus at that depth.
+        The other parameter is kept at its current value.
+        """
+        img = self.selected_hologram()
+        if img is None:
+            QMessageBox.about(self, "Error", "No hologram to calibrate from.")
+            return
+        processor = self.imageProcessor.get_processor()
+        if self.mainDisplay.roi is not None:
+            roi = pyholoscope.Roi(self.mainDisplay.roi[0], self.mainDisplay.roi[1], self.even(self.mainDisplay.roi[2] - self.mainDisplay.roi[0]), self.even(self.mainDisplay.roi[3] - self.mainDisplay.roi[1]))
+        else:
+            roi = None
+        param = parameter_sweep.PARAMETERS[self.holoSweepParamCombo.currentIndex()]
+        current = processor.holo.pixelSize if param == 'pixelSize' else processor.holo.wavelength
+        fraction = self.holoSweepRangeInput.value() / 100
+        values = np.linspace(current * (1 - fraction), current * (1 + fraction), self.holoSweepStepsInput.value())
+        depthRange = (self.holoAutoFocusMinInput.value() / 10**6, self.holoAutoFocusMaxInput.value() / 10**6)
+        
+        if self.imageThread is not None:
+            self.imageThread.pause()
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            result = processor.parameter_sweep(img, param, values, depthRange, self.holoSweepPlanesInput.value(),
+                                               self.holoSweepTargetDepthInput.value() / 10**6, roi = roi)
+        finally:
+            QApplication.restoreOverrideCursor()
+            if self.imageThread is not None:
+                self.imageThread.resume()
+        
+        best = result['value']
+        if best <= min(values) or best >= max(values):
+            QMessageBox.about(self, "Warning", "Best fit is at the end of the sweep, try a larger range.")
+        if param == 'pixelSize':
+            # The input is the pixel size before scaling by the bundle processing
+            self.holoPixelSizeInput.setValue(self.holoPixelSizeInput.value() * best / current)
+        else:
+            self.holoWavelengthInput.setValue(best * 10**6)
+        
         
     def sr_generate_LUT_clicked(self):
         """ Called when SR Generate LUT button is clicked.
         """
         param_depths = np.array(self.sr_param_depths)
-        param_holograms = np.stack(self.sr_param_holograms, axis = 3)
+        
+        # Memory-mapped if the captured stacks were too large to keep in memory
+        param_holograms = self.sr_param_holograms.as_array()
+        if param_holograms is None:
+            QMessageBox.about(self, "Error", "No shifts have been captured.")  
+            return
         
         QApplication.setOverrideCursor(Qt.WaitCursor)
        
         if self.imageThread is not None: self.imageThread.pause() 
         if self.imageProcessor is not None: self.imageProcessor.pause()
                
-        #t1 = time.perf_counter()
-        self.srParamShiftCalib = pybundle.SuperRes.calib_param_shift(param_depths, param_holograms, self.imageProcessor.pyb.calibration, forceZero = True)
+        calibration = self.imageProcessor.pyb.calibration
+        comparison = None
+        if self.srCompareShiftCheck.isChecked():
+            comparison = shift_calibration.benchmark(param_depths, param_holograms, calibration, forceZero = True)
+        
+        if self.srFastShiftCheck.isChecked():
+            self.srParamShiftCalib, shifts, timings = shift_calibration.calib_param_shift(param_depths, param_holograms, calibration, forceZero = True)
+        else:
+            self.srParamShiftCalib = pybundle.SuperRes.calib_param_shift(param_depths, param_holograms, calibration, forceZero = True)
         self.imageProcessor.pyb.set_calib_image(self.backgroundImage)
         self.imageProcessor.pyb.calibrate_sr_lut(self.srParamShiftCalib, (self.srLUTMinInput.value() / 10**6, self.srLUTMaxInput.value() / 10**6), self.srLUTNumStepsInput.value())
+        self.imageProcessor.get_processor().settings_changed()
         #print(f"LUT took {time.perf_counter() -t1} to build.")
         
         if self.imageThread is not None: self.imageThread.resume()
         if self.imageProcessor is not None: self.imageProcessor.resume()
         QApplication.restoreOverrideCursor()
         
+        if comparison is not None:
+            QMessageBox.about(self, "Shift Estimation",
+                              f"PyBundle: {comparison['pybundle']:.2f} s\nFast: {comparison['fast']:.2f} s ({comparison['speedup']:.1f}x)\n"
+                              f"Max coefficient difference: {comparison.get('maxDifference', 0):.3g}")
+        
         
     def sr_capture_shift_clicked(self):
         """
@@ -630,7 +1384,9 @@ class Holo_Bundle(CAS_GUI_Bundle):
     def sr_clear_shifts_clicked(self):
         """
         """
-        self.sr_param_holograms = []
+        if self.sr_param_holograms is not None:
+            self.sr_param_holograms.clear()
+        self.sr_param_holograms = CaptureBuffer(self.srCaptureMemoryBudget)
         self.sr_param_depths = []
 
 
@@ -665,10 +1421,10 @@ class Holo_Bundle(CAS_GUI_Bundle):
         self.imageProcessor.get_processor().currentInputImage = self.currentImage
         self.imageProcessor.get_processor().pyb.set_sr_calib_images(frames)
 
-        self.imageProcessor.get_processor().pyb.calibrate_sr()
+        self.imageProcessor.get_processor().calibrate_bundle_sr()
             
         # We also do a conventional calibration at the same time
-        self.imageProcessor.get_processor().pyb.calibrate()            
+        self.imageProcessor.get_processor().calibrate_bundle()            
         #   QApplication.restoreOverrideCursor()
             
     def save_sr_calib_clicked(self):
@@ -747,6 +1503,7 @@ class Holo_Bundle(CAS_GUI_Bundle):
         self.holoPixelSizeInput.setValue(0.64)
         self.holoRefocusCheck.setChecked(True)
         self.holoPhaseCheck.setChecked(False)
+        self.holoUnwrapPhaseCheck.setChecked(False)
         self.holoInvertCheck.setChecked(False)
         self.holoWindowCombo.setCurrentIndex(1)
         self.holoWindowThicknessInput.setValue(20)
@@ -768,21 +1525,49 @@ class Holo_Bundle(CAS_GUI_Bundle):
         """ Creates a depth stack over a specified range.
         """
         
-        if self.imageProcessor is not None and (self.imageProcessor.preProcessFrame is not None or self.currentImage is not None):
-            if self.exportStackDialog.exec():
-                try:
-                    filename = QFileDialog.getSaveFileName(self, 'Select filename to save to:', '', filter='*.tif')[0]
-                except:
-                    filename = None
-                if filename is not None and filename != '':
-                     depthRange = (self.exportStackDialog.depthStackMinDepthInput.value() / 1000, self.exportStackDialog.depthStackMaxDepthInput.value() / 1000)
-                     nDepths = int(self.exportStackDialog.depthStackNumDepthsInput.value())
-                     QApplication.setOverrideCursor(Qt.WaitCursor)
-                     depthStack = self.imageProcessor.get_processor().holo.depth_stack(self.imageProcessor.preProcessFrame, depthRange, nDepths)
+        img = self.selected_hologram() if self.imageProcessor is not None else None
+        if img is None:
+            QMessageBox.about(self, "Error", "A hologram is required to create a depth stack.") 
+            return
+        if self.exportStackDialog.exec():
+            try:
+                filename, fileFilter = QFileDialog.getSaveFileName(self, 'Select filename to save to:', '', filter = TIF_STACK_FILTER + ';;' + CHUNKED_STACK_FILTER)
+            except:
+                filename = None
+            if filename is not None and filename != '':
+                 depthRange = (self.exportStackDialog.depthStackMinDepthInput.value() / 1000, self.exportStackDialog.depthStackMaxDepthInput.value() / 1000)
+                 nDepths = int(self.exportStackDialog.depthStackNumDepthsInput.value())
+                 if filename.endswith(chunked_store.EXTENSION) or fileFilter == CHUNKED_STACK_FILTER:
+                     if not filename.endswith(chunked_store.EXTENSION):
+                         filename = filename + chunked_store.EXTENSION
+                     self.export_chunked_depth_stack(img, filename, depthRange, nDepths)
+                     return
+                 QApplication.setOverrideCursor(Qt.WaitCursor)
+                 try:
+                     depths, stack = self.imageProcessor.get_processor().depth_stack(img, depthRange, nDepths)
+                 finally:
                      QApplication.restoreOverrideCursor()
-                     depthStack.write_intensity_to_tif(filename)
-        else:
-              QMessageBox.about(self, "Error", "A hologram is required to create a depth stack.") 
+                 write_stack_tif(filename, stack)
+              
+              
+    def export_chunked_depth_stack(self, img, folder, depthRange, nDepths):
+        """ Writes depth stack of core-removed hologram img to a chunked 
+        store. If 'Append as new time point' is checked and the store already
+        exists, the stack is added as the next time point, allowing a 
+        time-lapse to be built up.
+        """
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            depths, stack = self.imageProcessor.get_processor().depth_stack(img, depthRange, nDepths)
+            if self.exportStackDialog.depthStackAppendCheck.isChecked() and os.path.exists(os.path.join(folder, 'meta.json')):
+                ChunkedStore(folder).append(stack)
+            else:
+                store = ChunkedStore.create(folder, (0,) + np.shape(stack), stack.dtype, depths = depths)
+                store.append(stack)
+        except ValueError as e:
+            QMessageBox.about(self, "Error", str(e))
+        finally:
+            QApplication.restoreOverrideCursor()
 
 
 
@@ -825,6 +1610,9 @@ class ExportStackDialog(QDialog):
         self.layout.addWidget(QLabel("Number of Depths:"))
         self.layout.addWidget(self.depthStackNumDepthsInput)
         
+        self.depthStackAppendCheck = QCheckBox("Append as new time point (" + chunked_store.EXTENSION + " only)")
+        self.layout.addWidget(self.depthStackAppendCheck)
+        
         self.layout.addWidget(self.buttonBox)
         self.setLayout(self.layout)
         
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Array File Cache
+
+Stores arrays which are expensive to compute, such as windows, in a folder of
+.npy files named by a hash of a key. Arrays are loaded memory-mapped, so
+several processes using the same cache folder share one copy of each array
+in memory (through the operating system's file cache) and each array is only
+computed once, by whichever process needs it first.
+
+A small number of recently used arrays are also kept in memory.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import hashlib
+import tempfile
+import collections
+
+import numpy as np
+
+
+def default_cache_folder(name):
+    """ Returns folder called name in the temp folder.
+    """
+    return os.path.join(tempfile.gettempdir(), 'holobundle_cache', name)
+
+
+def key_hash(key):
+    """ Returns hex digest identifying a key made of numbers, strings, None
+    and tuples of these.
+    """
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+class ArrayFileCache:
+    """ Cache of arrays stored on disk and loaded memory-mapped.
+
+    Arguments:
+        folder      : str, cache folder, created if does not exist. If None,
+                      arrays are only cached in memory.
+
+    Keyword Arguments:
+        maxInMemory : int, number of arrays to keep in memory, default 16
+    """
+
+    def __init__(self, folder, maxInMemory = 16):
+
+        self.folder = folder
+        self.maxInMemory = maxInMemory
+        self.memory = collections.OrderedDict()
+        if folder is not None:
+            os.makedirs(folder, exist_ok = True)
+
+
+    def filename(self, key):
+        return os.path.join(self.folder, key_hash(key) + '.npy')
+
+
+    def _remember(self, key, arr):
+        self.memory[key] = arr
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxInMemory:
+            self.memory.popitem(last = False)
+        return arr
+
+
+    def get(self, key):
+        """ Returns cached array for key, or None if not in cache.
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.folder is not None:
+            filename = self.filename(key)
+            if os.path.exists(filename):
+                try:
+                    return self._remember(key, np.load(filename, mmap_mode = 'r'))
+                except (OSError, ValueError):
+                    return None
+        return None
+
+
+    def put(self, key, arr):
+        """ Stores arr under key and returns the cached (read-only) array.
+        """
+        if self.folder is None:
+            return self._remember(key, arr)
+        filename = self.filename(key)
+
+        # Write to a temporary file first so another process never sees a
+        # partly written array
+        tempFile = filename[:-4] + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(tempFile, arr)
+        try:
+            os.replace(tempFile, filename)
+        except OSError:
+            # On Windows the file cannot be replaced if another process has
+            # already created and mapped it, in which case we use that one
+            os.remove(tempFile)
+        return self._remember(key, np.load(filename, mmap_mode = 'r'))
+
+
+    def get_or_create(self, key, factory):
+        """ Returns cached array for key, calling factory() to create it if it
+        is not already cached.
+        """
+        arr = self.get(key)
+        if arr is None:
+            arr = self.put(key, factory())
+        return arr
+
+
+    def clear(self):
+        """ Removes all cached arrays from memory and disk.
+        """
+        self.memory.clear()
+        if self.folder is not None:
+            for file in os.listdir(self.folder):
+                if file.endswith('.npy'):
+                    try:
+                        os.remove(os.path.join(self.folder, file))
+                    except OSError:
+                        pass
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Backpressure Policy
+
+Decides whether the processor should process or skip a frame when frames are
+arriving faster than they can be processed. Skipping a frame costs almost
+nothing, and so processing catches up with acquisition rather than latency
+growing until the input queue overflows and frames are dropped arbitrarily.
+
+Decisions are made per batch, i.e. per call to the processor's process
+method. In SR mode a batch is a whole LED sequence, and so sequences are
+always kept or skipped together.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+# Policy modes
+OFF = 0
+LATEST_ONLY = 1
+DROP_OLDEST = 2
+KEEP_EVERY_NTH = 3
+
+MODE_NAMES = ['Off', 'Latest Only', 'Drop Oldest', 'Keep Every Nth']
+
+
+class BackpressurePolicy:
+    """ Backpressure policy for the processor input queue.
+
+    Keyword Arguments:
+        mode        : OFF, LATEST_ONLY, DROP_OLDEST or KEEP_EVERY_NTH
+        everyN      : int, for KEEP_EVERY_NTH, only one in every N batches
+                      is processed when saturated
+        maxBacklog  : int, number of complete batches waiting in the queue
+                      above which processing is considered saturated
+    """
+
+    smoothing = 0.1      # Weight of newest value in smoothed process time
+
+    def __init__(self, mode = OFF, everyN = 2, maxBacklog = 2):
+
+        self.mode = mode
+        self.everyN = max(int(everyN), 1)
+        self.maxBacklog = max(int(maxBacklog), 1)
+        self.reset()
+
+
+    def reset(self):
+        self.count = 0
+        self.processed = 0
+        self.skipped = 0
+        self.queueDepth = 0
+        self.queueDepthMax = 0
+        self.processTime = 0
+        self.saturated = False
+
+
+    def accept(self, queueDepth, batchSize = 1):
+        """ Returns True if the current batch should be processed, False if
+        it should be skipped.
+
+        Arguments:
+            queueDepth : int, number of frames waiting in the input queue
+                         (not including the current batch)
+
+        Keyword Arguments:
+            batchSize  : int, number of frames per batch, default is 1
+        """
+        self.queueDepth = queueDepth
+        self.queueDepthMax = max(self.queueDepthMax, queueDepth)
+
+        # Only count complete batches, a partial sequence is not yet usable
+        backlog = queueDepth // max(batchSize, 1)
+        self.saturated = backlog >= self.maxBacklog
+
+        if self.mode == LATEST_ONLY:
+            keep = backlog == 0
+        elif self.mode == DROP_OLDEST:
+            keep = not self.saturated
+        elif self.mode == KEEP_EVERY_NTH:
+            keep = not self.saturated or self.count % self.everyN == 0
+        else:
+            keep = True
+
+        self.count = self.count + 1
+        if keep:
+            self.processed = self.processed + 1
+        else:
+            self.skipped = self.skipped + 1
+        return keep
+
+
+    def record_process_time(self, processTime):
+        """ Updates the smoothed processing time with the time taken to
+        process the last batch, in seconds.
+        """
+        if self.processTime == 0:
+            self.processTime = processTime
+        else:
+            self.processTime = (1 - self.smoothing) * self.processTime + self.smoothing * processTime
+
+
+    def get_metrics(self, batchSize = 1):
+        """ Returns dictionary of queue and latency metrics. Latency is
+        estimated as the time for the frames currently in the queue to be
+        processed plus the processing time of one batch.
+        """
+        backlog = self.queueDepth / max(batchSize, 1)
+        return {'queueDepth': self.queueDepth,
+                'queueDepthMax': self.queueDepthMax,
+                'processTime': self.processTime,
+                'latency': (backlog + 1) * self.processTime,
+                'processed': self.processed,
+                'skipped': self.skipped,
+                'saturated': float(self.saturated)}
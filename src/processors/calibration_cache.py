@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Calibration Cache
+
+Core removal by triangular linear interpolation needs the bundle cores to
+be found and triangulated, and the interpolation weights of every output
+pixel to be calculated, which is slow for large bundles. The result only
+depends on the calibration image and on the processing settings, so
+calibrations are stored on disk, keyed by:
+
+    fingerprint of the calibration image
+    bundle centre and radius, if set by the user rather than found
+    grid size, core size, filter size, radius, white balance and auto mask
+    hash of background and normalisation images
+    (for SR) hash of the SR calibration images, shifts and dark frame, and
+        the SR settings
+
+so that at startup, or when switching modes, the calibration can be
+restored from the cache rather than being rebuilt.
+
+The PyBundle attributes used are calibImage, loc, autoLoc, the SETTINGS,
+IMAGES, SR_IMAGES and SR_SETTINGS below. Any that are missing are treated
+as None.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import pickle
+
+from processors.array_cache import key_hash, default_cache_folder
+from processors.stage_cache import state_key, fingerprint
+
+SETTINGS = ['coreMethod', 'gridSize', 'coreSize', 'filterSize', 'radius', 'whiteBalance', 'autoMask']
+IMAGES = ['background', 'normaliseImage']
+SR_IMAGES = ['srCalibImages', 'srBackgrounds', 'srNormalisationImgs', 'srShifts', 'srDarkFrame']
+SR_SETTINGS = ['srMultiBackgrounds', 'srMultiNormalisation', 'srNormToBackgrounds', 'srNormToImages']
+
+
+def user_geometry(pyb):
+    """ Returns bundle (centreX, centreY, radius) if it has been set by the
+    user (with set_loc), or None if it is found from the calibration image.
+    """
+    loc = getattr(pyb, 'loc', None)
+    if loc is None or getattr(pyb, 'autoLoc', True):
+        return None
+    return tuple(float(v) for v in loc[:3])
+
+
+def calibration_key(pyb, sr = False):
+    """ Returns key identifying the calibration of PyBundle instance pyb, or
+    None if there is no calibration image.
+    """
+    calibImage = getattr(pyb, 'calibImage', None)
+    if calibImage is None:
+        return None
+    key = (('calibImage', fingerprint(calibImage)), ('geometry', user_geometry(pyb))) \
+          + tuple((name, state_key(getattr(pyb, name, None))) for name in SETTINGS + IMAGES)
+    if sr:
+        key = key + (('sr',),) + tuple((name, state_key(getattr(pyb, name, None))) for name in SR_IMAGES + SR_SETTINGS)
+    return key
+
+
+class CalibrationCache:
+    """ Stores pickled calibrations in a folder.
+
+    Keyword Arguments:
+        folder : str, cache folder, default is in the temp folder
+    """
+
+    def __init__(self, folder = None):
+
+        self.folder = folder or default_cache_folder('calibrations')
+        os.makedirs(self.folder, exist_ok = True)
+
+
+    def filename(self, key):
+        return os.path.join(self.folder, key_hash(key) + '.pkl')
+
+
+    def get(self, key):
+        """ Returns cached calibration for key, or None.
+        """
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            return None
+
+
+    def put(self, key, calibration):
+        """ Stores calibration under key.
+        """
+        filename = self.filename(key)
+        tempFile = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(tempFile, 'wb') as f:
+            pickle.dump(calibration, f)
+        try:
+            os.replace(tempFile, filename)
+        except OSError:
+            os.remove(tempFile)
+
+
+    def calibrate(self, pyb):
+        """ Sets pyb.calibration from the cache if possible, otherwise calls
+        pyb.calibrate() and stores the result. Returns True if the cached
+        calibration was used.
+        """
+        key = calibration_key(pyb)
+        if key is not None:
+            calibration = self.get(key)
+            if calibration is not None:
+                pyb.calibration = calibration
+                return True
+        pyb.calibrate()
+        if key is not None and getattr(pyb, 'calibration', None) is not None:
+            self.put(key, pyb.calibration)
+        return False
+
+
+    def calibrate_sr(self, pyb):
+        """ Sets pyb.calibrationSR from the cache if possible, otherwise calls
+        pyb.calibrate_sr() and stores the result. Returns True if the cached
+        calibration was used.
+        """
+        key = calibration_key(pyb, sr = True)
+        if key is not None:
+            calibration = self.get(key)
+            if calibration is not None:
+                pyb.calibrationSR = calibration
+                return True
+        pyb.calibrate_sr()
+        if key is not None and getattr(pyb, 'calibrationSR', None) is not None:
+            self.put(key, pyb.calibrationSR)
+        return False
+
+
+    def store(self, pyb):
+        """ Stores the current calibrations of pyb, if any, e.g. after they
+        have been created elsewhere.
+        """
+        key = calibration_key(pyb)
+        if key is not None and getattr(pyb, 'calibration', None) is not None:
+            self.put(key, pyb.calibration)
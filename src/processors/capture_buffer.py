@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Capture Buffer
+
+Collects a series of equally sized stacks, such as the SR stacks captured at
+each depth for a shift calibration, within a memory budget. Stacks are
+copied into a preallocated (N, h, w, n) array, which grows by doubling,
+until the budget is exceeded, after which all stacks are moved to a raw file
+on disk, in the same layout, and later stacks are appended to it.
+
+as_array returns the stacks as a single 4D array of shape (h, w, n, N)
+(matching np.stack(stacks, axis = 3)). This is always a view, either of the
+in-memory array or of a memory-mapped file, so no copy of all the stacks is
+made. Once spilled to disk it is read from disk as it is used. Functions
+which use the whole array at once (such as PyBundle's shift calibration)
+will still read all of it into memory.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+
+class CaptureBuffer:
+    """ Memory-budgeted buffer of stacks which spills to disk.
+
+    Keyword Arguments:
+        memoryBudget : int, bytes which can be held in memory before
+                       spilling to disk, default 512 MB
+        folder       : str, folder for spill file, default is temp folder
+    """
+
+    def __init__(self, memoryBudget = 512 * 2**20, folder = None):
+
+        self.memoryBudget = memoryBudget
+        self.folder = folder or tempfile.gettempdir()
+        self.stacks = None           # Preallocated (capacity, h, w, n) array
+        self.spillFile = None
+        self.spillFilename = None
+        self.shape = None
+        self.dtype = None
+        self.count = 0
+
+
+    def __len__(self):
+        return self.count
+
+
+    def nbytes(self):
+        """ Size of all stacks in bytes.
+        """
+        if self.shape is None:
+            return 0
+        return self.count * int(np.prod(self.shape)) * self.dtype.itemsize
+
+
+    def is_spilled(self):
+        return self.spillFilename is not None
+
+
+    def append(self, stack):
+        """ Adds a stack. All stacks must have the same shape and dtype.
+        """
+        stack = np.asarray(stack)
+        if self.shape is None:
+            self.shape = np.shape(stack)
+            self.dtype = stack.dtype
+        elif np.shape(stack) != self.shape:
+            raise ValueError(f"Stack of shape {np.shape(stack)} does not match buffer of shape {self.shape}.")
+        stack = stack.astype(self.dtype, copy = False)
+        self.count = self.count + 1
+
+        if self.is_spilled():
+            self._write(stack)
+        elif self.nbytes() > self.memoryBudget:
+            self._spill()
+            self._write(stack)
+        else:
+            if self.stacks is None or len(self.stacks) < self.count:
+                self._grow()
+            self.stacks[self.count - 1] = stack
+
+
+    def _grow(self):
+        """ Doubles the capacity of the in-memory array, up to the number of
+        stacks which fit in the memory budget.
+        """
+        stackBytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        maxStacks = max(self.memoryBudget // stackBytes, self.count)
+        capacity = self.count if self.stacks is None else 2 * len(self.stacks)
+        capacity = int(min(max(capacity, self.count), maxStacks))
+        grown = np.empty((capacity,) + tuple(self.shape), dtype = self.dtype)
+        if self.stacks is not None:
+            grown[:len(self.stacks)] = self.stacks
+        self.stacks = grown
+
+
+    def _spill(self):
+        """ Moves stacks held in memory to the spill file.
+        """
+        handle, self.spillFilename = tempfile.mkstemp(prefix = 'holobundle_capture_', suffix = '.raw', dir = self.folder)
+        self.spillFile = os.fdopen(handle, 'wb')
+        if self.stacks is not None:
+            self._write(self.stacks[:self.count - 1])
+        self.stacks = None
+
+
+    def _write(self, stack):
+        self.spillFile.write(np.ascontiguousarray(stack).tobytes())
+
+
+    def as_array(self):
+        """ Returns all stacks as an array of shape (h, w, n, N). If spilled,
+        this is a view of a memory-mapped file. Returns None if empty.
+        """
+        if self.count == 0:
+            return None
+        if not self.is_spilled():
+            return np.moveaxis(self.stacks[:self.count], 0, len(self.shape))
+        self.spillFile.flush()
+        stacks = np.memmap(self.spillFilename, dtype = self.dtype, mode = 'r', shape = (self.count,) + tuple(self.shape))
+        return np.moveaxis(stacks, 0, len(self.shape))
+
+
+    def clear(self):
+        """ Removes all stacks and deletes the spill file.
+        """
+        self.stacks = None
+        self.count = 0
+        self.shape = None
+        self.dtype = None
+        if self.spillFile is not None:
+            self.spillFile.close()
+            self.spillFile = None
+        if self.spillFilename is not None:
+            try:
+                os.remove(self.spillFilename)
+            except OSError:
+                pass    # Still mapped, e.g. on Windows, left for temp folder clean up
+            self.spillFilename = None
+
+
+    def close(self):
+        self.clear()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Checkpoints
+
+Periodic checkpoints of the state needed to resume a long acquisition after
+a crash or restart: settings, backgrounds, calibrations and where the raw
+archive is being written.
+
+A checkpoint is a folder containing:
+    checkpoint.json : small state (settings, GUI values, time) and the file
+                      holding each large object
+    <name>_<hash>.npy / .pkl : one file per large object (arrays, and
+                      calibrations and other objects as pickles)
+
+Large objects are named by a hash of their contents, so on each checkpoint
+only objects which have changed since the last one are written; typically
+only checkpoint.json is rewritten. checkpoint.json is written to a temporary
+file and then renamed, so a crash during a checkpoint leaves the previous
+checkpoint intact. Files no longer referenced are then deleted. Arrays are
+loaded memory-mapped.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import json
+import logging
+import time
+import pickle
+
+import numpy as np
+
+from processors.array_cache import key_hash, default_cache_folder
+from processors.stage_cache import state_key
+
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+def _write_atomic(filename, write):
+    tempFile = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tempFile, 'wb') as f:
+        write(f)
+    os.replace(tempFile, filename)
+
+
+class Checkpoint:
+    """ Checkpoint folder.
+
+    Keyword Arguments:
+        folder : str, default is 'checkpoint' in the cache folder
+    """
+
+    def __init__(self, folder = None):
+
+        self.folder = folder or default_cache_folder('checkpoint')
+        self.lastSave = None
+
+
+    def filename(self):
+        return os.path.join(self.folder, CHECKPOINT_FILE)
+
+
+    def exists(self):
+        return os.path.exists(self.filename())
+
+
+    def _object_file(self, name, obj):
+        """ Returns file name for obj, based on its contents, writing the
+        file if it does not already exist.
+        """
+        ext = '.npy' if isinstance(obj, np.ndarray) else '.pkl'
+        file = name + '_' + key_hash(state_key(obj, depth = 3)) + ext
+        path = os.path.join(self.folder, file)
+        if not os.path.exists(path):
+            if ext == '.npy':
+                _write_atomic(path, lambda f: np.save(f, obj))
+            else:
+                _write_atomic(path, lambda f: pickle.dump(obj, f))
+        return file
+
+
+    def save(self, state, objects = None):
+        """ Writes a checkpoint.
+
+        Arguments:
+            state   : dict, must be serialisable to JSON
+
+        Keyword Arguments:
+            objects : dict of name: large object (numpy array or picklable
+                      object). Objects which are None are not stored.
+        """
+        os.makedirs(self.folder, exist_ok = True)
+        files = {name: self._object_file(name, obj) for name, obj in (objects or {}).items() if obj is not None}
+        checkpoint = {'version': 1, 'time': time.time(), 'state': state, 'objects': files}
+        _write_atomic(self.filename(), lambda f: f.write(json.dumps(checkpoint, indent = 1).encode('utf-8')))
+        self.lastSave = checkpoint['time']
+
+        # Remove objects from earlier checkpoints which have since changed
+        keep = set(files.values()) | {CHECKPOINT_FILE}
+        for file in os.listdir(self.folder):
+            if file not in keep and not file.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(self.folder, file))
+                except OSError:
+                    pass
+
+
+    def load(self):
+        """ Returns (time, state, objects) from the checkpoint, or None if
+        there is no checkpoint. Objects which cannot be read are left out.
+        """
+        if not self.exists():
+            return None
+        with open(self.filename(), 'r', encoding = 'utf-8') as f:
+            checkpoint = json.load(f)
+        objects = {}
+        for name, file in checkpoint['objects'].items():
+            path = os.path.join(self.folder, file)
+            try:
+                if file.endswith('.npy'):
+                    objects[name] = np.load(path, mmap_mode = 'r')
+                else:
+                    with open(path, 'rb') as f:
+                        objects[name] = pickle.load(f)
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError) as e:
+                logging.warning("Cannot restore %s from checkpoint: %s", name, e)
+        return checkpoint['time'], checkpoint['state'], objects
+
+
+    def clear(self):
+        """ Deletes the checkpoint.
+        """
+        if not os.path.exists(self.folder):
+            return
+        for file in os.listdir(self.folder):
+            try:
+                os.remove(os.path.join(self.folder, file))
+            except OSError:
+                pass
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Chunked Array Store
+
+A simple chunked, compressed array format for 4D (time x depth x y x x)
+depth stacks and time-lapses. It is similar in layout to a Zarr folder, but
+is not Zarr and cannot be read by Zarr readers, so stores are saved with 
+the extension EXTENSION ('.hbchunk'):
+
+    folder/meta.json     : shape, chunk shape, dtype and compression level
+    folder/t.z.y.x       : one zlib compressed file per chunk
+
+Chunks are compressed and written by a pool of threads. zlib releases the GIL
+while compressing, so writing scales with the number of cores. Reading is
+lazy: only the chunks overlapping the requested region are read and
+decompressed, so a single depth or a small region can be loaded from a large
+stack quickly.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import json
+import zlib
+import itertools
+import concurrent.futures
+
+import numpy as np
+
+META_FILE = 'meta.json'
+EXTENSION = '.hbchunk'
+
+
+def _normalise_index(index, shape):
+    """ Converts an index (int, slice or tuple of these) to a tuple of
+    (start, stop) for each dimension and a list of dimensions which were
+    indexed with an integer and so should be removed from the output.
+    """
+    if not isinstance(index, tuple):
+        index = (index,)
+    ranges = []
+    drop = []
+    for dim, size in enumerate(shape):
+        idx = index[dim] if dim < len(index) else slice(None)
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(size)
+            if step != 1:
+                raise ValueError("ChunkedStore only supports slices with a step of 1.")
+            ranges.append((start, max(stop, start)))
+        else:
+            idx = int(idx)
+            if idx < 0:
+                idx = idx + size
+            if idx < 0 or idx >= size:
+                raise IndexError(f"Index {idx} out of range for dimension {dim} of size {size}.")
+            ranges.append((idx, idx + 1))
+            drop.append(dim)
+    return ranges, drop
+
+
+class ChunkedStore:
+    """ Chunked, compressed 4D array stored in a folder.
+
+    Use ChunkedStore.create to make a new store, or ChunkedStore(folder) to
+    open an existing one.
+
+    Arguments:
+        folder     : str, path to store folder
+
+    Keyword Arguments:
+        numThreads : int, number of threads used to compress and write or
+                     read and decompress chunks, default is number of cores
+    """
+
+    def __init__(self, folder, numThreads = None):
+
+        self.folder = folder
+        self.numThreads = numThreads or os.cpu_count()
+        with open(os.path.join(folder, META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.level = meta['level']
+        self.depths = meta.get('depths')
+
+
+    @classmethod
+    def create(cls, folder, shape, dtype, chunks = None, level = 1, depths = None, numThreads = None):
+        """ Creates a new store.
+
+        Arguments:
+            folder   : str, path to store folder, created if does not exist
+            shape    : tuple of (t, z, y, x)
+            dtype    : numpy dtype
+
+        Keyword Arguments:
+            chunks   : tuple of chunk size in each dimension. Default is
+                       one time point, one depth and 256 x 256 pixels.
+            level    : int, zlib compression level, 0 to 9, default 1
+            depths   : list of depths of each plane, stored in meta data
+        """
+        if len(shape) != 4:
+            raise ValueError("ChunkedStore shape must be (t, z, y, x).")
+        if chunks is None:
+            chunks = (1, 1, min(256, shape[2]), min(256, shape[3]))
+        os.makedirs(folder, exist_ok = True)
+        meta = {'shape': [int(x) for x in shape],
+                'chunks': [int(x) for x in chunks],
+                'dtype': np.dtype(dtype).str,
+                'compression': 'zlib',
+                'level': int(level),
+                'depths': None if depths is None else [float(d) for d in depths]}
+        with open(os.path.join(folder, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        return cls(folder, numThreads = numThreads)
+
+
+    def _write_meta(self):
+        meta = {'shape': list(self.shape),
+                'chunks': list(self.chunks),
+                'dtype': self.dtype.str,
+                'compression': 'zlib',
+                'level': self.level,
+                'depths': self.depths}
+        with open(os.path.join(self.folder, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+    def _chunk_file(self, chunkIdx):
+        return os.path.join(self.folder, '.'.join(str(c) for c in chunkIdx))
+
+
+    def _chunk_ranges(self, ranges):
+        """ Returns index of each chunk overlapping ranges.
+        """
+        perDim = [range(start // c, (stop - 1) // c + 1) if stop > start else range(0)
+                  for (start, stop), c in zip(ranges, self.chunks)]
+        return itertools.product(*perDim)
+
+
+    def _chunk_bounds(self, chunkIdx, shape = None):
+        shape = self.shape if shape is None else shape
+        return [(i * c, min((i + 1) * c, s)) for i, c, s in zip(chunkIdx, self.chunks, shape)]
+
+
+    def _read_chunk(self, chunkIdx, storedShape = None):
+        """ Reads a chunk. Edge chunks are stored clipped to the store shape
+        at the time they were written, so if the store has since grown,
+        storedShape gives that shape and the chunk is padded with zeros to
+        its current size.
+        """
+        bounds = self._chunk_bounds(chunkIdx)
+        chunkShape = tuple(b - a for a, b in bounds)
+        filename = self._chunk_file(chunkIdx)
+        if not os.path.exists(filename):
+            return np.zeros(chunkShape, dtype = self.dtype)
+        storedBounds = self._chunk_bounds(chunkIdx, storedShape)
+        storedChunkShape = tuple(max(b - a, 0) for a, b in storedBounds)
+        with open(filename, 'rb') as f:
+            data = zlib.decompress(f.read())
+        data = np.frombuffer(data, dtype = self.dtype).reshape(storedChunkShape)
+        if storedChunkShape == chunkShape:
+            return data
+        chunk = np.zeros(chunkShape, dtype = self.dtype)
+        chunk[tuple(slice(0, s) for s in storedChunkShape)] = data
+        return chunk
+
+
+    def _write_chunk(self, chunkIdx, data):
+        with open(self._chunk_file(chunkIdx), 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(data, dtype = self.dtype), self.level))
+
+
+    def write(self, data, offset = (0, 0, 0, 0), storedShape = None):
+        """ Writes 4D array data into the store starting at offset. Chunks which
+        are only partly covered by data are read and merged first. If the
+        store has grown since those chunks were written, storedShape is the
+        shape it had then.
+        """
+        data = np.asarray(data)
+        ranges = [(o, o + s) for o, s in zip(offset, np.shape(data))]
+        for (start, stop), size in zip(ranges, self.shape):
+            if stop > size:
+                raise ValueError(f"Data of shape {np.shape(data)} at offset {offset} does not fit in store of shape {self.shape}.")
+
+        def write_one(chunkIdx):
+            bounds = self._chunk_bounds(chunkIdx)
+            inner = [(max(a, r0), min(b, r1)) for (a, b), (r0, r1) in zip(bounds, ranges)]
+            src = tuple(slice(i0 - r0, i1 - r0) for (i0, i1), (r0, r1) in zip(inner, ranges))
+            if inner == bounds:
+                chunk = data[src]
+            else:
+                chunk = self._read_chunk(chunkIdx, storedShape).copy()
+                dst = tuple(slice(i0 - a, i1 - a) for (i0, i1), (a, b) in zip(inner, bounds))
+                chunk[dst] = data[src]
+            self._write_chunk(chunkIdx, chunk)
+
+        with concurrent.futures.ThreadPoolExecutor(self.numThreads) as pool:
+            list(pool.map(write_one, self._chunk_ranges(ranges)))
+
+
+    def append(self, volume):
+        """ Appends a 3D (z, y, x) volume as a new time point.
+        """
+        volume = np.asarray(volume)
+        if tuple(np.shape(volume)) != self.shape[1:]:
+            raise ValueError(f"Volume of shape {np.shape(volume)} does not match store of shape {self.shape}.")
+        storedShape = self.shape
+        t = self.shape[0]
+        self.shape = (t + 1,) + self.shape[1:]
+        self.write(volume[None], offset = (t, 0, 0, 0), storedShape = storedShape)
+        self._write_meta()
+
+
+    def __getitem__(self, index):
+        """ Reads a region, e.g. store[0, 5] for one depth or
+        store[:, :, 100:200, 100:200] for a sub-region at all times and depths.
+        Only the chunks needed are read.
+        """
+        ranges, drop = _normalise_index(index, self.shape)
+        out = np.zeros([b - a for a, b in ranges], dtype = self.dtype)
+
+        def read_one(chunkIdx):
+            bounds = self._chunk_bounds(chunkIdx)
+            inner = [(max(a, r0), min(b, r1)) for (a, b), (r0, r1) in zip(bounds, ranges)]
+            src = tuple(slice(i0 - a, i1 - a) for (i0, i1), (a, b) in zip(inner, bounds))
+            dst = tuple(slice(i0 - r0, i1 - r0) for (i0, i1), (r0, r1) in zip(inner, ranges))
+            out[dst] = self._read_chunk(chunkIdx)[src]
+
+        with concurrent.futures.ThreadPoolExecutor(self.numThreads) as pool:
+            list(pool.map(read_one, self._chunk_ranges(ranges)))
+        if drop:
+            out = out.reshape([s for dim, s in enumerate(out.shape) if dim not in drop])
+        return out
+
+
+    def get_depth(self, depthIdx, timeIdx = 0):
+        """ Returns a single 2D plane.
+        """
+        return self[timeIdx, depthIdx]
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Display Stage
+
+Prepares processed images for display on the processor side, so that the GUI
+thread only has to draw a small 8 bit image. Images are downsampled to the
+size of the display widget and mapped to 8 bit using a contrast mapping (or,
+for integer images, a precomputed look-up table). The stage also reports
+whether the 8 bit image has changed since the last frame so that unchanged
+frames need not be redrawn.
+
+The display image is kept separate from the processed frame, which is
+still output at full resolution for recording and snapshots. It is passed
+to the GUI, which may be in a different process, through a DisplayChannel,
+a memory-mapped file in the same way as the metrics channel, and is only
+written when it has changed.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import math
+import tempfile
+
+import numpy as np
+import cv2 as cv
+
+_MAGIC = 0x484f4c4f44495350      # 'HOLODISP'
+_HEADER_INTS = 8                  # magic, h, w, writeCount, frameNumber, spare
+
+
+def default_display_file():
+    """ Returns a filename in the temp folder unique to this process.
+    """
+    return os.path.join(tempfile.gettempdir(), f"holobundle_display_{os.getpid()}.dat")
+
+
+class DisplayStage:
+    """ Downsamples and maps images to uint8 for display.
+
+    Keyword Arguments:
+        width        : int, width of display in pixels, default None (no
+                       downsampling)
+        height       : int, height of display in pixels, default None
+        autoContrast : boolean, if True (default) contrast is set from the
+                       image range, smoothed over frames to avoid flicker,
+                       otherwise the limits set by set_contrast are used
+    """
+
+    smoothing = 0.2          # Weight of newest frame in auto contrast limits
+
+    def __init__(self, width = None, height = None, autoContrast = True):
+
+        self.width = width
+        self.height = height
+        self.autoContrast = autoContrast
+        self.low = None
+        self.high = None
+        self.lut = None
+        self.lutKey = None
+        self.lastDisplay = None
+        self.changed = True
+
+
+    def set_size(self, width, height):
+        """ Sets the size of the display widget, in pixels.
+        """
+        self.width = width
+        self.height = height
+
+
+    def set_contrast(self, low, high):
+        """ Sets fixed display limits and turns off auto contrast.
+        """
+        self.low = low
+        self.high = high
+        self.autoContrast = False
+
+
+    def downsample(self, img):
+        """ Downsamples image by the largest integer factor which keeps it at
+        least as large as the display, using area averaging.
+        """
+        if self.width is None or self.height is None or self.width < 1 or self.height < 1:
+            return img
+        h, w = np.shape(img)[:2]
+        factor = max(min(h // self.height, w // self.width), 1)
+        if factor == 1:
+            return img
+        if img.dtype not in (np.uint8, np.uint16, np.float32):
+            img = img.astype('float32')
+        return cv.resize(img, (w // factor, h // factor), interpolation = cv.INTER_AREA)
+
+
+    def update_limits(self, img):
+        low = float(np.min(img))
+        high = float(np.max(img))
+        if self.low is None or self.high is None:
+            self.low, self.high = low, high
+        else:
+            self.low = (1 - self.smoothing) * self.low + self.smoothing * low
+            self.high = (1 - self.smoothing) * self.high + self.smoothing * high
+
+
+    def quantised_limits(self):
+        """ Returns (low, high, step), the contrast limits rounded outwards to
+        a multiple of step, a power of two of about 1/256 of the range, i.e.
+        less than one grey level.
+        """
+        step = 2 ** max(math.floor(math.log2(max(self.high - self.low, 1) / 256)), 0)
+        return math.floor(self.low / step) * step, math.ceil(self.high / step) * step, step
+
+
+    def get_lut(self, dtype):
+        """ Returns look-up table mapping every value of an integer dtype
+        to uint8 for the current contrast limits. Smoothed auto contrast
+        limits drift slightly on every frame, so the table is only rebuilt
+        when the limits move by more than one quantisation step from those 
+        it was built for, which changes the mapping by about a grey level.
+        """
+        if self.lutKey is not None and self.lutKey[0] == np.dtype(dtype):
+            _, lutLow, lutHigh, lutStep = self.lutKey
+            if abs(self.low - lutLow) <= lutStep and abs(self.high - lutHigh) <= lutStep:
+                return self.lut
+        low, high, step = self.quantised_limits()
+        values = np.arange(np.iinfo(dtype).max + 1, dtype = 'float32')
+        scale = 255 / max(high - low, 1)
+        self.lut = np.clip((values - low) * scale, 0, 255).astype('uint8')
+        self.lutKey = (np.dtype(dtype), low, high, step)
+        return self.lut
+
+
+    def to_uint8(self, img):
+        """ Maps image to uint8 using the current contrast limits.
+        """
+        if self.autoContrast:
+            self.update_limits(img)
+        if self.low is None or self.high is None:
+            self.update_limits(img)
+        if img.dtype in (np.uint8, np.uint16):
+            return self.get_lut(img.dtype)[img]
+        scale = 255 / max(self.high - self.low, 1e-12)
+        out = np.subtract(img, self.low, dtype = 'float32')
+        out *= scale
+        np.clip(out, 0, 255, out = out)
+        return out.astype('uint8')
+
+
+    def process(self, img):
+        """ Returns uint8 display image for img. After calling, the changed
+        attribute is False if the display image is identical to the last one.
+        """
+        if img is None:
+            return None
+        if np.iscomplexobj(img):
+            img = np.abs(img)
+        display = self.to_uint8(self.downsample(img))
+        self.changed = self.lastDisplay is None or not np.array_equal(display, self.lastDisplay)
+        self.lastDisplay = display
+        return display
+
+
+
+class DisplayChannel:
+    """ Latest display image in a memory-mapped file. The processor creates
+    the channel with create = True and writes to it, the GUI opens it and
+    reads from it.
+
+    Arguments:
+        filename  : str, path to file
+
+    Keyword Arguments:
+        create    : boolean, if True the file is created (or reset) for
+                    writing, otherwise an existing file is opened for
+                    reading. Default is False.
+    """
+
+    def __init__(self, filename, create = False):
+
+        self.filename = filename
+        self.writer = create
+        self.fileId = None
+        self.header = None
+        self.image = None
+        self.lastRead = None
+        if create:
+            self._create((0, 0))
+        else:
+            self._open()
+
+
+    def _create(self, shape):
+        """ Writes a new file for images of shape (h, w) and renames it over
+        the old one, so a reader with the old file mapped is unaffected.
+        """
+        h, w = shape
+        tempFile = self.filename + '.' + str(os.getpid()) + '.tmp'
+        with open(tempFile, 'wb') as f:
+            f.truncate(_HEADER_INTS * 8 + max(h * w, 1))
+        header = np.memmap(tempFile, dtype = '<i8', mode = 'r+', shape = (_HEADER_INTS,))
+        header[:3] = (_MAGIC, h, w)
+        header.flush()
+        del header
+        os.replace(tempFile, self.filename)
+        self._map('r+')
+
+
+    def _open(self):
+        try:
+            self._map('r')
+        except (OSError, ValueError):
+            self.header = None
+            self.image = None
+
+
+    def _map(self, mode):
+        self.fileId = os.stat(self.filename).st_ino
+        self.header = np.memmap(self.filename, dtype = '<i8', mode = mode, shape = (_HEADER_INTS,))
+        if self.header[0] != _MAGIC:
+            raise ValueError(f"{self.filename} is not a display channel file.")
+        h, w = int(self.header[1]), int(self.header[2])
+        self.image = np.memmap(self.filename, dtype = 'uint8', mode = mode, offset = _HEADER_INTS * 8, shape = (max(h * w, 1),))[:h * w].reshape(h, w)
+
+
+    def write(self, img, frameNumber = 0):
+        """ Writes uint8 display image img. The write count is odd while the
+        image is being written, so a reader can detect a partial image.
+        """
+        if np.shape(img) != np.shape(self.image):
+            self._create(np.shape(img))
+        count = int(self.header[3])
+        self.header[3] = count + 1
+        self.image[:] = img
+        self.header[4] = frameNumber
+        self.header[3] = count + 2
+
+
+    def read(self):
+        """ Returns (frameNumber, copy of image) if a new image has been
+        written since the last read, otherwise None.
+        """
+        if self.header is None or not self.is_current():
+            self._open()
+            self.lastRead = None
+            if self.header is None:
+                return None
+        count = int(self.header[3])
+        if count == 0 or count % 2 == 1 or count == self.lastRead:
+            return None
+        img = np.array(self.image)
+        frameNumber = int(self.header[4])
+        if int(self.header[3]) != count:
+            return None     # Overwritten while being read
+        self.lastRead = count
+        return frameNumber, img
+
+
+    def is_current(self):
+        """ Returns False if the file has been replaced since it was opened.
+        """
+        try:
+            return os.stat(self.filename).st_ino == self.fileId
+        except OSError:
+            return False
+
+
+    def close(self, remove = False):
+        """ Closes the channel, deleting the file if remove is True.
+        """
+        self.header = None
+        self.image = None
+        if remove:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
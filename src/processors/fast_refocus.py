@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Fast Refocusing
+
+Angular spectrum refocusing split into separate steps (hologram FFT,
+propagator, inverse FFT) so that intermediate results can be cached and
+reused, for example so that a depth change only needs one multiply and one
+inverse FFT, or so that many depths can be generated from one hologram FFT.
+
+Refocused fields, including their phase, match pyholoscope inline 
+refocusing. Propagators are stored without an fftshift so that no shifts
+are needed at each step.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import math
+
+import numpy as np
+import scipy.fft
+
+# Number of threads used for FFTs, -1 for all cores
+FFT_WORKERS = -1
+
+
+def propagator(shape, wavelength, pixelSize, depth, precision = 'single'):
+    """ Returns angular spectrum propagator for an unshifted FFT.
+
+    Arguments:
+        shape      : tuple of (height, width)
+        wavelength : float, wavelength in m
+        pixelSize  : float, pixel size in m
+        depth      : float, refocus depth in m
+
+    Keyword Arguments:
+        precision  : 'single' (default) or 'double'
+    """
+    dtype = 'complex64' if precision == 'single' else 'complex128'
+    fy = np.fft.fftfreq(shape[0], d = pixelSize)
+    fx = np.fft.fftfreq(shape[1], d = pixelSize)
+    arg = 1 / wavelength**2 - fx[None,:]**2 - fy[:,None]**2
+    valid = arg > 0
+    prop = np.exp(-2j * math.pi * depth * np.sqrt(np.where(valid, arg, 0)))
+    prop[~valid] = 0
+    return prop.astype(dtype)
+
+
+def circular_window(shape, radius = None, thickness = 0, dtype = 'float32'):
+    """ Returns circular window with a cosine taper at the edge.
+
+    Arguments:
+        shape      : tuple of (height, width)
+
+    Keyword Arguments:
+        radius     : float, radius of window in pixels. Default (None) is
+                     to use the largest circle which fits in the image.
+        thickness  : float, thickness of cosine taper at edge, in pixels
+    """
+    h, w = shape[:2]
+    if radius is None:
+        radius = min(h, w) / 2
+    y = np.arange(h, dtype = 'float32') - h / 2
+    x = np.arange(w, dtype = 'float32') - w / 2
+    r = np.sqrt(x[None,:]**2 + y[:,None]**2)
+    if thickness > 0:
+        edge = np.clip((r - (radius - thickness)) / thickness, 0, 1)
+        window = 0.5 + 0.5 * np.cos(edge * math.pi)
+    else:
+        window = (r < radius).astype(dtype)
+    return window.astype(dtype)
+
+
+def hologram_fft(img, window = None, background = None, buffer = None):
+    """ Returns FFT of hologram as complex64, after subtracting background and
+    applying window, if provided. The conversion to complex and the window 
+    multiply are done in a single pass over the image.
+
+    Keyword Arguments:
+        window     : numpy array, window to multiply hologram by
+        background : numpy array, background to subtract from hologram
+        buffer     : complex64 array of same shape as img, used as working
+                     memory if provided
+    """
+    if buffer is None or np.shape(buffer) != np.shape(img):
+        buffer = np.empty(np.shape(img), dtype = 'complex64')
+    if background is not None:
+        np.subtract(img, background, out = buffer)
+        if window is not None:
+            buffer *= window
+    elif window is not None:
+        np.multiply(img, window, out = buffer)
+    else:
+        buffer[...] = img
+    return scipy.fft.fft2(buffer, workers = FFT_WORKERS)
+
+
+def propagate(imgFFT, prop, out = None):
+    """ Returns refocused field from hologram FFT and propagator.
+
+    Keyword Arguments:
+        out     : complex64 array of same shape as imgFFT, used as working
+                  memory if provided
+    """
+    if out is None:
+        out = np.multiply(imgFFT, prop)
+    else:
+        np.multiply(imgFFT, prop, out = out)
+    return scipy.fft.ifft2(out, workers = FFT_WORKERS, overwrite_x = True)
+
+
+def refocus(img, wavelength, pixelSize, depth, window = None, background = None):
+    """ Refocuses hologram img to depth. Convenience function which does not
+    cache anything.
+    """
+    prop = propagator(np.shape(img), wavelength, pixelSize, depth)
+    return propagate(hologram_fft(img, window, background), prop)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Focus Cache
+
+Refocused planes and focus metric values for one hologram, so that
+autofocus, depth stack export and particle location on the same frame share
+work rather than each refocusing it again:
+
+    planes      : amplitude at each depth, kept up to a memory budget, least
+                  recently used first out
+    curves      : focus metric value at each depth, for each ROI and metric
+
+The cache is cleared when a different hologram (or wavelength, pixel size,
+window or background) is selected.
+
+auto_focus does a coarse search over a grid of depths followed by a
+golden-section search around the best depth. For the coarse search, a
+depth already evaluated within a quarter of the grid spacing is used in
+place of the grid depth, so a repeat autofocus over a narrower or shifted
+range reuses earlier evaluations.
+
+write_stack_tif saves a stack of planes, e.g. from FocusCache.stack, as a
+16 bit tif stack.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import math
+import collections
+
+import numpy as np
+from PIL import Image
+
+from processors import fast_refocus
+
+METRICS = ['Brenner', 'Variance', 'Peak']
+
+_GOLDEN = (math.sqrt(5) - 1) / 2
+
+
+def focus_metric(amplitude, metric = 'Brenner'):
+    """ Returns focus metric of a refocused amplitude image, larger when
+    better focused.
+
+    Arguments:
+        amplitude : 2D numpy array
+
+    Keyword Arguments:
+        metric    : 'Brenner' (default), the mean squared difference between
+                    pixels two apart, 'Variance', or 'Peak', the maximum 
+                    amplitude (as PyHoloscope's 'Peak' method)
+    """
+    amplitude = np.asarray(amplitude, dtype = 'float32')
+    if metric == 'Brenner':
+        dx = amplitude[:, 2:] - amplitude[:, :-2]
+        dy = amplitude[2:, :] - amplitude[:-2, :]
+        return float(np.mean(dx * dx) + np.mean(dy * dy))
+    if metric == 'Variance':
+        return float(np.var(amplitude))
+    if metric == 'Peak':
+        return float(np.max(amplitude))
+    raise ValueError(f"Unknown focus metric {metric}.")
+
+
+def roi_bounds(roi, shape):
+    """ Returns (y0, y1, x0, x1) for roi, which can be None (whole image), a
+    tuple of (x, y, width, height) or an object with x, y, width and height
+    attributes, such as a pyholoscope Roi.
+    """
+    if roi is None:
+        return (0, shape[0], 0, shape[1])
+    if not isinstance(roi, (tuple, list)):
+        roi = (roi.x, roi.y, roi.width, roi.height)
+    x, y, w, h = (int(v) for v in roi)
+    return (max(y, 0), min(y + h, shape[0]), max(x, 0), min(x + w, shape[1]))
+
+
+def write_stack_tif(filename, stack, autoContrast = True):
+    """ Writes a stack of amplitude planes of shape (nDepths, h, w) to a 16 bit
+    tif stack, as PyHoloscope's FocusStack.write_intensity_to_tif. If 
+    autoContrast is True (default) the stack is scaled, as a whole, to use 
+    the full bit depth.
+    """
+    stack = np.abs(np.asarray(stack, dtype = 'float32'))
+    if autoContrast:
+        minVal, maxVal = float(np.min(stack)), float(np.max(stack))
+        scale = (2**16 - 1) / (maxVal - minVal) if maxVal > minVal else 0
+        planes = [((plane - minVal) * scale).astype('uint16') for plane in stack]
+    else:
+        planes = [np.clip(255 * plane, 0, 2**16 - 1).astype('uint16') for plane in stack]
+    images = [Image.fromarray(plane) for plane in planes]
+    images[0].save(filename, compression = 'tiff_deflate', save_all = True, append_images = images[1:])
+
+
+class FocusCache:
+    """ Planes and focus curves for one hologram.
+
+    Keyword Arguments:
+        maxBytes       : int, memory budget for planes, default 256 MB
+        maxPropagators : int, number of propagators kept, default 32
+    """
+
+    def __init__(self, maxBytes = 256 * 2**20, maxPropagators = 32):
+
+        self.maxBytes = maxBytes
+        self.maxPropagators = maxPropagators
+        self.key = None
+        self.imgFFT = None
+        self.wavelength = None
+        self.pixelSize = None
+        self.planes = collections.OrderedDict()
+        self.curves = {}
+        self.propagators = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def select(self, key, imgFFT, wavelength, pixelSize):
+        """ Selects hologram with FFT imgFFT, identified by key. If key,
+        wavelength or pixel size differ from the last hologram, cached planes
+        and curves are cleared.
+        """
+        key = (key, float(wavelength), float(pixelSize))
+        if key != self.key:
+            self.key = key
+            self.planes.clear()
+            self.curves = {}
+        self.imgFFT = imgFFT
+        self.wavelength = float(wavelength)
+        self.pixelSize = float(pixelSize)
+
+
+    def _propagator(self, depth):
+        key = (np.shape(self.imgFFT), self.wavelength, self.pixelSize, depth)
+        if key in self.propagators:
+            self.propagators.move_to_end(key)
+        else:
+            self.propagators[key] = fast_refocus.propagator(np.shape(self.imgFFT), self.wavelength, self.pixelSize, depth)
+            while len(self.propagators) > self.maxPropagators:
+                self.propagators.popitem(last = False)
+        return self.propagators[key]
+
+
+    def plane(self, depth):
+        """ Returns refocused amplitude at depth as float32. The returned
+        array is held by the cache and should not be modified.
+        """
+        depth = float(depth)
+        if depth in self.planes:
+            self.hits = self.hits + 1
+            self.planes.move_to_end(depth)
+            return self.planes[depth]
+        self.misses = self.misses + 1
+        amplitude = np.abs(fast_refocus.propagate(self.imgFFT, self._propagator(depth)))
+        self.add_plane(depth, amplitude)
+        return amplitude
+
+
+    def add_plane(self, depth, amplitude):
+        """ Stores an amplitude plane calculated elsewhere.
+        """
+        self.planes[float(depth)] = amplitude
+        total = sum(p.nbytes for p in self.planes.values())
+        while total > self.maxBytes and len(self.planes) > 1:
+            total = total - self.planes.popitem(last = False)[1].nbytes
+
+
+    def stack(self, depths):
+        """ Returns float32 array of amplitudes of shape (len(depths), h, w).
+        """
+        stack = np.zeros((len(depths),) + np.shape(self.imgFFT), dtype = 'float32')
+        for idx, depth in enumerate(depths):
+            stack[idx] = self.plane(depth)
+        return stack
+
+
+    def metric(self, depth, roi = None, metric = 'Brenner'):
+        """ Returns focus metric within roi at depth.
+        """
+        bounds = roi_bounds(roi, np.shape(self.imgFFT))
+        curve = self.curves.setdefault((bounds, metric), {})
+        depth = float(depth)
+        if depth not in curve:
+            y0, y1, x0, x1 = bounds
+            curve[depth] = focus_metric(self.plane(depth)[y0:y1, x0:x1], metric)
+        return curve[depth]
+
+
+    def nearest_evaluated(self, depth, tolerance, roi = None, metric = 'Brenner'):
+        """ Returns the depth closest to depth, within tolerance, at which the
+        metric has already been evaluated, or depth if there is none.
+        """
+        curve = self.curves.get((roi_bounds(roi, np.shape(self.imgFFT)), metric), {})
+        if len(curve) == 0:
+            return depth
+        nearest = min(curve, key = lambda d: abs(d - depth))
+        return nearest if abs(nearest - depth) <= tolerance else depth
+
+
+    def curve(self, depths, roi = None, metric = 'Brenner', snap = 0):
+        """ Returns (depths, values) of the focus metric at depths. If snap is
+        non-zero, depths already evaluated within snap of a requested depth
+        are used instead, and the returned depths are those actually used.
+        """
+        if snap > 0:
+            depths = [self.nearest_evaluated(d, snap, roi, metric) for d in depths]
+        depths = np.asarray(depths, dtype = 'float64')
+        return depths, np.array([self.metric(d, roi, metric) for d in depths])
+
+
+    def auto_focus(self, depthRange, numCoarse = 10, roi = None, metric = 'Brenner', tolerance = None):
+        """ Returns depth of best focus within depthRange.
+
+        Keyword Arguments:
+            numCoarse : int, number of intervals in coarse search, default 10
+            roi       : region to assess focus in, see roi_bounds
+            metric    : str, see focus_metric
+            tolerance : float, depth precision of fine search, default is
+                        1/1000 of the range
+        """
+        low, high = float(min(depthRange)), float(max(depthRange))
+        numCoarse = max(int(numCoarse or 10), 2)
+        step = (high - low) / numCoarse
+        tolerance = tolerance or (high - low) / 1000
+        depths, values = self.curve(np.linspace(low, high, numCoarse + 1), roi, metric, snap = step / 4)
+        best = int(np.argmax(values))
+        if step == 0:
+            return low
+
+        # Golden-section search between the neighbours of the best coarse depth
+        a, b = max(depths[best] - step, low), min(depths[best] + step, high)
+        c, d = b - _GOLDEN * (b - a), a + _GOLDEN * (b - a)
+        while b - a > tolerance:
+            if self.metric(c, roi, metric) > self.metric(d, roi, metric):
+                b, d = d, c
+                c = b - _GOLDEN * (b - a)
+            else:
+                a, c = c, d
+                d = a + _GOLDEN * (b - a)
+        return (a + b) / 2
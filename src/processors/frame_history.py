@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Frame History
+
+A ring of the most recent core-removed (pre-refocus) frames, so that an
+operator can pause, go back to any recent frame and refocus it, autofocus
+it or export a depth stack from it, without reacquiring or reprocessing raw
+frames.
+
+The ring is stored in a memory-mapped file, in the same way as the metrics
+channel, so that the processor can write to it while the GUI, which may be
+in a different process, reads from it. The file contains a header, an index
+of the frame number and time of each slot, and the frames themselves, which
+are stored as float32 (default) or, to save memory, float16. float16 frames
+are clipped to the float16 range, since core-removed frames from 16 bit
+cameras can exceed it.
+
+When the frame size or length of the history changes, a new file is
+written and renamed over the old one, so a reader which still has the old
+file open is unaffected and can use is_current to check if it should reopen.
+
+The writer updates the index entry of a slot to -1 before overwriting the
+frame and to the frame number afterwards, so a reader can detect a frame
+which was overwritten while it was being read.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import time
+import tempfile
+import collections
+
+import numpy as np
+
+_MAGIC = 0x484f4c4f48495354      # 'HOLOHIST'
+_HEADER_INTS = 8                  # magic, capacity, h, w, dtype, writeCount, spare
+DTYPES = ['float16', 'float32']
+
+INDEX_DTYPE = np.dtype([('frame', '<i8'), ('timestamp', '<f8')])
+FLOAT16_MAX = float(np.finfo('float16').max)
+
+
+def default_history_file():
+    """ Returns a filename in the temp folder unique to this process.
+    """
+    return os.path.join(tempfile.gettempdir(), f"holobundle_history_{os.getpid()}.dat")
+
+
+def remove_history_file(filename):
+    """ Deletes history file filename if it exists, e.g. at exit.
+    """
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+class FrameHistory:
+    """ Ring of recent frames in a memory-mapped file. Use FrameHistory.create
+    in the processor and FrameHistory.open to read.
+
+    Keyword Arguments:
+        fftCacheSize : int, number of hologram FFTs kept by cached_fft,
+                       default 4
+    """
+
+    def __init__(self, filename, mode = 'r', fftCacheSize = 4):
+
+        self.filename = filename
+        self.mode = mode
+        self.fileId = os.stat(filename).st_ino
+        header = np.memmap(filename, dtype = '<i8', mode = 'r', shape = (_HEADER_INTS,))
+        if header[0] != _MAGIC:
+            raise ValueError(f"{filename} is not a frame history file.")
+        self.capacity, h, w, dtypeCode = (int(v) for v in header[1:5])
+        del header
+        self.shape = (h, w)
+        self.dtype = np.dtype(DTYPES[dtypeCode])
+        self.header = np.memmap(filename, dtype = '<i8', mode = mode, shape = (_HEADER_INTS,))
+        indexOffset = _HEADER_INTS * 8
+        self.index = np.memmap(filename, dtype = INDEX_DTYPE, mode = mode, offset = indexOffset, shape = (self.capacity,))
+        dataOffset = indexOffset + self.capacity * INDEX_DTYPE.itemsize
+        self.frames = np.memmap(filename, dtype = self.dtype, mode = mode, offset = dataOffset, shape = (self.capacity, h, w))
+        self.fftCacheSize = fftCacheSize
+        self.fftCache = collections.OrderedDict()
+
+
+    @classmethod
+    def create(cls, filename, capacity, shape, dtype = 'float32'):
+        """ Creates (or replaces) a history file for capacity frames of shape
+        (h, w) and opens it for writing.
+        """
+        h, w = shape[:2]
+        size = _HEADER_INTS * 8 + capacity * INDEX_DTYPE.itemsize + capacity * h * w * np.dtype(dtype).itemsize
+        tempFile = filename + '.' + str(os.getpid()) + '.tmp'
+        with open(tempFile, 'wb') as f:
+            f.truncate(size)
+        header = np.memmap(tempFile, dtype = '<i8', mode = 'r+', shape = (_HEADER_INTS,))
+        header[:5] = (_MAGIC, capacity, h, w, DTYPES.index(np.dtype(dtype).name))
+        index = np.memmap(tempFile, dtype = INDEX_DTYPE, mode = 'r+', offset = _HEADER_INTS * 8, shape = (capacity,))
+        index['frame'] = -1
+        header.flush()
+        index.flush()
+        del header, index
+        os.replace(tempFile, filename)
+        return cls(filename, mode = 'r+')
+
+
+    @classmethod
+    def open(cls, filename, fftCacheSize = 4):
+        """ Opens an existing history file for reading, or returns None if
+        there is no valid history file.
+        """
+        try:
+            return cls(filename, 'r', fftCacheSize)
+        except (OSError, ValueError):
+            return None
+
+
+    def is_current(self):
+        """ Returns False if the history file has been replaced since this
+        was opened.
+        """
+        try:
+            return os.stat(self.filename).st_ino == self.fileId
+        except OSError:
+            return False
+        
+        
+    def write_count(self):
+        return int(self.header[5])
+
+
+    def add(self, img, frameNumber, timestamp = None):
+        """ Adds frame img, overwriting the oldest frame once full.
+        """
+        slot = self.write_count() % self.capacity
+        self.index['frame'][slot] = -1
+        if self.dtype == np.float16:
+            np.clip(img, -FLOAT16_MAX, FLOAT16_MAX, out = self.frames[slot], casting = 'unsafe')
+        else:
+            self.frames[slot] = img
+        self.index['timestamp'][slot] = time.time() if timestamp is None else timestamp
+        self.index['frame'][slot] = frameNumber
+        self.header[5] = self.write_count() + 1
+
+
+    def available(self, maxAge = None):
+        """ Returns list of (frameNumber, timestamp) of frames in the history,
+        oldest first. If maxAge is given, only frames from the last maxAge
+        seconds are included.
+        """
+        count = self.write_count()
+        slots = [idx % self.capacity for idx in range(max(count - self.capacity, 0), count)]
+        now = time.time()
+        entries = []
+        for slot in slots:
+            frame, timestamp = int(self.index['frame'][slot]), float(self.index['timestamp'][slot])
+            if frame >= 0 and (maxAge is None or now - timestamp <= maxAge):
+                entries.append((frame, timestamp))
+        return entries
+
+
+    def get(self, frameNumber):
+        """ Returns a float32 copy of frame frameNumber, or None if it is no
+        longer in the history.
+        """
+        slots = np.nonzero(self.index['frame'] == frameNumber)[0]
+        if len(slots) == 0:
+            return None
+        slot = slots[0]
+        img = np.array(self.frames[slot], dtype = 'float32')
+        if self.index['frame'][slot] != frameNumber:
+            return None     # Overwritten while being read
+        return img
+
+
+    def latest(self):
+        """ Returns (frameNumber, img) of the newest frame, or None.
+        """
+        entries = self.available()
+        if len(entries) == 0:
+            return None
+        img = self.get(entries[-1][0])
+        return None if img is None else (entries[-1][0], img)
+
+
+    def cached_fft(self, key, compute):
+        """ Returns hologram FFT stored under key (which should include the
+        frame number), calling compute() to calculate it if it is not one of
+        the fftCacheSize most recently used. Repeatedly refocusing a few
+        history frames then only needs the FFT of each once.
+        """
+        if key in self.fftCache:
+            self.fftCache.move_to_end(key)
+            return self.fftCache[key]
+        value = compute()
+        if self.fftCacheSize > 0:
+            self.fftCache[key] = value
+            while len(self.fftCache) > self.fftCacheSize:
+                self.fftCache.popitem(last = False)
+        return value
+
+
+    def close(self, remove = False):
+        """ Closes the history, deleting the file if remove is True.
+        """
+        self.fftCache.clear()
+        for name in ('header', 'index', 'frames'):
+            arr = getattr(self, name, None)
+            if arr is not None and self.mode != 'r':
+                arr.flush()
+            setattr(self, name, None)
+        if remove:
+            remove_history_file(self.filename)
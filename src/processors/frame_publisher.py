@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Frame Publisher
+
+Streams processed frames to other local processes over a TCP socket on the
+loopback interface. Each frame is sent as a fixed size binary header (see
+HEADER) followed by the raw pixel data, sent directly from the array
+without copying it into an intermediate bytes object.
+
+Subscribers connect and send a request (see REQUEST) giving the decimation
+they want, N, and are then sent every Nth frame. Each subscriber has its own
+short queue and sending thread, so a slow subscriber cannot hold up the
+processor or other subscribers; if it falls behind, the oldest frames in its
+queue are dropped.
+
+FrameSubscriber is a client which can be used by other programs, and
+benchmark() measures throughput between the two.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import queue
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'HBFR'
+VERSION = 1
+
+# magic, version, mode, dtype, ndim, frameNumber, acquired time (0 if the
+# source does not record it), output time,
+# depth (m), pixel size (m), height, width, channels, payload size in bytes
+HEADER = struct.Struct('<4sBBBBQddddIIIQ')
+
+# magic, decimation
+REQUEST_MAGIC = b'HBSB'
+REQUEST = struct.Struct('<4sI')
+
+MODES = ['standard', 'differential', 'sr']
+DTYPES = ['uint8', 'uint16', 'float32', 'float64', 'complex64', 'complex128', 'int16', 'int32']
+
+# Other dtypes which are converted to one of DTYPES before publishing
+CONVERT_DTYPES = {'bool': 'uint8', 'int8': 'int16', 'float16': 'float32'}
+
+DEFAULT_PORT = 5600
+
+
+def publishable(img):
+    """ Returns img converted, if needed, to a dtype in DTYPES. Raises
+    ValueError if there is no suitable dtype.
+    """
+    name = np.dtype(img.dtype).name
+    if name in DTYPES:
+        return img
+    if name in CONVERT_DTYPES:
+        return img.astype(CONVERT_DTYPES[name])
+    raise ValueError(f"Cannot publish frames of dtype {name}.")
+
+
+def pack_header(img, frameNumber = 0, acquired = 0, output = 0, depth = 0, pixelSize = 0, mode = 'standard'):
+    """ Returns binary header for image img, which must have a dtype in
+    DTYPES (see publishable).
+    """
+    name = np.dtype(img.dtype).name
+    if name not in DTYPES:
+        raise ValueError(f"Cannot publish frames of dtype {name}.")
+    shape = tuple(np.shape(img)) + (1, 1)
+    return HEADER.pack(MAGIC, VERSION, MODES.index(mode), DTYPES.index(name), np.ndim(img),
+                       int(frameNumber), float(acquired), float(output), float(depth), float(pixelSize),
+                       shape[0], shape[1], shape[2], img.nbytes)
+
+
+def unpack_header(data):
+    """ Returns dictionary of values from binary header.
+    """
+    (magic, version, mode, dtype, ndim, frameNumber, acquired, output, depth, pixelSize,
+     height, width, channels, nbytes) = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError("Not a HoloBundle frame header.")
+    return {'version': version, 'mode': MODES[mode], 'dtype': DTYPES[dtype],
+            'shape': (height, width, channels)[:ndim], 'frameNumber': frameNumber,
+            'acquired': acquired, 'output': output, 'depth': depth, 'pixelSize': pixelSize,
+            'nbytes': nbytes}
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        num = sock.recv_into(view[received:])
+        if num == 0:
+            raise ConnectionError("Connection closed.")
+        received = received + num
+    return buffer
+
+
+class _Subscriber:
+    """ Connection to one subscriber with its own queue and sending thread.
+    """
+
+    def __init__(self, sock, decimate, queueSize):
+
+        self.sock = sock
+        self.decimate = max(int(decimate), 1)
+        self.queue = queue.Queue(queueSize)
+        self.count = 0
+        self.numSent = 0
+        self.numDropped = 0
+        self.alive = True
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+
+    def wants_frame(self):
+        """ Counts an offered frame and returns True if it should be sent,
+        taking decimation into account.
+        """
+        self.count = self.count + 1
+        return (self.count - 1) % self.decimate == 0
+
+
+    def offer(self, header, img):
+        """ Queues frame, dropping the oldest queued frame if the queue is 
+        full.
+        """
+        try:
+            self.queue.put_nowait((header, img))
+        except queue.Full:
+            try:
+                self.queue.get_nowait()
+                self.numDropped = self.numDropped + 1
+            except queue.Empty:
+                pass
+            self.queue.put_nowait((header, img))
+
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                header, img = item
+                self.sock.sendall(header)
+                if img.nbytes > 0:
+                    self.sock.sendall(img.reshape(-1).view('uint8'))
+                self.numSent = self.numSent + 1
+        except OSError:
+            pass
+        self.alive = False
+        self.sock.close()
+
+
+    def close(self):
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            self.sock.close()
+
+
+
+class FramePublisher:
+    """ Publishes frames to subscribers on a local TCP port.
+
+    Keyword Arguments:
+        port      : int, port to listen on, default DEFAULT_PORT. If 0, a free
+                    port is chosen, available as the port attribute.
+        host      : str, interface to listen on, default is loopback only
+        queueSize : int, frames queued per subscriber before dropping,
+                    default 2
+    """
+
+    def __init__(self, port = DEFAULT_PORT, host = '127.0.0.1', queueSize = 2):
+
+        self.queueSize = queueSize
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.numPublished = 0
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.port = self.server.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target = self._accept, daemon = True)
+        self.thread.start()
+
+
+    def _accept(self):
+        while self.running:
+            try:
+                sock, address = self.server.accept()
+            except OSError:
+                break
+            try:
+                sock.settimeout(5)
+                magic, decimate = REQUEST.unpack(_recv_exact(sock, REQUEST.size))
+                sock.settimeout(None)
+                if magic != REQUEST_MAGIC:
+                    raise ValueError("Not a HoloBundle subscription request.")
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (OSError, ValueError, struct.error):
+                sock.close()
+                continue
+            with self.lock:
+                self.subscribers.append(_Subscriber(sock, decimate, self.queueSize))
+
+
+    def num_subscribers(self):
+        with self.lock:
+            return len(self.subscribers)
+
+
+    def publish(self, img, frameNumber = None, acquired = None, output = None, depth = 0, pixelSize = 0, mode = 'standard'):
+        """ Sends img to all subscribers that want this frame. Returns
+        immediately; frames are sent by each subscriber's thread, from a copy
+        of img taken only if a subscriber wants the frame, so the caller may 
+        go on to modify img (as the mosaic is). Frames of other dtypes than 
+        DTYPES are converted by publishable().
+        """
+        if frameNumber is None:
+            frameNumber = self.numPublished
+        self.numPublished = self.numPublished + 1
+        with self.lock:
+            self.subscribers = [sub for sub in self.subscribers if sub.alive]
+            subscribers = list(self.subscribers)
+        if img is None:
+            return
+        subscribers = [sub for sub in subscribers if sub.wants_frame()]
+        if len(subscribers) == 0:
+            return
+        frame = publishable(img)
+        img = np.array(frame, order = 'C') if frame is img else np.ascontiguousarray(frame)
+        output = time.time() if output is None else output
+        acquired = output if acquired is None else acquired
+        header = pack_header(img, frameNumber, acquired, output, depth, pixelSize, mode)
+        for sub in subscribers:
+            sub.offer(header, img)
+
+
+    def close(self):
+        self.running = False
+        self.server.close()
+        with self.lock:
+            for sub in self.subscribers:
+                sub.close()
+            self.subscribers = []
+
+
+
+class FrameSubscriber:
+    """ Client which receives frames from a FramePublisher.
+
+    Keyword Arguments:
+        port     : int, default DEFAULT_PORT
+        host     : str, default loopback
+        decimate : int, receive only every Nth frame, default 1
+        timeout  : float, seconds to wait for a frame before raising
+                   socket.timeout, default is to wait indefinitely
+    """
+
+    def __init__(self, port = DEFAULT_PORT, host = '127.0.0.1', decimate = 1, timeout = None):
+
+        self.sock = socket.create_connection((host, port))
+        self.sock.settimeout(timeout)
+        self.sock.sendall(REQUEST.pack(REQUEST_MAGIC, max(int(decimate), 1)))
+
+
+    def read(self):
+        """ Returns (header, img) for next frame, where header is a dictionary
+        as returned by unpack_header.
+        """
+        header = unpack_header(_recv_exact(self.sock, HEADER.size))
+        data = _recv_exact(self.sock, header['nbytes'])
+        img = np.frombuffer(data, dtype = header['dtype']).reshape(header['shape'])
+        return header, img
+
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.read()
+            except ConnectionError:
+                return
+
+
+    def close(self):
+        self.sock.close()
+
+
+
+def benchmark(shape = (1024, 1024), dtype = 'float32', numFrames = 500, decimate = 1):
+    """ Publishes numFrames frames as fast as possible to a local subscriber
+    and returns a dictionary of frames received, frame rate and data rate
+    in MB/s.
+    """
+    publisher = FramePublisher(port = 0)
+    subscriber = FrameSubscriber(publisher.port, decimate = decimate, timeout = 5)
+    while publisher.num_subscribers() == 0:
+        time.sleep(0.01)
+
+    received = []
+    def receive():
+        try:
+            for header, img in subscriber:
+                received.append(header['frameNumber'])
+                if header['frameNumber'] >= numFrames - decimate:
+                    break
+        except socket.timeout:
+            pass
+    thread = threading.Thread(target = receive)
+
+    img = np.zeros(shape, dtype = dtype)
+    t0 = time.perf_counter()
+    thread.start()
+    sub = publisher.subscribers[0]
+    for idx in range(numFrames):
+        # Wait for space rather than dropping, to measure throughput
+        while sub.queue.full():
+            time.sleep(0)
+        publisher.publish(img, idx)
+    thread.join()
+    elapsed = time.perf_counter() - t0
+    subscriber.close()
+    publisher.close()
+    return {'frames': len(received), 'fps': len(received) / elapsed,
+            'MBps': len(received) * img.nbytes / elapsed / 2**20, 'dropped': sub.numDropped}
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Shared Memory Frame Ring
+
+A ring of slots in shared memory, each holding one batch of frames (e.g. a
+super-resolution LED sequence or a differential pair) as an (h, w, N)
+array. The acquisition side writes each frame directly into the next slot
+and, when the batch is complete, passes a small SlotHandle to the processor
+rather than the stack itself. The processor, which may be in another process,
+attaches to the ring and gets a zero-copy (h, w, N) view of the slot, so
+stacks are never serialised or copied between processes.
+
+Slots are reference counted by the writer. Publishing a slot gives it one
+reference (for the processor); further references can be taken for other
+users in the writer's process, such as the display. The processor releases
+its reference by writing the slot generation into the slot header, so each
+header field is only ever written by one side and no cross-process lock is
+needed. A slot is only reused once all references are released. If no slot
+is free the batch is dropped rather than overwriting a slot still in use.
+
+The cas_gui acquisition thread does not yet write to a ring; it queues
+stacks itself. At present the ring is only used by synthetic.soak_test (with
+useRing = True). The processor accepts a SlotHandle in place of a frame (see
+InlineBundleProcessorClass.process), so an acquisition thread can use the
+ring by creating it with FrameRing.create, writing each frame with
+write_frame and passing each handle returned to the processor.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import time
+import threading
+import collections
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_MAGIC = 0x484f4c4f52494e47      # 'HOLORING'
+_HEADER_INTS = 8                  # magic, numSlots, h, w, N, spare
+_DTYPE_BYTES = 16
+_SLOT_INTS = 3                    # generation, count, released generation
+
+# timestamp is the time.time() at which the batch was completed
+SlotHandle = collections.namedtuple('SlotHandle', ['name', 'slot', 'generation', 'timestamp'])
+
+
+def _open_shared_memory(name):
+    """ Attaches to existing shared memory. Where supported (Python 3.13+),
+    it is not registered with the resource tracker, which would otherwise
+    remove it when this process exits. Processor processes started by the GUI
+    share its resource tracker, so this only matters for other processes.
+    """
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        return shared_memory.SharedMemory(name = name)
+
+
+class FrameRing:
+    """ Ring of frame batches in shared memory. Use FrameRing.create on the
+    acquisition side and FrameRing.attach(name) in the processor.
+    """
+
+    def __init__(self, shm, owner = False):
+
+        self.shm = shm
+        self.owner = owner
+        self.name = shm.name
+        header = np.ndarray((_HEADER_INTS,), dtype = 'int64', buffer = shm.buf)
+        if header[0] != _MAGIC:
+            raise ValueError(f"Shared memory {shm.name} is not a frame ring.")
+        self.numSlots, h, w, n = (int(v) for v in header[1:5])
+        self.shape = (h, w, n)
+        dtypeBytes = bytes(shm.buf[_HEADER_INTS * 8:_HEADER_INTS * 8 + _DTYPE_BYTES])
+        self.dtype = np.dtype(dtypeBytes.rstrip(b'\x00').decode('ascii'))
+        slotOffset = _HEADER_INTS * 8 + _DTYPE_BYTES
+        self.slots = np.ndarray((self.numSlots, _SLOT_INTS), dtype = 'int64', buffer = shm.buf, offset = slotOffset)
+        dataOffset = slotOffset + self.numSlots * _SLOT_INTS * 8
+        dataOffset = dataOffset + (-dataOffset) % 64
+        self.data = np.ndarray((self.numSlots,) + self.shape, dtype = self.dtype, buffer = shm.buf, offset = dataOffset)
+
+        # Writer state
+        self.lock = threading.Lock()
+        self.refs = np.zeros(self.numSlots, dtype = int)
+        self.generation = 0
+        self.writeSlot = None
+        self.writeCount = 0
+        self.dropped = 0
+
+
+    @classmethod
+    def create(cls, frameShape, batchSize, dtype = 'uint16', numSlots = 8):
+        """ Creates a new ring in shared memory.
+
+        Arguments:
+            frameShape : tuple of (h, w)
+            batchSize  : int, number of frames in each slot
+
+        Keyword Arguments:
+            dtype      : dtype of frames, default 'uint16'
+            numSlots   : int, number of batches in the ring, default 8. At
+                         least 3 are needed since the processor keeps its
+                         latest slot until the next one arrives.
+        """
+        dtype = np.dtype(dtype)
+        h, w = frameShape[:2]
+        slotOffset = _HEADER_INTS * 8 + _DTYPE_BYTES
+        dataOffset = slotOffset + numSlots * _SLOT_INTS * 8
+        dataOffset = dataOffset + (-dataOffset) % 64
+        size = dataOffset + numSlots * h * w * batchSize * dtype.itemsize
+        shm = shared_memory.SharedMemory(create = True, size = size)
+        header = np.ndarray((_HEADER_INTS,), dtype = 'int64', buffer = shm.buf)
+        header[:] = 0
+        header[:5] = (_MAGIC, numSlots, h, w, batchSize)
+        shm.buf[_HEADER_INTS * 8:slotOffset] = dtype.str.encode('ascii').ljust(_DTYPE_BYTES, b'\x00')
+        np.ndarray((numSlots, _SLOT_INTS), dtype = 'int64', buffer = shm.buf, offset = slotOffset)[:] = 0
+        return cls(shm, owner = True)
+
+
+    @classmethod
+    def attach(cls, name):
+        """ Attaches to an existing ring by name.
+        """
+        return cls(_open_shared_memory(name))
+
+
+    def _collect_releases(self):
+        """ Drops the processor's reference to any slot it has released.
+        """
+        released = (self.slots[:,2] == self.slots[:,0]) & (self.slots[:,0] > 0) & (self.refs > 0)
+        for slot in np.nonzero(released)[0]:
+            self.slots[slot, 2] = -self.slots[slot, 0]
+            self.refs[slot] = self.refs[slot] - 1
+
+
+    def _next_free_slot(self):
+        self._collect_releases()
+        free = np.nonzero(self.refs == 0)[0]
+        if len(free) == 0:
+            return None
+        # Oldest free slot, so recently released slots stay valid for longest
+        return int(free[np.argmin(self.slots[free, 0])])
+
+
+    def begin_batch(self):
+        """ Starts writing a new batch and returns a writable (h, w, N) view
+        of its slot, or None if all slots are in use, in which case the batch
+        is dropped.
+        """
+        with self.lock:
+            slot = self._next_free_slot()
+            if slot is None:
+                self.dropped = self.dropped + 1
+                self.writeSlot = None
+                return None
+            self.refs[slot] = 1         # Held by writer until published
+            self.slots[slot, 0] = 0     # Invalidate any old handles
+            self.writeSlot = slot
+            self.writeCount = 0
+            return self.data[slot]
+
+
+    def publish(self):
+        """ Marks the current batch as complete and returns a SlotHandle to
+        pass to the processor. The writer's reference is passed on to the
+        processor.
+        """
+        with self.lock:
+            slot = self.writeSlot
+            if slot is None:
+                return None
+            self.generation = self.generation + 1
+            self.slots[slot, 1] = self.writeCount if self.writeCount > 0 else self.shape[2]
+            self.slots[slot, 2] = 0
+            self.slots[slot, 0] = self.generation
+            self.writeSlot = None
+            return SlotHandle(self.name, slot, self.generation, time.time())
+
+
+    def write_frame(self, frame):
+        """ Copies one frame into the current batch, starting a new batch if
+        needed. Returns a SlotHandle when the batch is complete, otherwise
+        None. Frames are dropped if no slot is free.
+        """
+        if self.writeSlot is None:
+            if self.begin_batch() is None:
+                return None
+        self.data[self.writeSlot][:,:,self.writeCount] = frame
+        self.writeCount = self.writeCount + 1
+        if self.writeCount == self.shape[2]:
+            return self.publish()
+        return None
+
+
+    def write_batch(self, frames):
+        """ Copies a whole (h, w, N) batch into the next slot and returns a
+        SlotHandle, or None if no slot is free.
+        """
+        slot = self.begin_batch()
+        if slot is None:
+            return None
+        slot[:] = frames
+        self.writeCount = self.shape[2]
+        return self.publish()
+
+
+    def view(self, handle):
+        """ Returns zero-copy (h, w, N) view of the batch in a slot, or None
+        if the slot has since been reused.
+        """
+        if self.slots[handle.slot, 0] != handle.generation:
+            return None
+        return self.data[handle.slot]
+
+
+    def incref(self, handle):
+        """ Takes an extra reference to a slot in the writer's process, e.g.
+        for display. Returns False if the slot has already been reused.
+        """
+        with self.lock:
+            if self.slots[handle.slot, 0] != handle.generation:
+                return False
+            self.refs[handle.slot] = self.refs[handle.slot] + 1
+            return True
+
+
+    def decref(self, handle):
+        """ Releases a reference taken with incref.
+        """
+        with self.lock:
+            if self.slots[handle.slot, 0] == handle.generation and self.refs[handle.slot] > 0:
+                self.refs[handle.slot] = self.refs[handle.slot] - 1
+
+
+    def release(self, handle):
+        """ Releases the processor's reference to a slot. This may be called
+        from any process.
+        """
+        if self.slots[handle.slot, 0] == handle.generation:
+            self.slots[handle.slot, 2] = handle.generation
+
+
+    def close(self):
+        """ Detaches from the ring, and removes it if this is the writer.
+        """
+        self.slots = None
+        self.data = None
+        try:
+            self.shm.close()
+        except BufferError:
+            return
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Fused Frame Ingest
+
+Differences pairs of integer camera frames for differential mode, converting
+to float32 in the same pass. The subtraction is done with a numpy ufunc
+writing into the output array, so there are no full resolution temporaries,
+and the image is split into blocks of rows which are processed by a pool of
+threads (numpy releases the GIL). Background subtraction and normalisation
+are left to PyBundle, which applies them during core removal.
+
+The difference is calculated in float32, so a negative difference is not
+wrapped around as it would be if subtracting in the unsigned camera dtype.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import concurrent.futures
+
+import numpy as np
+
+# Rows processed by each task. Chosen so that a block of a few thousand pixel
+# wide 16 bit frames fits comfortably in L2 cache.
+BLOCK_ROWS = 32
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+    return _pool
+
+
+def _blocks(height):
+    return [(start, min(start + BLOCK_ROWS, height)) for start in range(0, height, BLOCK_ROWS)]
+
+
+def _run(func, height):
+    list(_get_pool().map(lambda rows: func(*rows), _blocks(height)))
+
+
+def _output(out, shape):
+    if out is None or np.shape(out) != tuple(shape) or out.dtype != np.float32:
+        return np.empty(shape, dtype = 'float32')
+    return out
+
+
+def difference(frames, out = None):
+    """ Returns float32 difference frames[:,:,0] - frames[:,:,1].
+
+    Arguments:
+        frames : (h, w, 2) integer or float array
+
+    Keyword Arguments:
+        out    : (h, w) float32 array to write into, or None
+    """
+    h, w = np.shape(frames)[:2]
+    out = _output(out, (h, w))
+    first, second = frames[:,:,0], frames[:,:,1]
+
+    def block(start, end):
+        np.subtract(first[start:end], second[start:end], out = out[start:end], dtype = 'float32', casting = 'unsafe')
+
+    _run(block, h)
+    return out
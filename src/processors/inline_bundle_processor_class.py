@@ -12,10 +12,13 @@ University of Kent
 """
 
 import sys
+import copy
 import logging
+import importlib.util
 
 import numpy as np
 import time
+import cv2 as cv
 
 from cas_gui.threads.image_processor_class import ImageProcessorClass
 
@@ -23,9 +26,65 @@ import pybundle
 from pybundle import PyBundle
 import pyholoscope
 
+from processors.raw_archive import RawArchiveWriter, sr_led_indices
+from processors.backpressure import BackpressurePolicy
+from processors.metrics import MetricsChannel
+from processors.telemetry import LatencyTelemetry
+from processors.display_stage import DisplayStage, DisplayChannel
+from processors.stage_cache import StageCache, FrameKeys, fingerprint, state_key, is_live
+from processors import fast_refocus
+from processors import ingest
+from processors import parameter_sweep
+from processors.array_cache import ArrayFileCache, default_cache_folder
+from processors.mosaic import RefocusMosaic
+from processors.sparse_sr import SparseSRReconstructor, current_sr_calibration, output_settings
+from processors.frame_ring import FrameRing, SlotHandle
+from processors.worker_pool import ProcessorPool
+from processors.calibration_cache import CalibrationCache
+from processors.quality_controller import QualityController
+from processors.frame_publisher import FramePublisher
+from processors.frame_history import FrameHistory
+from processors.focus_cache import FocusCache, roi_bounds
+from processors.post_stages import StageChain, IntensityStage, PhaseStage, UnwrappedPhaseStage, InvertStage
+from processors.particle_tracking import ParticleLocator, ParticleTracker, ParticleTableWriter
 
 import matplotlib.pyplot as plt
 
+
+# Objects which hold open files or large buffers are kept at module level,
+# rather than as attributes of the processor, so that they survive the
+# processor being replaced when settings are piped to a processor running
+# in another process.
+_runtimeObjects = {}
+
+def runtime_object(key, factory):
+    """ Returns the module level object stored under key, creating it
+    by calling factory() if it does not yet exist.
+    """
+    if key not in _runtimeObjects:
+        _runtimeObjects[key] = factory()
+    return _runtimeObjects[key]
+
+
+def close_runtime_object(key):
+    """ Closes (if it has a close method) and removes a module level object.
+    """
+    obj = _runtimeObjects.pop(key, None)
+    if obj is not None and hasattr(obj, 'close'):
+        obj.close()
+
+
+# PyHoloscope refocuses on the GPU using CuPy, if it is installed
+CUDA_AVAILABLE = importlib.util.find_spec('cupy') is not None
+
+
+# PyBundle attributes stored in checkpoints, so that calibrations can be
+# restored without being recomputed
+CHECKPOINT_PYB = ['calibImage', 'background', 'normaliseImage', 'calibration',
+                  'srCalibImages', 'srBackgrounds', 'srNormalisationImgs',
+                  'calibrationSR', 'srCalibrationLUT']
+
+
 class InlineBundleProcessorClass(ImageProcessorClass):
     
     method = None
@@ -40,27 +99,120 @@ class InlineBundleProcessorClass(ImageProcessorClass):
     srCalibrateFlag = False
     invert = False
     showPhase = False
+    unwrapPhase = False
     sr = False
     batchProcessNum = 1
     differential = False
     currentInputImage = None
+    rawArchiveFolder = None
+    archiveSettings = {}
+    backpressure = None
+    metricsFile = None
+    telemetryCsvFile = None
+    metricsInterval = 0.5
+    fastDisplay = False
+    displayStage = None
+    displayFile = None
+    bundleKey = None
+    windowShape = None
+    windowRadius = None
+    windowThickness = 0
+    windowCacheFolder = default_cache_folder('windows')
+    mosaicRefocus = False
+    showMosaic = False
+    mosaicResetCount = 0
+    trackParticles = False
+    linkParticles = True
+    particleDepthRange = (0, 1e-3)
+    particleNumDepths = 10
+    particleDownsample = 2
+    particleThreshold = 3
+    particleCsvFile = None
+    particleResetCount = 0
+    particleTable = None
+    sparseSR = False
+    poolWorkers = 1
+    settingsVersion = 0     # Incremented by settings_changed, tells pool workers to update
+    calibrationCacheFolder = default_cache_folder('calibrations')
+    adaptiveQuality = False
+    targetFps = 20
+    refocusScale = 1        # Refocus downsampling used when adaptiveQuality is off
+    srMatrixCacheFolder = default_cache_folder('sr_matrices')
+    publishPort = None
+    postStages = []
+    historyFile = None
+    historySeconds = 0
+    historyMaxFps = 50
+    historyMemoryBudget = 2**30
+    historyDtype = 'float32'
     
     def __init__(self, **kwargs):
         
         super().__init__()
         self.pyb = PyBundle()
         self.holo = pyholoscope.Holo(pyholoscope.INLINE_MODE, 1, 1)
+        self.backpressure = BackpressurePolicy()
+        self.displayStage = DisplayStage()
         
                 
-    def process(self, inputFrame):
-        """ This is called by the thread whenever a frame needs to be processed"""
+    def process(self, inputFrame, acquired = None):
+        """ This is called by the thread whenever a frame needs to be processed.
+        acquired is the time.time() at which the frame was acquired, if the
+        source records it, used for latency telemetry.
+        """
+        self.close_stale_outputs()
+        if isinstance(inputFrame, SlotHandle):
+            if acquired is None:
+                acquired = inputFrame.timestamp
+            inputFrame = self.frame_from_ring(inputFrame)
+            if inputFrame is None:
+                return None
+        if self.poolWorkers > 1:
+            return self.process_with_pool(inputFrame)
+        t0 = time.perf_counter()
         self.currentInputImage = inputFrame
+        
+        # Identifies the frame so that when the same frame is reprocessed (e.g.
+        # after a settings change when paused or using a file) cached results 
+        # from stages before the setting that changed can be reused
+        frameKey = self.frame_key(inputFrame)
+        cache = self.get_stage_cache()
+        
+        if self.rawArchiveFolder is not None:
+            self.archive_raw(inputFrame, frameKey)
+            
+        # If we are falling behind, the backpressure policy may decide to skip
+        # this frame (or, in SR mode, this whole LED sequence)
+        if self.backpressure is not None:
+            if not self.backpressure.accept(self.get_queue_depth(), self.batchProcessNum):
+                self.publish_metrics()
+                return None
+        
+        # To hold the target frame rate, the quality controller may reduce
+        # the refocus resolution or only process some frames. Reprocessing 
+        # the same frame means we are paused, and so full quality is used.
+        refocusScale = self.refocusScale
+        if self.adaptiveQuality:
+            controller = self.get_quality_controller()
+            paused = frameKey == getattr(controller, 'lastFrameKey', None)
+            controller.lastFrameKey = frameKey
+            if not controller.accept(paused):
+                self.publish_metrics()
+                return None
+            refocusScale = controller.settings()[0]
+            
+        # The acquisition time is only recorded if the source provides it
+        telemetry = self.get_telemetry()
+        telemetry.start_frame()
+        if acquired is not None:
+            telemetry.stamp('acquired', acquired)
+            
         outputFrame = None
         if self.sr == True:
            # Check we have a list of images, otherwise return None
 
            if not inputFrame.ndim > 2:
-              print("SR but no list of images")
+              logging.warning("SR mode but input is not a stack of images.")
               return None
            
                         
@@ -76,7 +228,11 @@ class InlineBundleProcessorClass(ImageProcessorClass):
            # axs[1,3].imshow(inputFrame[:,:,7])
 
 
-           imgs = pybundle.SuperRes.sort_sr_stack(inputFrame, self.batchProcessNum - 1)  
+           sortKey = (frameKey, self.batchProcessNum)
+           imgs = cache.get('sorted', sortKey)
+           if imgs is None:
+               imgs = cache.set('sorted', sortKey, pybundle.SuperRes.sort_sr_stack(inputFrame, self.batchProcessNum - 1))
+           telemetry.stamp('sorted')
            
            # fig, axs = plt.subplots(2, 4, dpi=150)
            # fig.suptitle('Sorted', fontsize=16)
@@ -100,14 +256,18 @@ class InlineBundleProcessorClass(ImageProcessorClass):
            #print("num images reconing with ", np.shape(imgs) )
  
            if imgs is not None:
-               outputFrame =  self.pyb.process(imgs)   
+               outputFrame =  self.bundle_process(imgs, ('sr', frameKey))   
+               telemetry.stamp('bundle')
+               self.preProcessFrame = outputFrame
         
         
         elif self.differential:   # Differential Mode
             if inputFrame.ndim == 3:
                 if np.shape(inputFrame)[2] == 2:
-                    outputFrame = inputFrame[:,:,0] - inputFrame[:,:,1]
-                    outputFrame = self.pyb.process(outputFrame)
+                    # Difference in float32 so it cannot underflow
+                    outputFrame = ingest.difference(inputFrame)
+                    outputFrame = self.bundle_process(outputFrame, ('differential', frameKey))
+                    telemetry.stamp('bundle')
                     self.preProcessFrame = outputFrame
 
 
@@ -117,33 +277,813 @@ class InlineBundleProcessorClass(ImageProcessorClass):
             #    inputFrame = inputFrame[0]
             if inputFrame.ndim == 3:
                 inputFrame = inputFrame[:,:,0]
-            outputFrame = self.pyb.process(inputFrame)
+            outputFrame = self.bundle_process(inputFrame, ('standard', frameKey))
+            telemetry.stamp('bundle')
            
             self.preProcessFrame = outputFrame
             
         #print(self.holo.wavelength)
         #print(self.holo.pixelSize)
         
+        if self.historyFile is not None and self.historySeconds > 0 and outputFrame is not None:
+            self.record_history(outputFrame, frameKey, telemetry.current)
+        
+        if self.trackParticles and outputFrame is not None:
+            self.locate_particles(outputFrame, frameKey)
+        
         if self.refocus == True and outputFrame is not None:
-            outputFrame = self.holo.process(outputFrame)
-            if self.showPhase is False:
-                outputFrame = np.abs(outputFrame)
-                if self.invert is True:
-                    outputFrame = np.max(outputFrame) - outputFrame
-            else:
-                 outputFrame = np.angle(outputFrame)    
-            if outputFrame is not None:
-                outputFrame = np.abs(outputFrame)   # Take intensity from complex image
-                
+            outputFrame = self.refocus_frame(outputFrame, self.bundleKey, refocusScale)
+            telemetry.stamp('refocus')
+            outputFrame = self.get_post_chain().run(outputFrame)
+            telemetry.stamp('post')
+            
+            if self.mosaicRefocus:
+                mosaic = self.get_mosaic()
+                if frameKey != mosaic.lastFrameKey:
+                    mosaic.lastFrameKey = frameKey
+                    mosaic.add(outputFrame)
+                if self.showMosaic:
+                    outputFrame = mosaic.get_mosaic()
+        
+        if self.backpressure is not None:
+            self.backpressure.record_process_time(time.perf_counter() - t0)
+        if self.adaptiveQuality and not paused:
+            controller.record(time.perf_counter() - t0)
+        if self.publishPort is not None and outputFrame is not None:
+            self.publish_frame(outputFrame, telemetry.current)
+        # Downsample and convert to 8 bit here rather than in the GUI thread
+        if self.fastDisplay and outputFrame is not None:
+            self.update_display(outputFrame, telemetry.current)
+        
+        telemetry.stamp('output')
+        telemetry.end_frame()
+        self.publish_metrics()
+        
+        return outputFrame
+
+    def process_with_pool(self, inputFrame):
+        """ Sends frame to a pool of worker processes and returns the next
+        processed frame in acquisition order, or None if it is not ready yet.
+        Outputs are therefore delayed by a few frames, but throughput scales
+        with the number of workers. Raw archiving, backpressure and adaptive
+        quality are handled here, everything else by the workers.
+        """
+        self.currentInputImage = inputFrame
+        frameKey = self.frame_key(inputFrame)
+        if self.rawArchiveFolder is not None:
+            self.archive_raw(inputFrame, frameKey)
+        if self.backpressure is not None:
+            if not self.backpressure.accept(self.get_queue_depth(), self.batchProcessNum):
+                self.publish_metrics()
+                return None
+        
+        # Frames are skipped here, before they are sent to the pool, and the
+        # refocus scale for the quality level is sent to the workers as a 
+        # setting, which only happens when the level changes
+        refocusScale = self.refocusScale
+        paused = False
+        if self.adaptiveQuality:
+            controller = self.get_quality_controller()
+            paused = frameKey == getattr(controller, 'lastFrameKey', None)
+            controller.lastFrameKey = frameKey
+            if not controller.accept(paused):
+                self.publish_metrics()
+                return None
+            refocusScale = controller.settings()[0]
+        
+        pool = _runtimeObjects.get('processorPool')
+        if pool is not None and pool.numWorkers != self.poolWorkers:
+            close_runtime_object('processorPool')
+            pool = None
+        settingsKey = (self.pool_settings_key(), refocusScale)
+        if pool is None:
+            pool = runtime_object('processorPool', lambda: ProcessorPool(self.pool_worker_copy(refocusScale), self.poolWorkers))
+        elif settingsKey != pool.settingsKey:
+            pool.update_settings(self.pool_worker_copy(refocusScale))
+        pool.settingsKey = settingsKey
+            
+        t0 = time.perf_counter()
+        pool.submit(np.asarray(inputFrame))
+        
+        # Wait for the oldest frame once all workers are busy, so frames do not
+        # build up in the pool
+        result = pool.get(block = pool.in_flight() > pool.numWorkers)
+        if self.backpressure is not None:
+            self.backpressure.record_process_time((time.perf_counter() - t0))
+        # Workers process frames in parallel, so the time available for each
+        # frame is shared between them
+        if self.adaptiveQuality and not paused and result is not None:
+            controller.record(pool.lastProcessTime / pool.numWorkers)
+        self.publish_metrics()
+        if result is None:
+            return None
+        seq, outputFrame, self.preProcessFrame = result
+        if self.publishPort is not None:
+            self.publish_frame(outputFrame)
+        if self.fastDisplay:
+            self.update_display(outputFrame)
+        return outputFrame
+    
+    
+    def worker_copy(self):
+        """ Returns copy of processor to send to pool workers. Archiving and 
+        metrics are handled by this processor. Mosaicing, particle tracking
+        and the frame history need every frame in order, and so are not 
+        available in pool mode.
+        """
+        worker = copy.copy(self)
+        worker.poolWorkers = 1
+        worker.rawArchiveFolder = None
+        worker.metricsFile = None
+        worker.telemetryCsvFile = None
+        worker.backpressure = None
+        worker.mosaicRefocus = False
+        worker.showMosaic = False
+        worker.trackParticles = False
+        worker.publishPort = None
+        worker.historyFile = None
+        worker.fastDisplay = False
+        worker.currentInputImage = None
+        worker.preProcessFrame = None
+        return worker
+    
+    
+    def pool_worker_copy(self, refocusScale = 1):
+        """ Returns copy of processor for pool workers, with adaptive quality
+        handled by this processor and the refocus scale fixed at refocusScale.
+        """
+        worker = self.worker_copy()
+        worker.adaptiveQuality = False
+        worker.refocusScale = refocusScale
+        return worker
+    
+    
+    def settings_changed(self):
+        """ Must be called after settings are changed (other than through
+        the set_ methods of this class, which call it), so that pool workers
+        are sent the new settings.
+        """
+        self.settingsVersion = self.settingsVersion + 1
+    
+    
+    def pool_settings_key(self):
+        """ Returns key describing processor settings, used to detect when
+        the settings need to be sent to pool workers again.
+        """
+        return self.settingsVersion
+    
+    
+    def frame_from_ring(self, handle):
+        """ Returns zero-copy (h, w, N) view of the batch in a shared memory
+        frame ring slot, or None if it has already been overwritten. The slot 
+        of the previous batch is released at this point rather than when 
+        processing finishes, so that currentInputImage remains valid (e.g. for
+        SR calibration) until the next batch arrives.
+        """
+        ring = runtime_object(('frameRing', handle.name), lambda: FrameRing.attach(handle.name))
+        held = runtime_object('heldSlot', dict)
+        previous = held.pop('handle', None)
+        if previous is not None:
+            runtime_object(('frameRing', previous.name), lambda: FrameRing.attach(previous.name)).release(previous)
+        frames = ring.view(handle)
+        if frames is not None:
+            held['handle'] = handle
+        return frames
+    
+    
+    def frame_key(self, inputFrame):
+        """ Returns key identifying raw input frame. Frames are only 
+        fingerprinted in full if they may be a repeat of the last frame, live
+        frames get a unique key which never matches the stage cache. See
+        stage_cache.FrameKeys.
+        """
+        return runtime_object('frameKeys', FrameKeys).key(inputFrame)
+    
+    
+    def get_stage_cache(self):
+        """ Returns the stage cache for this process.
+        """
+        return runtime_object('stageCache', StageCache)
+    
+    
+    def bundle_process(self, img, inputKey):
+        """ Core removal using PyBundle. If the same input has already been 
+        processed with the same PyBundle settings and calibration, the cached 
+        result is returned.
+        
+        Arguments:
+            img       : numpy array, image or stack of images
+            inputKey  : hashable key identifying img
+        """
+        cache = self.get_stage_cache()
+        if is_live(inputKey):
+            key = inputKey      # Cannot repeat, so no need to describe settings
+        else:
+            key = (inputKey, state_key(self.pyb))
+        self.bundleKey = key
+        outputFrame = cache.get('bundle', key)
+        if outputFrame is None:
+            if self.sr and self.sparseSR and np.ndim(img) == 3:
+                outputFrame = self.sparse_sr_process(img)
+            if outputFrame is None:
+                outputFrame = self.pyb.process(img)
+            outputFrame = cache.set('bundle', key, outputFrame)
         return outputFrame
+    
+    
+    def sparse_sr_process(self, imgs):
+        """ SR reconstruction as a single sparse matrix product, using a 
+        matrix built from the current SR calibration (or LUT entry) and shared
+        between processes via the matrix cache folder. Returns None if the 
+        calibration cannot be converted to a matrix, in which case PyBundle 
+        should be used instead.
+        """
+        reconstructor = runtime_object(('sparseSR', self.srMatrixCacheFolder), lambda: SparseSRReconstructor(self.srMatrixCacheFolder))
+        outputFrame = reconstructor.reconstruct(imgs, current_sr_calibration(self.pyb))
+        if outputFrame is None:
+            return None
+        return output_settings(outputFrame, self.pyb)
+    
+    
+    def refocus_frame(self, img, imgKey = None, scale = 1):
+        """ Refocuses a core-removed image to the current depth, returning
+        the complex field. The hologram FFT is cached, so that if only the 
+        depth changes this requires only one multiply and one inverse FFT.
+        
+        Arguments:
+            img      : numpy array, core-removed hologram
+            
+        Keyword Arguments:
+            imgKey   : hashable key identifying img. If None (default), a 
+                       fingerprint of img is used.
+            scale    : int, factor to downsample img by before refocusing, 
+                       default 1. The field is upsampled back to the size of
+                       img, so that the output size (and so the display and 
+                       mosaic) does not change with scale. Not used when 
+                       refocusing on the GPU.
+        """
+        if self.holo.cuda and CUDA_AVAILABLE:
+            # PyHoloscope GPU refocusing, which applies its own window and
+            # background. Stages are not cached as the GPU is fast enough.
+            return self.holo.process(img)
+        cache = self.get_stage_cache()
+        h, w = np.shape(img)[:2]
+        if scale > 1:
+            img = cv.resize(np.asarray(img, dtype = 'float32'), (w // scale, h // scale), interpolation = cv.INTER_AREA)
+            imgKey = None if imgKey is None else (imgKey, scale)
+        pixelSize = self.holo.pixelSize * scale
+        shape = np.shape(img)
+        fftKey, imgFFT = self.get_hologram_fft(img, imgKey)
+        
+        fieldKey = (fftKey, self.propagator_key(shape, pixelSize))
+        field = cache.get('field', fieldKey)
+        if field is None:
+            field = cache.set('field', fieldKey, fast_refocus.propagate(imgFFT, self.get_propagator(shape, pixelSize)))
+        if scale > 1:
+            # OpenCV cannot resize complex arrays, but can resize the real
+            # and imaginary parts as a two channel image
+            field = np.ascontiguousarray(field, dtype = 'complex64')
+            channels = field.view('float32').reshape(np.shape(field) + (2,))
+            field = cv.resize(channels, (w, h), interpolation = cv.INTER_LINEAR).view('complex64')[:, :, 0]
+        return field
+    
+    
+    def get_hologram_fft(self, img, imgKey = None):
+        """ Returns (key, FFT) of windowed hologram img, using the cached FFT
+        if img has already been transformed with the current window.
+        """
+        if imgKey is None:
+            imgKey = fingerprint(img)
+        cache = self.get_stage_cache()
+        shape = np.shape(img)
+        background = self.hologram_background(shape)
+        
+        fftKey = (imgKey, self.window_key(shape), state_key(background))
+        imgFFT = cache.get('fft', fftKey)
+        if imgFFT is None:
+            buffer = runtime_object('fftBuffer', dict)
+            if buffer.get('shape') != shape:
+                buffer['shape'] = shape
+                buffer['buffer'] = np.empty(shape, dtype = 'complex64')
+            imgFFT = cache.set('fft', fftKey, fast_refocus.hologram_fft(img, self.get_window(shape), background, buffer['buffer']))
+        return fftKey, imgFFT
+    
+    
+    def hologram_background(self, shape):
+        """ Returns the hologram background, resized to shape if needed, or
+        None if there is no background.
+        """
+        background = getattr(self.holo, 'background', None)
+        if background is not None and np.shape(background) != shape:
+            background = cv.resize(np.asarray(background, dtype = 'float32'), (shape[1], shape[0]), interpolation = cv.INTER_AREA)
+        return background
+    
+    
+    def record_history(self, img, frameKey = None, frame = None):
+        """ Adds core-removed frame img to the frame history. The history 
+        holds historySeconds of frames at up to historyMaxFps, limited to
+        historyMemoryBudget bytes. frame is the telemetry record, used for 
+        the frame number and time.
+        """
+        shape = np.shape(img)[:2]
+        frameBytes = int(np.prod(shape)) * np.dtype(self.historyDtype).itemsize
+        capacity = max(1, min(int(self.historySeconds * self.historyMaxFps), self.historyMemoryBudget // frameBytes))
+        key = ('history', self.historyFile)
+        history = _runtimeObjects.get(key)
+        if history is not None and (history.shape != shape or history.capacity != capacity or history.dtype != self.historyDtype):
+            close_runtime_object(key)
+            history = None
+        try:
+            if history is None:
+                history = runtime_object(key, lambda: FrameHistory.create(self.historyFile, capacity, shape, self.historyDtype))
+                history.lastFrameKey = None
+            if frameKey is not None and frameKey == history.lastFrameKey:
+                return
+            history.lastFrameKey = frameKey
+            frame = frame or {}
+            history.add(img, frame.get('frame', history.write_count()), frame.get('received'))
+        except OSError as e:
+            logging.warning("Frame history stopped: %s", e)
+            self.historyFile = None
+            
+            
+    def get_history_reader(self):
+        """ Returns the frame history for reading, e.g. in the GUI, or None
+        if there is no history yet.
+        """
+        key = ('historyReader', self.historyFile)
+        history = _runtimeObjects.get(key)
+        if history is not None and not history.is_current():
+            close_runtime_object(key)
+            history = None
+        if history is None and self.historyFile is not None:
+            history = FrameHistory.open(self.historyFile)
+            if history is not None:
+                _runtimeObjects[key] = history
+        return history
+    
+    
+    def history_frame(self, frameNumber):
+        """ Returns core-removed frame frameNumber from the history as
+        float32, or None if it is no longer available.
+        """
+        history = self.get_history_reader()
+        if history is None:
+            return None
+        return history.get(frameNumber)
+    
+    
+    def refocus_history_frame(self, frameNumber):
+        """ Refocuses frame frameNumber from the history to the current 
+        depth, returning the complex field, or None if the frame is no longer
+        available. The FFTs of the last few history frames refocused are 
+        kept, so changing depth only needs one multiply and inverse FFT.
+        """
+        history = self.get_history_reader()
+        img = None if history is None else history.get(frameNumber)
+        if img is None:
+            return None
+        shape = np.shape(img)
+        background = self.hologram_background(shape)
+        fftKey = (frameNumber, self.window_key(shape), state_key(background))
+        imgFFT = history.cached_fft(fftKey, lambda: fast_refocus.hologram_fft(img, self.get_window(shape), background))
+        return fast_refocus.propagate(imgFFT, self.get_propagator(shape))
+    
+    
+    def get_focus_cache(self, img, imgKey = None):
+        """ Returns the focus cache with core-removed hologram img selected.
+        Planes and focus curves already calculated for img, e.g. by an 
+        autofocus, are kept and reused.
+        """
+        if imgKey is None:
+            imgKey = state_key(img)
+        fftKey, imgFFT = self.get_hologram_fft(img, imgKey)
+        cache = runtime_object('focusCache', FocusCache)
+        cache.select(fftKey, imgFFT, self.holo.wavelength, self.holo.pixelSize)
+        return cache
+    
+    
+    def depth_stack(self, img, depthRange, nDepths):
+        """ Refocuses core-removed hologram img to nDepths depths between 
+        depthRange[0] and depthRange[1], using one hologram FFT for all depths.
+        Returns tuple of (depths, stack) where stack is a float32 array of
+        amplitudes of shape (nDepths, h, w).
+        """
+        depths = np.linspace(depthRange[0], depthRange[1], nDepths)
+        return depths, self.get_focus_cache(img).stack(depths)
+    
+    
+    def focus_curve(self, img, depthRange, nDepths, roi = None, metric = 'Brenner'):
+        """ Returns (depths, values) of focus metric of core-removed 
+        hologram img within roi for nDepths depths in depthRange.
+        """
+        return self.get_focus_cache(img).curve(np.linspace(depthRange[0], depthRange[1], nDepths), roi, metric)
+    
+    
+    def auto_focus_frame(self, img, depthRange, coarseSearchInterval = None, roi = None, metric = 'Brenner', margin = None):
+        """ Returns depth of best focus of core-removed hologram img within 
+        depthRange (in m). Planes and metric values are kept in the focus 
+        cache, so a depth stack or a repeat autofocus of the same frame 
+        reuses them.
+        
+        If margin (in pixels) is given as well as roi, only the region within
+        margin of the roi is refocused, as in PyHoloscope. This is faster, 
+        but the planes are then of this region only and so are not reused by
+        a depth stack.
+        """
+        if margin is None or roi is None:
+            return self.get_focus_cache(img).auto_focus(depthRange, coarseSearchInterval, roi, metric)
+        
+        # As in PyHoloscope, the background is subtracted and the window
+        # applied to the whole hologram, and then the region is cropped
+        h, w = np.shape(img)[:2]
+        y0, y1, x0, x1 = roi_bounds(roi, (h, w))
+        margin = int(margin)
+        cy0, cy1, cx0, cx1 = max(y0 - margin, 0), min(y1 + margin, h), max(x0 - margin, 0), min(x1 + margin, w)
+        cropped = np.asarray(img, dtype = 'float32')
+        background = self.hologram_background((h, w))
+        if background is not None:
+            cropped = cropped - background
+        window = self.get_window((h, w))
+        if window is not None:
+            cropped = cropped * window
+        cropped = cropped[cy0:cy1, cx0:cx1]
+        cache = runtime_object('focusCache', FocusCache)
+        cache.select((state_key(img), self.window_key((h, w)), state_key(background), (cy0, cy1, cx0, cx1)),
+                     fast_refocus.hologram_fft(cropped), self.holo.wavelength, self.holo.pixelSize)
+        return cache.auto_focus(depthRange, coarseSearchInterval, (x0 - cx0, y0 - cy0, x1 - x0, y1 - y0), metric)
 
-    #def message(self, message, parameter):
-     #   if message == "set_depth":
-      #      self.holo.set_depth(parameter)
+
+    def parameter_sweep(self, holograms, param, values, depthRange, nDepths, knownDepths = None,
+                        fitOffset = False, roi = None, metric = 'Brenner'):
+        """ Finds the pixel size or wavelength (param is 'pixelSize' or
+        'wavelength') from values which best matches the depths of best
+        focus of core-removed holograms of a calibration target to
+        knownDepths (in m), using the current window and background and the
+        current value of the other parameter. See parameter_sweep.sweep for
+        the returned dictionary.
+        """
+        if np.ndim(holograms) == 2:
+            holograms = [holograms]
+        shape = np.shape(holograms[0])
+        return parameter_sweep.sweep(holograms, param, values, np.linspace(depthRange[0], depthRange[1], nDepths),
+                                     self.holo.wavelength, self.holo.pixelSize, knownDepths, fitOffset,
+                                     self.get_window(shape), self.hologram_background(shape), roi, metric)
+
+
+    def propagator_key(self, shape, pixelSize = None):
+        if pixelSize is None:
+            pixelSize = self.holo.pixelSize
+        return (tuple(shape), float(self.holo.wavelength), float(pixelSize), float(self.holo.depth))
+    
+    
+    def get_propagator(self, shape, pixelSize = None):
+        """ Returns propagator for current depth, wavelength and pixel size. A 
+        few recent propagators are kept so that switching back and forth between
+        depths does not require them to be recalculated.
+        """
+        propagators = runtime_object('propagators', dict)
+        if pixelSize is None:
+            pixelSize = self.holo.pixelSize
+        key = self.propagator_key(shape, pixelSize)
+        if key not in propagators:
+            if len(propagators) >= 8:
+                propagators.pop(next(iter(propagators)))
+            propagators[key] = fast_refocus.propagator(shape, self.holo.wavelength, pixelSize, self.holo.depth)
+        return propagators[key]
+    
+    
+    def set_window(self, shape, radius = None, thickness = 0):
+        """ Sets window applied to hologram before refocusing.
+        
+        Arguments:
+            shape     : 'circle' or None for no window
+            
+        Keyword Arguments:
+            radius    : float, radius in pixels, None (default) for largest 
+                        circle that fits in image
+            thickness : float, thickness of cosine taper at edge of window
+        """
+        self.windowShape = shape
+        self.windowRadius = radius
+        self.windowThickness = thickness
+        
+        # Also set on PyHoloscope for when refocusing on the GPU
+        if shape is None:
+            self.holo.window = None
+        else:
+            self.holo.set_auto_window(True)
+            self.holo.set_window_shape(shape)
+            self.holo.set_window_radius(radius)
+            self.holo.set_window_thickness(thickness)
+        self.settings_changed()
+        
+        
+    def window_key(self, shape):
+        if self.windowShape is None:
+            return None
+        return (self.windowShape, tuple(shape), self.windowRadius, float(self.windowThickness))
+        
+        
+    def get_window(self, shape):
+        """ Returns window for image of given shape, or None if there is no
+        window. Windows are cached on disk, keyed by shape, radius and 
+        thickness, so they are shared between processor processes and only 
+        built once.
+        """
+        key = self.window_key(shape)
+        if key is None:
+            return None
+        windowCache = runtime_object(('windowCache', self.windowCacheFolder), lambda: ArrayFileCache(self.windowCacheFolder))
+        return windowCache.get_or_create(key, lambda: fast_refocus.circular_window(shape, self.windowRadius, self.windowThickness))
+    
+    
+    def get_mosaic(self):
+        """ Returns the mosaic of refocused images for this process. 
+        """
+        mosaic = runtime_object('mosaic', RefocusMosaic)
+        if getattr(mosaic, 'resetCount', 0) != self.mosaicResetCount:
+            mosaic.reset()
+        mosaic.resetCount = self.mosaicResetCount
+        if not hasattr(mosaic, 'lastFrameKey'):
+            mosaic.lastFrameKey = None
+        return mosaic
+    
+    
+    def locate_particles(self, img, frameKey = None):
+        """ Finds particles in 3D in core-removed hologram img, links them 
+        to tracks if linkParticles is True, and writes the table to the 
+        particle CSV file if one is set. The table is also stored in 
+        particleTable. If frameKey is the same as for the last frame, the 
+        frame is being reprocessed and the last table is returned.
+        """
+        locator = runtime_object('particleLocator', ParticleLocator)
+        tracker = runtime_object('particleTracker', ParticleTracker)
+        if getattr(tracker, 'resetCount', 0) != self.particleResetCount:
+            tracker.reset()
+            tracker.frameNumber = 0
+        tracker.resetCount = self.particleResetCount
+        if frameKey is not None and frameKey == getattr(tracker, 'lastFrameKey', None):
+            return self.particleTable
+        tracker.lastFrameKey = frameKey
+        tracker.frameNumber = getattr(tracker, 'frameNumber', 0) + 1
+        
+        locator.depthRange = self.particleDepthRange
+        locator.numDepths = int(self.particleNumDepths)
+        locator.downsample = max(int(self.particleDownsample), 1)
+        locator.threshold = self.particleThreshold
+        tracker.zScale = 1 / self.holo.pixelSize
+        
+        focusCache = self.get_focus_cache(img, self.bundleKey if frameKey is not None else None)
+        table = locator.locate(focusCache.imgFFT, self.holo.wavelength, self.holo.pixelSize, tracker.frameNumber, focusCache.plane)
+        if self.linkParticles:
+            table = tracker.link(table)
+        self.particleTable = table
+        
+        if self.particleCsvFile is not None:
+            writer = runtime_object(('particleCsv', self.particleCsvFile), lambda: ParticleTableWriter(self.particleCsvFile))
+            writer.write(table)
+        if self.metricsFile is not None:
+            channel = runtime_object(('metrics', self.metricsFile), lambda: MetricsChannel(self.metricsFile))
+            channel.update({'particleCount': len(table), 'trackCount': tracker.nextTrack})
+        return table
+    
+    
+    def set_particle_csv(self, filename):
+        """ Sets CSV file to append particle tables to. Set to None to stop.
+        """
+        self.particleCsvFile = filename
+        for key in list(_runtimeObjects):
+            if key[0] == 'particleCsv' and key[1] != filename:
+                close_runtime_object(key)
+                
+                
+    def reset_particle_tracks(self):
+        """ Ends all tracks and restarts frame numbering. Uses a counter so
+        that it also works on a copy of the processor in another process.
+        """
+        self.particleResetCount = self.particleResetCount + 1
+        
+        
+    def reset_mosaic(self):
+        """ Clears the mosaic. This is done by incrementing a counter so that 
+        it also works on a copy of the processor in another process.
+        """
+        self.mosaicResetCount = self.mosaicResetCount + 1
+        
+        
+    def message(self, message, parameter):
+        """ Handles messages piped from the GUI.
+        """
+        if message == "set_depth":
+            self.set_depth(parameter)
+        elif message == "set_display_size":
+            self.set_display_size(*parameter)
+        elif hasattr(super(), 'message'):
+            super().message(message, parameter)
 
 
     def set_depth(self,depth):
         self.holo.set_depth(depth)
+        self.settings_changed()
+        
+        
+    def set_display_size(self, width, height):
+        """ Sets the size of the display that images are downsampled to when
+        fastDisplay is True.
+        """
+        self.displayStage.set_size(int(width), int(height))
+        
+        
+    def update_display(self, img, frame = None):
+        """ Downsamples and maps processed frame img to 8 bit for display,
+        and writes it to the display file, if one has been set, if it has
+        changed since the last frame. frame is the telemetry record, used for
+        the frame number. img itself is not modified.
+        """
+        display = self.displayStage.process(img)
+        if self.displayFile is None or not self.displayStage.changed:
+            return
+        channel = runtime_object(('display', self.displayFile), lambda: DisplayChannel(self.displayFile, create = True))
+        channel.write(display, (frame or {}).get('frame', 0))
+        
+        
+    def set_raw_archive(self, folder):
+        """ Sets folder to append raw frames to. Set to None to stop archiving.
+        """
+        self.rawArchiveFolder = folder
+        self.close_stale_outputs()
+        
+        
+    def set_publish_port(self, port):
+        """ Sets local port that processed frames are published on, so they
+        can be received by other processes. Set to None to stop publishing.
+        """
+        self.publishPort = port
+        self.close_stale_outputs()
+        
+        
+    def close_stale_outputs(self):
+        """ Closes raw archive writers and publishers for a folder or port
+        which is no longer set, and deletes the frame history file if the 
+        history is turned off. This is called by process() as well as the
+        set_ methods since, in multicore mode, the set_ methods are called on
+        the copy of the processor in the GUI process, not the one that owns
+        the writer or publisher.
+        """
+        for key in list(_runtimeObjects):
+            if not isinstance(key, tuple):
+                continue
+            if (key[0] == 'rawArchive' and key[1] != self.rawArchiveFolder) or (key[0] == 'publisher' and key[1] != self.publishPort):
+                close_runtime_object(key)
+            elif key[0] == 'history' and (key[1] != self.historyFile or self.historySeconds <= 0):
+                _runtimeObjects.pop(key).close(remove = True)
+                
+                
+    def publish_frame(self, img, frame = None):
+        """ Sends processed frame img to subscribers, with the frame number
+        and timestamps from the telemetry record frame if given.
+        """
+        key = ('publisher', self.publishPort)
+        try:
+            publisher = runtime_object(key, lambda: FramePublisher(self.publishPort))
+        except OSError as e:
+            logging.warning("Cannot publish frames on port %s: %s", self.publishPort, e)
+            self.publishPort = None
+            return
+        if self.sr:
+            mode = 'sr'
+        elif self.differential:
+            mode = 'differential'
+        else:
+            mode = 'standard'
+        frame = frame or {}
+        publisher.publish(img, frame.get('frame'), frame.get('acquired', 0), None,
+                          self.holo.depth if self.refocus else 0, self.holo.pixelSize, mode)
+        
+        
+    def checkpoint_objects(self):
+        """ Returns dictionary of the calibration images and calibrations
+        to store in a checkpoint.
+        """
+        return {'pyb.' + name: getattr(self.pyb, name, None) for name in CHECKPOINT_PYB}
+    
+    
+    def restore_checkpoint_objects(self, objects):
+        """ Restores calibration images and calibrations from a dictionary
+        returned by checkpoint_objects.
+        """
+        for name in CHECKPOINT_PYB:
+            if 'pyb.' + name in objects:
+                setattr(self.pyb, name, objects['pyb.' + name])
+        self.settings_changed()
+        
+        
+    def get_queue_depth(self):
+        """ Returns number of frames waiting in the input queue, or 0 if the
+        processor is not attached to a queue.
+        """
+        try:
+            return self.get_num_images_in_input_queue()
+        except (AttributeError, TypeError):
+            return 0
+        
+        
+    def set_backpressure(self, mode, everyN = 2, maxBacklog = 2):
+        """ Sets the backpressure policy mode, see backpressure.py.
+        """
+        self.backpressure.mode = mode
+        self.backpressure.everyN = max(int(everyN), 1)
+        self.backpressure.maxBacklog = max(int(maxBacklog), 1)
+        
+        
+    def publish_metrics(self):
+        """ Writes current metrics to the metrics file, if one has been set,
+        so that they can be read by the GUI.
+        """
+        if self.metricsFile is None:
+            return
+        channel = runtime_object(('metrics', self.metricsFile), lambda: MetricsChannel(self.metricsFile))
+        if self.backpressure is not None:
+            channel.update(self.backpressure.get_metrics(self.batchProcessNum))
+            
+        # Latest frame, so the GUI can work out how old it is when displayed
+        telemetry = self.get_telemetry()
+        if len(telemetry.history) > 0:
+            frame = telemetry.history[-1]
+            channel.update({'frameNumber': frame['frame'],
+                            'frameAcquired': frame.get('acquired', 0),
+                            'frameReceived': frame['received'],
+                            'frameOutput': frame['output']})
+            
+        # Percentiles are slower to compute so are updated less often
+        now = time.time()
+        if now - channel.get('updated') > self.metricsInterval:
+            percentiles = telemetry.percentiles('acquired', 'output')
+            if percentiles is None:
+                percentiles = telemetry.percentiles('received', 'output')
+            if percentiles is not None:
+                channel.update({'latencyP50': percentiles[0], 'latencyP90': percentiles[1], 'latencyP99': percentiles[2]})
+            stageMeans = telemetry.stage_means()
+            if self.adaptiveQuality:
+                channel.set('qualityLevel', self.get_quality_controller().level)
+            else:
+                channel.set('qualityLevel', 0)
+            channel.update({'sortTime': stageMeans.get('sorted', 0),
+                            'bundleTime': stageMeans.get('bundle', 0),
+                            'refocusTime': stageMeans.get('refocus', 0),
+                            'postTime': stageMeans.get('post', 0)})
+            channel.set('updated', now)
+        
+        
+    def get_telemetry(self):
+        """ Returns the latency telemetry object for this process.
+        """
+        telemetry = runtime_object('telemetry', LatencyTelemetry)
+        telemetry.set_csv_file(self.telemetryCsvFile)
+        return telemetry
+        
+        
+    def get_settings_dict(self):
+        """ Returns dictionary of current processing settings, for storing 
+        alongside raw frames.
+        """
+        settings = {'refocus': bool(self.refocus),
+                    'depth': float(self.holo.depth),
+                    'wavelength': float(self.holo.wavelength),
+                    'pixelSize': float(self.holo.pixelSize),
+                    'sr': bool(self.sr),
+                    'differential': bool(self.differential),
+                    'batchProcessNum': int(self.batchProcessNum),
+                    'showPhase': bool(self.showPhase),
+                    'unwrapPhase': bool(self.unwrapPhase),
+                    'invert': bool(self.invert)}
+        settings.update(self.archiveSettings)
+        return settings
+    
+    
+    def archive_raw(self, inputFrame, frameKey = None):
+        """ Appends raw input frame, or stack of frames, to the raw archive.
+        If frameKey is the same as for the last frame archived, the frame is 
+        being reprocessed and so is not archived again.
+        """
+        try:
+            archive = runtime_object(('rawArchive', self.rawArchiveFolder), lambda: RawArchiveWriter(self.rawArchiveFolder))
+            if frameKey is not None:
+                if frameKey == getattr(archive, 'lastFrameKey', None):
+                    return
+                archive.lastFrameKey = frameKey
+            archive.set_settings(self.get_settings_dict())
+            if inputFrame.ndim > 2:
+                if self.sr:
+                    archive.add_stack(inputFrame, leds = sr_led_indices(inputFrame))
+                else:
+                    archive.add_stack(inputFrame)
+            else:
+                archive.add_frame(inputFrame)
+        except (OSError, ValueError) as e:
+            logging.warning("Raw archiving stopped: %s", e)
+            self.set_raw_archive(None)
         
     def handle_flags(self):
         """ Flags can be set externally for actions which cannot be performed
@@ -166,6 +1106,7 @@ class InlineBundleProcessorClass(ImageProcessorClass):
                 
     def set_differential(self, isDifferential):
         self.differential = isDifferential
+        self.settings_changed()
             
                     
     def calibrate_sr(self):
@@ -182,12 +1123,79 @@ class InlineBundleProcessorClass(ImageProcessorClass):
               
               # Extract a sequence of frames in correct order following blank reference frame
               calibImgs = pybundle.SuperRes.sort_sr_stack(self.currentInputImage, self.batchProcessNum - 1)    
-              print(np.shape(calibImgs))
+              logging.debug("SR calibration images of shape %s", np.shape(calibImgs))
               # SR Calibration
               self.pyb.set_sr_calib_images(calibImgs)
-              self.pyb.calibrate_sr()
+              self.get_calibration_cache().calibrate_sr(self.pyb)
+              self.settings_changed()
               
    
+    def get_post_chain(self):
+        """ Returns the chain of post-refocus stages for this process, set
+        up for the current settings: intensity (optionally inverted) or phase
+        (optionally unwrapped), followed by any stages added with 
+        add_post_stage.
+        """
+        if self.showPhase:
+            stages = [UnwrappedPhaseStage() if self.unwrapPhase else PhaseStage()]
+        else:
+            stages = [IntensityStage()]
+            if self.invert:
+                stages.append(InvertStage())
+        chain = runtime_object('postChain', StageChain)
+        chain.set_stages(stages + list(self.postStages))
+        return chain
+    
+    
+    def add_post_stage(self, stage):
+        """ Adds a PostStage to be run after refocusing. Stages with the
+        same name are replaced.
+        """
+        self.postStages = [s for s in self.postStages if s.name != stage.name] + [stage]
+        self.settings_changed()
+        
+        
+    def remove_post_stage(self, name):
+        self.postStages = [s for s in self.postStages if s.name != name]
+        self.settings_changed()
+        
+        
+    def get_quality_controller(self):
+        """ Returns the adaptive quality controller for this process.
+        """
+        controller = runtime_object('qualityController', QualityController)
+        controller.targetFps = max(float(self.targetFps), 0.1)
+        return controller
+    
+    
+    def get_calibration_cache(self):
+        return runtime_object(('calibrationCache', self.calibrationCacheFolder), lambda: CalibrationCache(self.calibrationCacheFolder))
+    
+    
+    def calibrate_bundle(self, restoreOnly = False):
+        """ Core removal calibration, restored from the calibration cache if
+        the bundle and settings match a previous calibration. If restoreOnly
+        is True and there is already a calibration, this is stored in the 
+        cache instead.
+        """
+        cache = self.get_calibration_cache()
+        if restoreOnly:
+            if getattr(self.pyb, 'calibration', None) is not None:
+                cache.store(self.pyb)
+                return False
+            if getattr(self.pyb, 'calibImage', None) is None:
+                return False
+        self.settings_changed()
+        return cache.calibrate(self.pyb)
+    
+    
+    def calibrate_bundle_sr(self):
+        """ SR calibration, restored from the calibration cache if possible.
+        """
+        self.settings_changed()
+        return self.get_calibration_cache().calibrate_sr(self.pyb)
+    
+    
     def capture_sr_shift(self):
         return pybundle.SuperRes.sort_sr_stack(self.currentInputImage, self.batchProcessNum - 1)    
         
@@ -201,12 +1209,15 @@ class InlineBundleProcessorClass(ImageProcessorClass):
     #    self.pyb.set_sr_backgrounds(backImgs)
                     
                     
-    def auto_focus(self, **kwargs):
-        
+    def auto_focus(self, roi = None, depthRange = (0, 1e-3), coarseSearchInterval = None, method = 'Brenner', margin = None, **kwargs):
+        """ Autofocus of the latest core-removed frame, see auto_focus_frame.
+        method is the focus metric, see focus_cache.focus_metric. Other 
+        keyword arguments, as used by pyholoscope, are ignored.
+        """
         if self.preProcessFrame is not None:
-            return self.holo.auto_focus(self.preProcessFrame.astype('float32'), **kwargs)
+            return self.auto_focus_frame(self.preProcessFrame, depthRange, coarseSearchInterval, roi, method, margin)
         
         
     def update_settings(self):
         """ For compatibility with multi-processor version"""
-        pass
\ No newline at end of file
+        self.settings_changed()
\ No newline at end of file
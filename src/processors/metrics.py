@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Processing Metrics
+
+A small memory-mapped file of named float values which the processor writes
+to and the GUI reads from. Since the processor may be running in a different
+process to the GUI, its attributes cannot be read directly, but both
+processes can map the same file.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+# Fields available in the metrics channel. New fields should be added at
+# the end so that existing offsets do not change.
+METRICS_FIELDS = ['updated',          # time.time() of last full update
+                  'queueDepth',       # Frames waiting in processor input queue
+                  'queueDepthMax',    # Largest queue depth seen
+                  'processTime',      # Smoothed processing time per batch, s
+                  'latency',          # Estimated queue + processing latency, s
+                  'processed',        # Number of batches processed
+                  'skipped',          # Number of batches skipped by backpressure policy
+                  'saturated',        # 1 if processing is not keeping up
+                  'frameNumber',      # Number of last frame output by processor
+                  'frameAcquired',    # Acquisition time of last frame, 0 if source does not record it
+                  'frameOutput',      # Time last frame was output by processor
+                  'latencyP50',       # Rolling acquisition (or, if not recorded, receipt) to output latency percentiles, s
+                  'latencyP90',
+                  'latencyP99',
+                  'sortTime',         # Mean time in sort_sr_stack, s
+                  'bundleTime',       # Mean time in core removal, s
+                  'refocusTime',      # Mean time in refocusing, s
+                  'particleCount',    # Particles found in last frame
+                  'trackCount',       # Tracks started since particle tracking was reset
+                  'qualityLevel',     # Adaptive quality level, 0 is full quality
+                  'postTime',         # Mean time in post-refocus stages, s
+                  'frameReceived']    # Time last frame was received by processor
+
+
+def default_metrics_file():
+    """ Returns a filename in the temp folder unique to this process.
+    """
+    return os.path.join(tempfile.gettempdir(), f"holobundle_metrics_{os.getpid()}.dat")
+
+
+class MetricsChannel:
+    """ Named float values stored in a memory-mapped file.
+
+    Arguments:
+        filename  : str, path to file
+
+    Keyword Arguments:
+        create    : boolean, if True the file is created (or reset), otherwise
+                    an existing file is opened. Default is False.
+    """
+
+    def __init__(self, filename, create = False):
+
+        self.filename = filename
+        self.fields = {name: idx for idx, name in enumerate(METRICS_FIELDS)}
+        if create or not os.path.exists(filename) or os.path.getsize(filename) != len(METRICS_FIELDS) * 8:
+            self.values = np.memmap(filename, dtype = '<f8', mode = 'w+', shape = (len(METRICS_FIELDS),))
+        else:
+            self.values = np.memmap(filename, dtype = '<f8', mode = 'r+', shape = (len(METRICS_FIELDS),))
+
+
+    def set(self, name, value):
+        self.values[self.fields[name]] = value
+
+
+    def get(self, name):
+        return float(self.values[self.fields[name]])
+
+
+    def update(self, values):
+        """ Sets several values from a dictionary.
+        """
+        for name, value in values.items():
+            self.values[self.fields[name]] = value
+
+
+    def as_dict(self):
+        return {name: float(self.values[idx]) for name, idx in self.fields.items()}
+
+
+    def close(self, remove = False):
+        """ Closes the channel, deleting the file if remove is True.
+        """
+        if self.values is not None:
+            self.values.flush()
+        self.values = None
+        if remove:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
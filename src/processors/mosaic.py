@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Refocused Image Mosaicing
+
+Builds a mosaic from refocused images as the probe is scanned. Each frame is
+registered to the previous frame by phase correlation on a downsampled copy,
+which is fast enough to keep up with live imaging on a CPU, and then blended
+into a canvas using a feathered circular weight (matching the circular
+bundle field of view).
+
+The canvas is pre-allocated and, when the mosaic reaches an edge, grows by a
+whole number of tiles so that growth (which requires a copy) is rare.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import math
+
+import numpy as np
+import scipy.fft
+import cv2 as cv
+
+from processors import fast_refocus
+
+
+class RefocusMosaic:
+    """ Mosaic of refocused images.
+
+    Keyword Arguments:
+        downsample     : int, factor frames are downsampled by for
+                         registration, default 4
+        tileSize       : int, canvas grows in multiples of this, default 256
+        initialTiles   : int, initial canvas size in tiles, default 8
+        minCorrelation : float, registrations with a normalised correlation
+                         peak below this are rejected and the frame is not
+                         added, default 0.05
+        maxShift       : float, largest shift between frames accepted, as a
+                         fraction of frame size, default 0.25
+    """
+
+    def __init__(self, downsample = 4, tileSize = 256, initialTiles = 8, minCorrelation = 0.05, maxShift = 0.25):
+
+        self.downsample = max(int(downsample), 1)
+        self.tileSize = tileSize
+        self.initialTiles = initialTiles
+        self.minCorrelation = minCorrelation
+        self.maxShift = maxShift
+        self.reset()
+
+
+    def reset(self):
+        self.canvas = None
+        self.weights = None
+        self.image = None
+        self.origin = None           # Canvas pixel at which the first frame was placed
+        self.position = (0.0, 0.0)   # Position of current frame relative to first frame (y, x)
+        self.lastFFT = None
+        self.frameShape = None
+        self.regWindow = None
+        self.blendWeight = None
+        self.numFrames = 0
+        self.numRejected = 0
+        self.lastCorrelation = 0
+
+
+    def _prepare(self, shape):
+        """ Sets up windows for a new frame size.
+        """
+        self.frameShape = shape
+        regShape = (shape[0] // self.downsample, shape[1] // self.downsample)
+        self.regShape = regShape
+        self.regWindow = fast_refocus.circular_window(regShape, None, min(regShape) / 8)
+        self.blendWeight = fast_refocus.circular_window(shape, None, min(shape) / 8) + 1e-6
+        size = self.initialTiles * self.tileSize
+        size = max(size, self.tileSize * math.ceil(2 * max(shape) / self.tileSize))
+        self.canvas = np.zeros((size, size), dtype = 'float32')
+        self.weights = np.zeros((size, size), dtype = 'float32')
+        self.image = np.zeros((size, size), dtype = 'float32')
+        self.origin = ((size - shape[0]) // 2, (size - shape[1]) // 2)
+
+
+    def _registration_fft(self, img):
+        small = cv.resize(img.astype('float32'), (self.regShape[1], self.regShape[0]), interpolation = cv.INTER_AREA)
+        small = (small - np.mean(small)) * self.regWindow
+        return scipy.fft.rfft2(small)
+
+
+    def register(self, imgFFT):
+        """ Returns (dy, dx) shift of the image content of the frame with FFT
+        imgFFT relative to the previous frame, in full resolution pixels, and
+        the height of the normalised correlation peak.
+        """
+        cross = imgFFT * np.conj(self.lastFFT)
+        cross /= np.abs(cross) + 1e-12
+        corr = scipy.fft.irfft2(cross, s = self.regShape)
+        peak = np.unravel_index(np.argmax(corr), corr.shape)
+        shift = [float(p) if p < s // 2 else float(p - s) for p, s in zip(peak, self.regShape)]
+        return shift[0] * self.downsample, shift[1] * self.downsample, float(corr[peak])
+
+
+    def _grow(self, y, x, h, w):
+        """ Grows canvas by whole tiles so that region (y, x, h, w) fits.
+        """
+        size = self.canvas.shape
+        top = self.tileSize * math.ceil(max(-y, 0) / self.tileSize)
+        left = self.tileSize * math.ceil(max(-x, 0) / self.tileSize)
+        bottom = self.tileSize * math.ceil(max(y + h - size[0], 0) / self.tileSize)
+        right = self.tileSize * math.ceil(max(x + w - size[1], 0) / self.tileSize)
+        if top == 0 and left == 0 and bottom == 0 and right == 0:
+            return 0, 0
+        newShape = (size[0] + top + bottom, size[1] + left + right)
+        for name in ('canvas', 'weights', 'image'):
+            grown = np.zeros(newShape, dtype = 'float32')
+            grown[top:top + size[0], left:left + size[1]] = getattr(self, name)
+            setattr(self, name, grown)
+        self.origin = (self.origin[0] + top, self.origin[1] + left)
+        return top, left
+
+
+    def add(self, img):
+        """ Registers img to the previous frame and blends it into the mosaic.
+        Returns True if the frame was added.
+        """
+        img = np.asarray(img)
+        if np.iscomplexobj(img):
+            img = np.abs(img)
+        if self.frameShape != np.shape(img):
+            self.reset()
+            self._prepare(np.shape(img))
+
+        imgFFT = self._registration_fft(img)
+        if self.lastFFT is not None:
+            dy, dx, self.lastCorrelation = self.register(imgFFT)
+            maxShift = self.maxShift * max(self.frameShape)
+            if self.lastCorrelation < self.minCorrelation or abs(dy) > maxShift or abs(dx) > maxShift:
+                self.numRejected = self.numRejected + 1
+                return False
+            # Image content moving by (dy, dx) means the field of view has moved
+            # by (-dy, -dx) relative to the sample
+            self.position = (self.position[0] - dy, self.position[1] - dx)
+        self.lastFFT = imgFFT
+
+        h, w = self.frameShape
+        y = self.origin[0] + int(round(self.position[0]))
+        x = self.origin[1] + int(round(self.position[1]))
+        top, left = self._grow(y, x, h, w)
+        y, x = y + top, x + left
+
+        self.canvas[y:y + h, x:x + w] += img * self.blendWeight
+        self.weights[y:y + h, x:x + w] += self.blendWeight
+        np.divide(self.canvas[y:y + h, x:x + w], self.weights[y:y + h, x:x + w], out = self.image[y:y + h, x:x + w])
+        self.numFrames = self.numFrames + 1
+        return True
+
+
+    def get_mosaic(self):
+        """ Returns current mosaic image, or None if no frames have been added.
+        """
+        return self.image
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Parameter Sweep Calibration
+
+Finds the effective pixel size or wavelength by refocusing one or more
+holograms of a calibration target over a grid of (parameter, depth) values
+and choosing the parameter for which the depths of best focus best match
+the known depths of the target.
+
+The work is shared as far as possible:
+
+    the FFT of each hologram is calculated once for the whole sweep
+    for each parameter value, the axial spatial frequency grid is calculated
+        once and shared by all depths
+    each propagator is shared by all holograms
+    parameter values are spread across threads (numpy and scipy FFTs
+        release the GIL), with each thread doing single-threaded FFTs
+
+In the angular spectrum method the focus depth scales approximately with
+pixelSize**2 / wavelength, so a single hologram at a known depth is enough
+to fit one parameter. With several holograms moved by known distances, but
+at an unknown absolute position, set fitOffset to fit the difference in
+depths only.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import math
+import concurrent.futures
+
+import numpy as np
+import scipy.fft
+
+from processors import fast_refocus
+from processors.focus_cache import focus_metric, roi_bounds
+
+PARAMETERS = ['pixelSize', 'wavelength']
+
+
+def kz_grid(shape, wavelength, pixelSize):
+    """ Returns (kz, valid) where kz is the axial spatial frequency for each
+    pixel of an unshifted FFT and valid is False for evanescent components.
+    A propagator for depth z is then exp(-2 pi i z kz) where valid, as in
+    fast_refocus.propagator.
+    """
+    fy = np.fft.fftfreq(shape[0], d = pixelSize)
+    fx = np.fft.fftfreq(shape[1], d = pixelSize)
+    arg = 1 / wavelength**2 - fx[None,:]**2 - fy[:,None]**2
+    valid = arg > 0
+    return np.sqrt(np.where(valid, arg, 0)), valid
+
+
+def peak_depth(depths, values):
+    """ Returns depth of maximum of values, refined by fitting a parabola
+    through the maximum and its neighbours.
+    """
+    best = int(np.argmax(values))
+    if best == 0 or best == len(values) - 1:
+        return float(depths[best])
+    below, peak, above = values[best - 1], values[best], values[best + 1]
+    denominator = below - 2 * peak + above
+    offset = 0.5 * (below - above) / denominator if denominator != 0 else 0
+    step = depths[best + 1] - depths[best]
+    return float(depths[best] + np.clip(offset, -0.5, 0.5) * step)
+
+
+def _evaluate(imgFFTs, wavelength, pixelSize, depths, bounds, metric):
+    """ Returns focus metric array of shape (nImages, nDepths) for one
+    parameter value.
+    """
+    shape = np.shape(imgFFTs[0])
+    kz, valid = kz_grid(shape, wavelength, pixelSize)
+    phase = (-2 * math.pi * kz).astype('float32')
+    prop = np.empty(shape, dtype = 'complex64')
+    buffer = np.empty(shape, dtype = 'complex64')
+    y0, y1, x0, x1 = bounds
+    values = np.zeros((len(imgFFTs), len(depths)))
+    for depthIdx, depth in enumerate(depths):
+        np.exp(1j * (phase * np.float32(depth)), out = prop)
+        prop[~valid] = 0
+        for imgIdx, imgFFT in enumerate(imgFFTs):
+            np.multiply(imgFFT, prop, out = buffer)
+            field = scipy.fft.ifft2(buffer, workers = 1, overwrite_x = True)
+            values[imgIdx, depthIdx] = focus_metric(np.abs(field[y0:y1, x0:x1]), metric)
+    return values
+
+
+def focus_grid(imgFFTs, param, values, depths, wavelength, pixelSize, roi = None, metric = 'Brenner', numWorkers = None):
+    """ Returns focus metric array of shape (nValues, nImages, nDepths) for
+    holograms with FFTs imgFFTs, with param ('pixelSize' or 'wavelength')
+    set to each of values and the other parameter fixed.
+    """
+    if param not in PARAMETERS:
+        raise ValueError(f"Cannot sweep {param}, must be one of {PARAMETERS}.")
+    bounds = roi_bounds(roi, np.shape(imgFFTs[0]))
+
+    def evaluate(value):
+        if param == 'pixelSize':
+            return _evaluate(imgFFTs, wavelength, value, depths, bounds, metric)
+        return _evaluate(imgFFTs, value, pixelSize, depths, bounds, metric)
+
+    numWorkers = numWorkers or os.cpu_count()
+    if numWorkers <= 1:
+        return np.stack([evaluate(value) for value in values])
+    with concurrent.futures.ThreadPoolExecutor(numWorkers) as pool:
+        return np.stack(list(pool.map(evaluate, values)))
+
+
+def sweep(holograms, param, values, depths, wavelength, pixelSize, knownDepths = None, fitOffset = False,
+          window = None, background = None, roi = None, metric = 'Brenner', numWorkers = None):
+    """ Sweeps param over values and finds the best fitting value.
+
+    Arguments:
+        holograms   : core-removed hologram, or list of holograms
+        param       : 'pixelSize' or 'wavelength'
+        values      : 1D array of values of param to try
+        depths      : 1D array of depths to refocus to, in m
+        wavelength  : float, wavelength in m (ignored if param is wavelength)
+        pixelSize   : float, pixel size in m (ignored if param is pixelSize)
+
+    Keyword Arguments:
+        knownDepths : depth, or list of depths, of the target in each
+                      hologram. If None, the value giving the sharpest focus
+                      is chosen instead.
+        fitOffset   : boolean, if True only the differences between known
+                      depths are fitted, default False
+        window      : window applied to holograms before refocusing
+        background  : background subtracted from holograms
+        roi         : region to assess focus in, see focus_cache.roi_bounds
+        metric      : str, see focus_cache.focus_metric
+        numWorkers  : int, threads used, default is number of cores
+
+    Returns:
+        dictionary of 'value' (best fitting value), 'values', 'depths',
+        'grid' (focus metric, nValues x nImages x nDepths), 'focusDepths'
+        (best focus depth, nValues x nImages) and 'error' (RMS depth error
+        for each value, or None if knownDepths is None)
+    """
+    if np.ndim(holograms) == 2:
+        holograms = [holograms]
+    values = np.asarray(values, dtype = 'float64')
+    depths = np.asarray(depths, dtype = 'float64')
+    imgFFTs = [fast_refocus.hologram_fft(np.asarray(img, dtype = 'float32'), window, background) for img in holograms]
+    grid = focus_grid(imgFFTs, param, values, depths, wavelength, pixelSize, roi, metric, numWorkers)
+    focusDepths = np.array([[peak_depth(depths, grid[v, i]) for i in range(len(imgFFTs))] for v in range(len(values))])
+
+    error = None
+    if knownDepths is None:
+        best = int(np.argmax(np.max(grid, axis = 2).sum(axis = 1)))
+        bestValue = float(values[best])
+    else:
+        residual = focusDepths - np.reshape(np.asarray(knownDepths, dtype = 'float64'), (1, -1))
+        if fitOffset:
+            residual = residual - np.mean(residual, axis = 1, keepdims = True)
+        error = np.sqrt(np.mean(residual**2, axis = 1))
+        bestValue = -peak_depth(-values, -error) if len(values) > 2 and np.all(np.diff(values) > 0) else float(values[np.argmin(error)])
+    return {'value': bestValue, 'values': values, 'depths': depths, 'grid': grid,
+            'focusDepths': focusDepths, 'error': error}
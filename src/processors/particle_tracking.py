@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+3D Particle Localisation and Tracking
+
+Finds particles in 3D by refocusing a hologram to a range of depths and
+looking for peaks in a focus metric in (x, y, z). The hologram FFT is
+calculated once and shared by all depths, so each plane costs one multiply
+and one inverse FFT. Particles found in successive frames can be linked into
+tracks by nearest neighbour matching.
+
+The focus metric is calculated per pixel from the refocused amplitude as the
+local contrast (absolute deviation from the local mean), averaged over a
+small region. Both dark (absorbing) and bright particles give a peak at
+their in-focus depth.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import numpy as np
+import scipy.ndimage
+import scipy.spatial
+
+from processors import fast_refocus
+
+# Column names of particle tables
+PARTICLE_COLUMNS = ['frame', 'x', 'y', 'z', 'metric', 'track']
+
+
+class ParticleLocator:
+    """ Locates particles in 3D from a single hologram.
+
+    Keyword Arguments:
+        depthRange   : tuple of (min, max) depth to search, in m
+        numDepths    : int, number of planes, default 20
+        regionSize   : int, size in pixels of region metric is averaged
+                       over, and the minimum separation of particles, default 9
+        threshold    : float, minimum metric, as a multiple of the median
+                       metric over the volume, for a peak to be a particle,
+                       default 3
+        maxParticles : int, maximum particles returned per frame, default 500
+        downsample   : int, factor to downsample metric by laterally before
+                       peak finding, to speed up live use, default 1
+    """
+
+    def __init__(self, depthRange = (0, 1e-3), numDepths = 20, regionSize = 9, threshold = 3,
+                 maxParticles = 500, downsample = 1):
+
+        self.depthRange = depthRange
+        self.numDepths = numDepths
+        self.regionSize = regionSize
+        self.threshold = threshold
+        self.maxParticles = maxParticles
+        self.downsample = max(int(downsample), 1)
+        self.propagators = {}
+
+
+    def get_propagators(self, shape, wavelength, pixelSize):
+        """ Returns list of propagators for each depth. These are cached since
+        the depths normally stay the same from frame to frame.
+        """
+        key = (tuple(shape), wavelength, pixelSize, tuple(self.depthRange), self.numDepths)
+        if key not in self.propagators:
+            self.propagators = {key: [fast_refocus.propagator(shape, wavelength, pixelSize, depth) for depth in self.depths()]}
+        return self.propagators[key]
+
+
+    def depths(self):
+        return np.linspace(self.depthRange[0], self.depthRange[1], self.numDepths)
+
+
+    def focus_metric(self, amplitude):
+        """ Returns per-pixel focus metric for one refocused amplitude image.
+        """
+        size = self.regionSize
+        localMean = scipy.ndimage.uniform_filter(amplitude, size)
+        metric = scipy.ndimage.uniform_filter(np.abs(amplitude - localMean), size)
+        if self.downsample > 1:
+            h, w = np.shape(metric)
+            d = self.downsample
+            metric = metric[:h // d * d, :w // d * d].reshape(h // d, d, w // d, d).mean(axis = (1, 3))
+        return metric
+
+
+    def metric_volume(self, imgFFT, wavelength, pixelSize, planes = None):
+        """ Returns focus metric volume of shape (numDepths, h, w) from the
+        FFT of a hologram. If planes is given, it is called with each depth
+        to get the refocused amplitude, e.g. from a FocusCache, rather than
+        refocusing here.
+        """
+        shape = np.shape(imgFFT)
+        buffer = np.empty(shape, dtype = 'complex64')
+        volume = None
+        propagators = None if planes is not None else self.get_propagators(shape, wavelength, pixelSize)
+        for idx, depth in enumerate(self.depths()):
+            if planes is not None:
+                amplitude = planes(depth)
+            else:
+                amplitude = np.abs(fast_refocus.propagate(imgFFT, propagators[idx], out = buffer))
+            metric = self.focus_metric(amplitude)
+            if volume is None:
+                volume = np.zeros((self.numDepths,) + np.shape(metric), dtype = 'float32')
+            volume[idx] = metric
+        return volume
+
+
+    def find_peaks(self, volume):
+        """ Returns array of (x, y, zIndex, metric) for local maxima in the
+        metric volume above threshold.
+        """
+        separation = max(self.regionSize // self.downsample, 1)
+        localMax = scipy.ndimage.maximum_filter(volume, size = (3, separation, separation), mode = 'nearest')
+        threshold = self.threshold * np.median(volume)
+        peaks = np.argwhere((volume == localMax) & (volume > threshold))
+        
+        # A maximum in the first or last plane may just be the edge of the
+        # search range rather than a particle in focus
+        if len(volume) > 2:
+            peaks = peaks[(peaks[:,0] > 0) & (peaks[:,0] < len(volume) - 1)]
+        if len(peaks) == 0:
+            return np.zeros((0, 4))
+        metrics = volume[peaks[:,0], peaks[:,1], peaks[:,2]]
+        order = np.argsort(metrics)[::-1][:self.maxParticles]
+        peaks, metrics = peaks[order], metrics[order]
+        x = peaks[:,2] * self.downsample + (self.downsample - 1) / 2
+        y = peaks[:,1] * self.downsample + (self.downsample - 1) / 2
+        return np.column_stack((x, y, peaks[:,0], metrics))
+
+
+    def locate(self, imgFFT, wavelength, pixelSize, frame = 0, planes = None):
+        """ Returns particle table for one frame as a float array with columns
+        PARTICLE_COLUMNS. x and y are in pixels, z is in m. Tracks are set
+        to -1 (not linked).
+
+        Arguments:
+            imgFFT     : FFT of windowed hologram, as from
+                         fast_refocus.hologram_fft
+            wavelength : float, in m
+            pixelSize  : float, in m
+
+        Keyword Arguments:
+            frame      : int, frame number stored in table
+            planes     : function returning refocused amplitude at a depth,
+                         see metric_volume
+        """
+        peaks = self.find_peaks(self.metric_volume(imgFFT, wavelength, pixelSize, planes))
+        depths = self.depths()
+        table = np.zeros((len(peaks), len(PARTICLE_COLUMNS)))
+        table[:,0] = frame
+        table[:,1] = peaks[:,0]
+        table[:,2] = peaks[:,1]
+        table[:,3] = depths[peaks[:,2].astype(int)] if len(peaks) > 0 else []
+        table[:,4] = peaks[:,3]
+        table[:,5] = -1
+        return table
+
+
+
+class ParticleTracker:
+    """ Links particle tables from successive frames into tracks by nearest
+    neighbour matching in 3D.
+
+    Keyword Arguments:
+        maxDistance : float, largest movement in pixels between frames for
+                      a particle to be linked, default 10
+        zScale      : float, pixels per m used to scale z when measuring
+                      distance, default 1 / pixel size is a good choice
+        maxGap      : int, number of frames a track can go without a match
+                      before it is ended, default 2
+    """
+
+    def __init__(self, maxDistance = 10, zScale = 1e6, maxGap = 2):
+
+        self.maxDistance = maxDistance
+        self.zScale = zScale
+        self.maxGap = maxGap
+        self.reset()
+
+
+    def reset(self):
+        self.active = np.zeros((0, len(PARTICLE_COLUMNS)))
+        self.lastSeen = np.zeros(0, dtype = int)
+        self.nextTrack = 0
+
+
+    def link(self, table):
+        """ Sets track column of particle table, linking to active tracks, and
+        returns the table.
+        """
+        if len(table) == 0:
+            return table
+        frame = table[0,0]
+        track = np.full(len(table), -1)
+
+        # Tracks not seen for more than maxGap frames have ended
+        current = frame - self.lastSeen <= self.maxGap
+        self.active, self.lastSeen = self.active[current], self.lastSeen[current]
+        if len(self.active) > 0:
+            scale = np.array([1, 1, self.zScale])
+            tree = scipy.spatial.cKDTree(self.active[:,1:4] * scale)
+            dist, nearest = tree.query(table[:,1:4] * scale, distance_upper_bound = self.maxDistance)
+            # Closest matches first, each active track used only once
+            used = set()
+            for idx in np.argsort(dist):
+                if np.isfinite(dist[idx]) and nearest[idx] not in used:
+                    used.add(nearest[idx])
+                    track[idx] = self.active[nearest[idx], 5]
+        newTracks = track < 0
+        track[newTracks] = np.arange(self.nextTrack, self.nextTrack + np.count_nonzero(newTracks))
+        self.nextTrack = self.nextTrack + np.count_nonzero(newTracks)
+        table[:,5] = track
+
+        # Update active tracks with latest positions
+        matched = np.isin(self.active[:,5], track) if len(self.active) > 0 else np.zeros(0, dtype = bool)
+        keep = ~matched
+        self.active = np.vstack((self.active[keep], table))
+        self.lastSeen = np.concatenate((self.lastSeen[keep], np.full(len(table), frame, dtype = int)))
+        return table
+
+
+
+class ParticleTableWriter:
+    """ Appends particle tables to a CSV file, one row per particle.
+
+    Arguments:
+        filename : str, path to CSV file. If it already exists, rows are
+                   appended.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.file = open(filename, 'a')
+        if self.file.tell() == 0:
+            self.file.write(','.join(PARTICLE_COLUMNS) + '\n')
+
+
+    def write(self, table):
+        for row in table:
+            self.file.write(f"{int(row[0])},{row[1]:.2f},{row[2]:.2f},{row[3]:.6e},{row[4]:.6g},{int(row[5])}\n")
+        self.file.flush()
+
+
+    def close(self):
+        self.file.close()
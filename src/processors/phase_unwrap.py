@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Fast Phase Unwrapping
+
+Unweighted least-squares phase unwrapping by the discrete cosine transform
+(Ghiglia and Romero), fast enough to run on every frame of a live phase
+display.
+
+The wrapped phase differences between neighbouring pixels are taken
+directly from the complex field, as the angle of field * conj(neighbour),
+so the wrapped phase itself is never needed. Their divergence is then
+solved for the unwrapped phase with one forward and one inverse DCT, using
+the same FFT workers as refocusing. The DCT denominator and the working
+buffers depend only on the image size, and so are calculated once and kept,
+one set per thread.
+
+The result is defined up to a constant and is returned with mean zero.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import threading
+
+import numpy as np
+import scipy.fft
+
+from processors.fast_refocus import FFT_WORKERS
+
+_local = threading.local()
+
+
+class PhaseUnwrapper:
+    """ DCT least-squares unwrapper for images of one size.
+
+    Arguments:
+        shape : tuple of (height, width)
+    """
+
+    def __init__(self, shape):
+
+        self.shape = tuple(shape[:2])
+        h, w = self.shape
+        denominator = (2 * np.cos(np.pi * np.arange(h) / h)[:, None]
+                       + 2 * np.cos(np.pi * np.arange(w) / w)[None, :] - 4)
+        denominator[0, 0] = 1       # Mean phase is undefined, set to 0 below
+        self.inverseDenominator = (1 / denominator).astype('float32')
+        self.dx = np.empty((h, w - 1), dtype = 'float32')
+        self.dy = np.empty((h - 1, w), dtype = 'float32')
+        self.divergence = np.empty((h, w), dtype = 'float32')
+        self.product = np.empty((max(h, w), max(h, w)), dtype = 'complex64')
+
+
+    def _wrapped_gradients(self, img):
+        """ Fills self.dx and self.dy with wrapped phase differences along x
+        and y, from a complex field or from a wrapped phase.
+        """
+        h, w = self.shape
+        if np.iscomplexobj(img):
+            product = self.product[:h, :w - 1]
+            np.multiply(img[:, 1:], np.conj(img[:, :-1]), out = product)
+            np.arctan2(product.imag, product.real, out = self.dx)
+            product = self.product[:h - 1, :w]
+            np.multiply(img[1:, :], np.conj(img[:-1, :]), out = product)
+            np.arctan2(product.imag, product.real, out = self.dy)
+        else:
+            for d, diff in ((self.dx, np.diff(img, axis = 1)), (self.dy, np.diff(img, axis = 0))):
+                np.add(diff, np.pi, out = d, casting = 'unsafe')
+                np.mod(d, 2 * np.pi, out = d)
+                np.subtract(d, np.pi, out = d)
+
+
+    def unwrap(self, img):
+        """ Returns unwrapped phase of img, which is either a complex field or
+        a wrapped phase in radians, as a new float32 array with mean zero.
+        """
+        self._wrapped_gradients(img)
+        dx, dy, rho = self.dx, self.dy, self.divergence
+
+        # Divergence of the wrapped gradients, with Neumann boundaries
+        rho[:] = 0
+        rho[:, :-1] += dx
+        rho[:, 1:] -= dx
+        rho[:-1, :] += dy
+        rho[1:, :] -= dy
+
+        phase = scipy.fft.dctn(rho, type = 2, workers = FFT_WORKERS)
+        np.multiply(phase, self.inverseDenominator, out = phase)
+        phase[0, 0] = 0
+        return scipy.fft.idctn(phase, type = 2, workers = FFT_WORKERS, overwrite_x = True).astype('float32', copy = False)
+
+
+
+def unwrap_phase(img):
+    """ Returns unwrapped phase of img (complex field or wrapped phase) as
+    float32, reusing the unwrapper for this image size and thread.
+    """
+    unwrappers = getattr(_local, 'unwrappers', None)
+    if unwrappers is None:
+        unwrappers = _local.unwrappers = {}
+    shape = np.shape(img)[:2]
+    if shape not in unwrappers:
+        unwrappers.clear()
+        unwrappers[shape] = PhaseUnwrapper(shape)
+    return unwrappers[shape].unwrap(img)
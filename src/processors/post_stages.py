@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Post-Refocus Stages
+
+Processing applied to the refocused field, such as taking the intensity or
+phase, inverting, filtering or making measurements, is done by a chain of
+PostStage objects. New processing can be added by subclassing PostStage and
+passing an instance to InlineBundleProcessorClass.add_post_stage, rather than
+by editing the processor.
+
+Each stage declares the dtype it accepts and the dtype it returns, and
+whether it works in place. Stages which change dtype (e.g. complex to
+float32) write into a new array, and later in-place stages then reuse this
+array, so no further arrays are allocated. The chain never modifies the
+image it is given, which may be held in the stage cache, so an in-place
+stage acting on this is given a copy.
+
+Stages which only make measurements, and do not change the image, can set
+every to run on only every Nth frame, or threaded to run in a background
+thread on the final image. The result of a measurement stage is kept in
+StageChain.results.
+
+Every stage is timed, and StageChain.times holds the smoothed time taken by
+each, in s.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import time
+import concurrent.futures
+
+import numpy as np
+
+from processors.phase_unwrap import unwrap_phase
+
+
+class PostStage:
+    """ Base class for post-refocus stages. Subclasses override process.
+
+    Class attributes:
+        name        : str, used for timings and results
+        inputDtype  : dtype image is converted to before process is called,
+                      or None to accept any
+        outputDtype : dtype returned by process, or None if the same as input
+        inPlace     : boolean, True if process modifies and returns its input
+        measurement : boolean, True if the stage does not change the image and
+                      its return value is a result to store instead
+        every       : int, measurement stages run every Nth frame
+        threaded    : boolean, measurement stage runs in a background thread
+    """
+
+    name = 'stage'
+    inputDtype = None
+    outputDtype = None
+    inPlace = False
+    measurement = False
+    every = 1
+    threaded = False
+
+    def process(self, img):
+        return img
+
+
+
+class IntensityStage(PostStage):
+    """ Amplitude of complex field, as float32.
+    """
+    name = 'intensity'
+    outputDtype = 'float32'
+
+    def process(self, img):
+        if np.iscomplexobj(img):
+            out = np.empty(np.shape(img), dtype = 'float32')
+            np.abs(img, out = out, casting = 'unsafe')
+            return out
+        return np.abs(img).astype('float32', copy = False)
+
+
+
+class PhaseStage(PostStage):
+    """ Phase of complex field in radians, as float32.
+    """
+    name = 'phase'
+    outputDtype = 'float32'
+
+    def process(self, img):
+        return np.angle(img).astype('float32', copy = False)
+
+
+
+class UnwrappedPhaseStage(PostStage):
+    """ Unwrapped phase of complex field in radians, mean zero, as float32.
+    See phase_unwrap.
+    """
+    name = 'unwrappedPhase'
+    outputDtype = 'float32'
+
+    def process(self, img):
+        return unwrap_phase(img)
+
+
+
+class InvertStage(PostStage):
+    """ Subtracts the image from its maximum, in place.
+    """
+    name = 'invert'
+    inputDtype = 'float32'
+    outputDtype = 'float32'
+    inPlace = True
+
+    def process(self, img):
+        return np.subtract(np.max(img), img, out = img)
+
+
+
+class StageChain:
+    """ Runs a list of PostStage objects on each frame.
+    """
+
+    smoothing = 0.1      # Weight of newest frame in smoothed stage times
+
+    def __init__(self):
+
+        self.stages = []
+        self.times = {}
+        self.results = {}
+        self.frameCount = 0
+        self.pending = {}
+        self.executor = None
+
+
+    def set_stages(self, stages):
+        """ Sets the list of stages. Timings and results of stages with the
+        same name as before are kept.
+        """
+        self.stages = list(stages)
+        names = [stage.name for stage in self.stages]
+        self.times = {name: t for name, t in self.times.items() if name in names}
+
+
+    def _time(self, name, elapsed):
+        previous = self.times.get(name)
+        self.times[name] = elapsed if previous is None else self.smoothing * elapsed + (1 - self.smoothing) * previous
+
+
+    def _run_stage(self, stage, img, owned = True):
+        t0 = time.perf_counter()
+        if stage.inputDtype is not None and img.dtype != np.dtype(stage.inputDtype):
+            img = img.astype(stage.inputDtype)
+        elif stage.inPlace and not owned:
+            img = img.copy()
+        out = stage.process(img)
+        self._time(stage.name, time.perf_counter() - t0)
+        return out
+
+
+    def _measure(self, stage, img):
+        self.results[stage.name] = self._run_stage(stage, img)
+
+
+    def run(self, img):
+        """ Passes img through each stage and returns the final image.
+        """
+        self.frameCount = self.frameCount + 1
+        measurements = []
+        original = img
+        for stage in self.stages:
+            if stage.measurement:
+                measurements.append(stage)
+            else:
+                img = self._run_stage(stage, img, img is not original)
+
+        # Measurements use the final image, which is not modified after this
+        for stage in measurements:
+            if (self.frameCount - 1) % max(int(stage.every), 1) != 0:
+                continue
+            if stage.threaded:
+                # If the last run of this stage has not finished, skip it
+                future = self.pending.get(stage.name)
+                if future is not None and not future.done():
+                    continue
+                if self.executor is None:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(1)
+                self.pending[stage.name] = self.executor.submit(self._measure, stage, img)
+            else:
+                self._measure(stage, img)
+        return img
+
+
+    def total_time(self):
+        """ Sum of smoothed times of stages run in line with processing.
+        """
+        return sum(self.times.get(stage.name, 0) for stage in self.stages if not stage.threaded)
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait = False)
+            self.executor = None
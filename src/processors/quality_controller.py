@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Adaptive Quality Controller
+
+Watches the time taken to process each frame and, if this is too long to
+keep up with a target frame rate, steps down through a list of quality
+levels, and steps back up when there is spare time. Each level sets:
+
+    refocusScale : factor the hologram is downsampled by before refocusing,
+                   the field is upsampled back so the output size is fixed
+    stageEvery   : only every Nth frame (or SR sequence) is processed
+
+Changing the core removal grid size would require a new calibration, so is
+not used. Hysteresis (different thresholds and frame counts for stepping
+down and up) stops the level oscillating. Full quality is restored when
+processing is idle (no frames for a while) or paused (the same frame being
+reprocessed, e.g. after a settings change).
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import time
+
+# (refocusScale, stageEvery) for each level, from full quality down
+QUALITY_LEVELS = [(1, 1), (2, 1), (2, 2), (4, 2), (4, 3), (4, 4)]
+
+
+class QualityController:
+    """ Chooses quality level to hold a target frame rate.
+
+    Keyword Arguments:
+        targetFps   : float, frame rate to hold, default 20
+        levels      : list of (refocusScale, stageEvery), default QUALITY_LEVELS
+        downFrames  : int, consecutive slow frames before stepping down,
+                      default 3
+        upFrames    : int, consecutive fast frames before stepping up,
+                      default 30
+        upMargin    : float, frames must take less than this fraction of the
+                      time that would be available at the next level up,
+                      default 0.7
+        idleTime    : float, time in s with no frames after which full quality
+                      is restored, default 1
+        retryTime   : float, after stepping down from a level, time in s 
+                      before trying that level again, default 10
+    """
+
+    smoothing = 0.3      # Weight of newest frame in smoothed process time
+
+    def __init__(self, targetFps = 20, levels = QUALITY_LEVELS, downFrames = 3, upFrames = 30, upMargin = 0.7, idleTime = 1, retryTime = 10):
+
+        self.targetFps = targetFps
+        self.levels = list(levels)
+        self.downFrames = downFrames
+        self.upFrames = upFrames
+        self.upMargin = upMargin
+        self.idleTime = idleTime
+        self.retryTime = retryTime
+        self.reset()
+
+
+    def reset(self):
+        """ Restores full quality.
+        """
+        self.level = 0
+        self.processTime = None
+        self.slowCount = 0
+        self.fastCount = 0
+        self.frameCount = 0
+        self.lastFrameTime = None
+        self.failedAt = {}
+
+
+    def budget(self, level = None):
+        """ Time available to process one frame processed at level.
+        """
+        level = self.level if level is None else level
+        return self.levels[level][1] / self.targetFps
+
+
+    def settings(self):
+        """ Returns (refocusScale, stageEvery) for current level.
+        """
+        return self.levels[self.level]
+
+
+    def accept(self, paused = False):
+        """ Called for each incoming frame. Returns True if this frame should
+        be processed at the current level.
+        """
+        now = time.perf_counter()
+        if paused or (self.lastFrameTime is not None and now - self.lastFrameTime > self.idleTime):
+            self.reset()
+        self.lastFrameTime = now
+        self.frameCount = self.frameCount + 1
+        return paused or (self.frameCount % self.levels[self.level][1]) == 0
+
+
+    def record(self, processTime):
+        """ Records the time taken to process a frame and changes level if
+        needed.
+        """
+        if self.processTime is None:
+            self.processTime = processTime
+        else:
+            self.processTime = self.smoothing * processTime + (1 - self.smoothing) * self.processTime
+
+        if self.processTime > self.budget():
+            self.slowCount = self.slowCount + 1
+            self.fastCount = 0
+        elif self.level > 0 and self.processTime < self.upMargin * self.budget(self.level - 1) \
+             and time.perf_counter() - self.failedAt.get(self.level - 1, -self.retryTime) > self.retryTime:
+            self.fastCount = self.fastCount + 1
+            self.slowCount = 0
+        else:
+            self.slowCount = 0
+            self.fastCount = 0
+
+        if self.slowCount >= self.downFrames and self.level < len(self.levels) - 1:
+            self.failedAt[self.level] = time.perf_counter()
+            self.set_level(self.level + 1)
+        elif self.fastCount >= self.upFrames and self.level > 0:
+            self.set_level(self.level - 1)
+
+
+    def set_level(self, level):
+        self.level = level
+        self.slowCount = 0
+        self.fastCount = 0
+        self.processTime = None
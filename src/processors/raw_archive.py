@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Raw Hologram Archive
+
+Append-only archive of raw camera frames written during acquisition. Since
+holograms can be refocused after capture it is more useful to keep the raw
+frames than refocused images.
+
+An archive is a folder containing:
+    header.json    : frame shape and dtype
+    frames.raw     : raw frame data, one frame after another
+    index.raw      : one fixed-size record per frame (timestamp, LED index,
+                     sequence number, settings id)
+    settings.jsonl : one line of JSON for each set of processing settings used
+
+Because every frame is the same size, frame N is at a fixed offset in
+frames.raw, and so random access through a memory map takes constant time
+regardless of the length of the archive.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import json
+import time
+
+import numpy as np
+
+HEADER_FILE = 'header.json'
+FRAMES_FILE = 'frames.raw'
+INDEX_FILE = 'index.raw'
+SETTINGS_FILE = 'settings.jsonl'
+
+INDEX_DTYPE = np.dtype([('timestamp', '<f8'),
+                        ('led', '<i4'),
+                        ('sequence', '<i8'),
+                        ('settings', '<i4')])
+
+# LED index stored for frames where there is no LED sequence
+NO_LED = -1
+
+
+def sr_led_indices(stack):
+    """ Returns LED index for each frame of a raw (unsorted) SR stack of shape
+    (h, w, n). The darkest frame is the blank reference frame, which is given
+    NO_LED, and subsequent frames (cyclically) are LEDs 0, 1, 2...
+    """
+    nFrames = np.shape(stack)[2]
+    blank = int(np.argmin(np.mean(stack, axis = (0,1))))
+    leds = (np.arange(nFrames) - blank - 1) % nFrames
+    leds[blank] = NO_LED
+    return leds
+
+
+class RawArchiveWriter:
+    """ Appends raw frames to an archive folder. If the folder already contains
+    an archive, frames are appended to the end of it.
+
+    Arguments:
+        folder     : str, path to archive folder, created if does not exist
+    """
+
+    flushInterval = 1       # Seconds between flushes to disk
+
+    def __init__(self, folder):
+
+        self.folder = folder
+        os.makedirs(folder, exist_ok = True)
+
+        self.shape = None
+        self.dtype = None
+        self.numFrames = 0
+        self.numSequences = 0
+        self.settingsId = -1
+        self.lastSettings = None
+        self.lastFlush = time.perf_counter()
+
+        headerFile = os.path.join(folder, HEADER_FILE)
+        if os.path.exists(headerFile):
+            with open(headerFile, 'r') as f:
+                header = json.load(f)
+            self.shape = tuple(header['shape'])
+            self.dtype = np.dtype(header['dtype'])
+            self._trim()
+            index = self._read_index()
+            if len(index) > 0:
+                self.numSequences = int(index['sequence'][-1]) + 1
+            self.settingsId, self.lastSettings = self._read_last_settings()
+
+        self.framesFile = open(os.path.join(folder, FRAMES_FILE), 'ab')
+        self.indexFile = open(os.path.join(folder, INDEX_FILE), 'ab')
+        self.settingsFile = open(os.path.join(folder, SETTINGS_FILE), 'a')
+
+
+    def _trim(self):
+        """ Truncates frames and index to the same whole number of frames,
+        in case a previous run stopped part way through writing a frame.
+        """
+        frameBytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        framesFile = os.path.join(self.folder, FRAMES_FILE)
+        indexFile = os.path.join(self.folder, INDEX_FILE)
+        nFrames = os.path.getsize(framesFile) // frameBytes if os.path.exists(framesFile) else 0
+        nIndex = os.path.getsize(indexFile) // INDEX_DTYPE.itemsize if os.path.exists(indexFile) else 0
+        self.numFrames = min(nFrames, nIndex)
+        for file, size in ((framesFile, self.numFrames * frameBytes), (indexFile, self.numFrames * INDEX_DTYPE.itemsize)):
+            if os.path.exists(file) and os.path.getsize(file) != size:
+                with open(file, 'r+b') as f:
+                    f.truncate(size)
+
+
+    def _read_index(self):
+        indexFile = os.path.join(self.folder, INDEX_FILE)
+        if self.numFrames == 0:
+            return np.zeros(0, dtype = INDEX_DTYPE)
+        return np.fromfile(indexFile, dtype = INDEX_DTYPE, count = self.numFrames)
+
+
+    def _read_last_settings(self):
+        settingsFile = os.path.join(self.folder, SETTINGS_FILE)
+        settingsId, settings = -1, None
+        if os.path.exists(settingsFile):
+            with open(settingsFile, 'r') as f:
+                for line in f:
+                    if line.strip() != '':
+                        entry = json.loads(line)
+                        settingsId, settings = entry['id'], entry['settings']
+        return settingsId, settings
+
+
+    def _write_header(self, frame):
+        self.shape = tuple(int(x) for x in np.shape(frame))
+        self.dtype = frame.dtype
+        with open(os.path.join(self.folder, HEADER_FILE), 'w') as f:
+            json.dump({'shape': self.shape, 'dtype': self.dtype.str, 'version': 1}, f)
+
+
+    def set_settings(self, settings):
+        """ Records the processing settings in use for subsequent frames. A new
+        settings entry is only written if the settings have changed.
+
+        Arguments:
+            settings : dict, must be serialisable to JSON
+        """
+        if settings != self.lastSettings:
+            self.settingsId = self.settingsId + 1
+            self.settingsFile.write(json.dumps({'id': self.settingsId, 'time': time.time(), 'settings': settings}) + '\n')
+            self.settingsFile.flush()
+            self.lastSettings = settings
+
+
+    def add_frame(self, frame, led = NO_LED, timestamp = None, sequence = None):
+        """ Appends a single 2D frame to the archive.
+
+        Arguments:
+            frame     : 2D numpy array
+
+        Keyword Arguments:
+            led       : int, LED index for frame, default is NO_LED
+            timestamp : float, time of frame, default is current time
+            sequence  : int, sequence number frame belongs to, default is to
+                        start a new sequence
+        """
+        if self.shape is None:
+            self._write_header(frame)
+        if tuple(np.shape(frame)) != self.shape or frame.dtype != self.dtype:
+            raise ValueError(f"Frame of shape {np.shape(frame)} and type {frame.dtype} does not match archive of shape {self.shape} and type {self.dtype}.")
+        if timestamp is None:
+            timestamp = time.time()
+        if sequence is None:
+            sequence = self.numSequences
+        self.numSequences = max(self.numSequences, sequence + 1)
+
+        self.framesFile.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+        record = np.array((timestamp, led, sequence, self.settingsId), dtype = INDEX_DTYPE)
+        self.indexFile.write(record.tobytes())
+        self.numFrames = self.numFrames + 1
+
+        if time.perf_counter() - self.lastFlush > self.flushInterval:
+            self.flush()
+
+        return self.numFrames - 1
+
+
+    def add_stack(self, stack, leds = None, timestamp = None):
+        """ Appends a stack of frames of shape (h, w, n), such as an SR or
+        differential batch, as a single sequence.
+
+        Arguments:
+            stack     : 3D numpy array
+
+        Keyword Arguments:
+            leds      : list/array of LED index for each frame, default is
+                        position in stack
+            timestamp : float, time of frames, default is current time
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        nFrames = np.shape(stack)[2]
+        if leds is None:
+            leds = range(nFrames)
+        sequence = self.numSequences
+        for idx in range(nFrames):
+            self.add_frame(stack[:,:,idx], led = int(leds[idx]), timestamp = timestamp, sequence = sequence)
+
+
+    def flush(self):
+        self.framesFile.flush()
+        self.indexFile.flush()
+        self.lastFlush = time.perf_counter()
+
+
+    def close(self):
+        self.flush()
+        self.framesFile.close()
+        self.indexFile.close()
+        self.settingsFile.close()
+
+
+
+class RawArchive:
+    """ Read access to a raw archive. Frames are memory mapped and so are only
+    read from disk when accessed.
+
+    Arguments:
+        folder     : str, path to archive folder
+    """
+
+    def __init__(self, folder):
+
+        self.folder = folder
+        with open(os.path.join(folder, HEADER_FILE), 'r') as f:
+            header = json.load(f)
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.frameBytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.frames = None
+        self.index = None
+        self.numFrames = 0
+        self.refresh()
+
+
+    def refresh(self):
+        """ Re-maps the archive files to pick up any frames written since the
+        archive was opened.
+        """
+        nFrames = os.path.getsize(os.path.join(self.folder, FRAMES_FILE)) // self.frameBytes
+        nIndex = os.path.getsize(os.path.join(self.folder, INDEX_FILE)) // INDEX_DTYPE.itemsize
+        self.numFrames = min(nFrames, nIndex)
+        if self.numFrames > 0:
+            self.frames = np.memmap(os.path.join(self.folder, FRAMES_FILE), dtype = self.dtype,
+                                    mode = 'r', shape = (self.numFrames,) + self.shape)
+            self.index = np.memmap(os.path.join(self.folder, INDEX_FILE), dtype = INDEX_DTYPE,
+                                   mode = 'r', shape = (self.numFrames,))
+        else:
+            self.frames = np.zeros((0,) + self.shape, dtype = self.dtype)
+            self.index = np.zeros(0, dtype = INDEX_DTYPE)
+
+
+    def __len__(self):
+        return self.numFrames
+
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+
+    def get_frame(self, idx):
+        """ Returns frame idx as a read-only memory mapped array.
+        """
+        return self.frames[idx]
+
+
+    def get_timestamp(self, idx):
+        return float(self.index['timestamp'][idx])
+
+
+    def get_led(self, idx):
+        return int(self.index['led'][idx])
+
+
+    def get_settings(self, idx = None):
+        """ Returns the settings dictionary in use for frame idx, or a dictionary
+        of all settings, keyed by id, if idx is None.
+        """
+        allSettings = {}
+        with open(os.path.join(self.folder, SETTINGS_FILE), 'r') as f:
+            for line in f:
+                if line.strip() != '':
+                    entry = json.loads(line)
+                    allSettings[entry['id']] = entry['settings']
+        if idx is None:
+            return allSettings
+        return allSettings.get(int(self.index['settings'][idx]))
+
+
+    def get_sequence(self, idx):
+        """ Returns tuple of (stack, start, end), where stack holds the frames
+        from the sequence containing frame idx, with shape (h, w, n), in the
+        order they were acquired, and start and end (exclusive) are the 
+        indices of the first and last frames of the sequence.
+        """
+        sequence = self.index['sequence'][idx]
+        start = idx
+        while start > 0 and self.index['sequence'][start - 1] == sequence:
+            start = start - 1
+        end = idx + 1
+        while end < self.numFrames and self.index['sequence'][end] == sequence:
+            end = end + 1
+        return np.moveaxis(self.frames[start:end], 0, 2), start, end
+
+
+    def batches(self, start = 0, end = None):
+        """ Generator which yields frames in a range, with frames from the 
+        same sequence (e.g. an SR LED sequence) stacked together as (h, w, n).
+        """
+        if end is None:
+            end = self.numFrames
+        idx = start
+        while idx < end:
+            sequence = self.index['sequence'][idx]
+            seqEnd = idx + 1
+            while seqEnd < end and self.index['sequence'][seqEnd] == sequence:
+                seqEnd = seqEnd + 1
+            if seqEnd - idx > 1:
+                yield np.moveaxis(self.frames[idx:seqEnd], 0, 2)
+            else:
+                yield self.frames[idx]
+            idx = seqEnd
+            
+            
+    def reprocess(self, processor, start = 0, end = None, depth = None):
+        """ Generator which passes a range of frames through a processor,
+        such as an InlineBundleProcessorClass, and yields the processed
+        images. Frames from the same sequence (e.g. an SR LED sequence)
+        are passed to the processor together. 
+
+        Arguments:
+            processor  : processor with a process(frame) method, or a 
+                         ProcessorPool, in which case frames are processed in 
+                         parallel and yielded in order
+
+        Keyword Arguments:
+            start      : int, first frame, default is 0
+            end        : int, last frame (exclusive), default is end of archive
+            depth      : float, refocus depth, default is to use the current
+                         processor depth
+        """
+        if depth is not None:
+            processor.set_depth(depth)
+        if hasattr(processor, 'map'):
+            yield from processor.map(self.batches(start, end))
+        else:
+            for frames in self.batches(start, end):
+                yield processor.process(frames)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Fast SR Shift Calibration
+
+Estimates the shift of each LED image relative to the first, for every depth
+of a depth-dependent (parameter) shift calibration, and fits the shifts as a
+linear function of depth. This does the same job as
+pybundle.SuperRes.calib_param_shift, but:
+
+    the core interpolation of each LED image is spread across processes
+    the shifts for all depths and LEDs are found in one batch of FFT
+        cross-correlations, rather than one image at a time
+    peaks are located to sub-pixel precision by fitting a parabola through
+        the correlation peak and its neighbours
+
+The results are returned in the same form as calib_param_shift, an array of
+shape (nShifts, 2, 2) of (x, y) linear fit coefficients (slope, intercept) for
+each LED, so they can be passed to calibrate_sr_lut. Shifts are measured on
+the core-interpolated images and converted to raw image pixels using the
+calibration radius and grid size. They follow the sign convention of
+pybundle.SuperRes.get_shifts, which is the shift of the first image relative
+to each image, and forceZero adds a zero shift point at zero as PyBundle
+does. benchmark() runs both and reports the difference as well as the
+timings.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import time
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+import scipy.fft
+
+import pybundle
+
+from processors import fast_refocus
+
+# Calibration used by worker processes, set once per worker
+_workerCalibration = None
+
+
+def _init_worker(calibration):
+    global _workerCalibration
+    _workerCalibration = calibration
+
+
+def _interpolate_stack(stack):
+    """ Core interpolates each image of an (h, w, n) stack, returning (n, g, g).
+    """
+    return np.stack([pybundle.recon_tri_interp(stack[:,:,idx], _workerCalibration) for idx in range(np.shape(stack)[2])]).astype('float32')
+
+
+def interpolate_all(images, calibration, numWorkers = None):
+    """ Core interpolates all images of an (h, w, nShifts, nParams) array,
+    one depth per task, returning an array of shape (nParams, nShifts, g, g).
+    """
+    nParams = np.shape(images)[3]
+    numWorkers = min(numWorkers or os.cpu_count(), nParams)
+    if numWorkers <= 1:
+        _init_worker(calibration)
+        return np.stack([_interpolate_stack(np.asarray(images[:,:,:,idx])) for idx in range(nParams)])
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(numWorkers, mp_context = context, initializer = _init_worker,
+                                                initargs = (calibration,)) as pool:
+        return np.stack(list(pool.map(_interpolate_stack, (np.asarray(images[:,:,:,idx]) for idx in range(nParams)))))
+
+
+def _parabolic_offset(below, peak, above):
+    """ Sub-pixel offset of peak from fit of parabola through three points.
+    """
+    denominator = below - 2 * peak + above
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        offset = np.where(denominator != 0, 0.5 * (below - above) / denominator, 0)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def batch_shifts(imgs, reference = 0):
+    """ Returns (x, y) shift of image number reference relative to each image
+    in imgs, i.e. the negative of the shift of each image, as returned by
+    pybundle.SuperRes.get_shifts. imgs is of shape (..., n, h, w) and the
+    result is of shape (..., n, 2). The central region of the images, where
+    there is no bundle edge, is windowed and cross-correlated using FFTs over
+    the whole batch at once.
+    """
+    imgs = np.asarray(imgs, dtype = 'float32')
+    h, w = np.shape(imgs)[-2:]
+    window = fast_refocus.circular_window((h, w), 0.4 * min(h, w), min(h, w) / 10)
+    imgs = (imgs - np.sum(imgs * window, axis = (-2, -1), keepdims = True) / np.sum(window)) * window
+    imgFFT = scipy.fft.rfft2(imgs, workers = fast_refocus.FFT_WORKERS)
+    product = imgFFT[..., reference:reference + 1, :, :] * np.conj(imgFFT)
+    corr = scipy.fft.irfft2(product, s = (h, w), workers = fast_refocus.FFT_WORKERS)
+
+    # Divide by the overlap of the windows at each shift, otherwise the window
+    # pulls the peak towards zero shift
+    windowFFT = scipy.fft.rfft2(window)
+    overlap = scipy.fft.irfft2(windowFFT * np.conj(windowFFT), s = (h, w))
+    corr = corr / np.maximum(overlap, 0.1 * np.max(overlap))
+
+    flat = corr.reshape(corr.shape[:-2] + (h * w,))
+    peakY, peakX = np.unravel_index(np.argmax(flat, axis = -1), (h, w))
+    take = lambda y, x: np.take_along_axis(flat, ((y % h) * w + (x % w))[..., None], axis = -1)[..., 0]
+    peak = take(peakY, peakX)
+    dy = _parabolic_offset(take(peakY - 1, peakX), peak, take(peakY + 1, peakX))
+    dx = _parabolic_offset(take(peakY, peakX - 1), peak, take(peakY, peakX + 1))
+
+    # Peaks beyond half the image size are negative shifts
+    shiftY = np.where(peakY > h // 2, peakY - h, peakY) + dy
+    shiftX = np.where(peakX > w // 2, peakX - w, peakX) + dx
+    return np.stack((shiftX, shiftY), axis = -1)
+
+
+def fit_shifts(param, shifts, forceZero = False):
+    """ Fits shifts of shape (nParams, nShifts, 2) linearly against param.
+    Returns coefficients of shape (nShifts, 2, 2) as (slope, intercept). If
+    forceZero is True, an extra point of zero shift at a parameter of zero
+    is added before fitting, as in pybundle.SuperRes.calib_param_shift.
+    """
+    param = np.asarray(param, dtype = 'float64')
+    shifts = np.asarray(shifts, dtype = 'float64')
+    nShifts = np.shape(shifts)[1]
+    if forceZero:
+        param = np.append(param, 0)
+        shifts = np.concatenate((shifts, np.zeros((1,) + np.shape(shifts)[1:])))
+    design = np.stack((param, np.ones_like(param)), axis = 1)
+    fit = np.linalg.lstsq(design, shifts.reshape(len(param), -1), rcond = None)[0]
+    return np.moveaxis(fit.reshape(2, nShifts, 2), 0, 2)
+
+
+def calib_param_shift(param, images, calibration, forceZero = False, numWorkers = None):
+    """ Fast equivalent of pybundle.SuperRes.calib_param_shift.
+
+    Arguments:
+        param       : 1D array of parameter (e.g. depth) of each set of images
+        images      : array of shape (h, w, nShifts, nParams), may be a
+                      memory-mapped view
+        calibration : PyBundle interpolation calibration
+
+    Keyword Arguments:
+        forceZero   : boolean, fit with zero intercept, default False
+        numWorkers  : int, processes used for core interpolation, default is
+                      number of cores
+
+    Returns:
+        tuple of (coeffs, shifts, timings) where timings is a dictionary of
+        time taken by each step, in s
+    """
+    t0 = time.perf_counter()
+    interpolated = interpolate_all(images, calibration, numWorkers)
+    t1 = time.perf_counter()
+    shifts = batch_shifts(interpolated)
+
+    # Convert from interpolated grid pixels to raw image pixels
+    radius = getattr(calibration, 'radius', None)
+    gridSize = getattr(calibration, 'gridSize', None)
+    if radius is not None and gridSize is not None:
+        shifts = shifts * (2 * radius / gridSize)
+    t2 = time.perf_counter()
+    coeffs = fit_shifts(param, shifts, forceZero)
+    t3 = time.perf_counter()
+    return coeffs, shifts, {'interpolate': t1 - t0, 'correlate': t2 - t1, 'fit': t3 - t2, 'total': t3 - t0}
+
+
+def benchmark(param, images, calibration, forceZero = False, numWorkers = None):
+    """ Runs both pybundle.SuperRes.calib_param_shift and the fast version,
+    returning a dictionary of timings and the largest difference between the
+    fitted coefficients.
+    """
+    t0 = time.perf_counter()
+    reference = pybundle.SuperRes.calib_param_shift(param, images, calibration, forceZero = forceZero)
+    pybundleTime = time.perf_counter() - t0
+    coeffs, shifts, timings = calib_param_shift(param, images, calibration, forceZero, numWorkers)
+    result = {'pybundle': pybundleTime, 'fast': timings['total'], 'speedup': pybundleTime / max(timings['total'], 1e-9)}
+    if np.shape(reference) == np.shape(coeffs):
+        result['maxDifference'] = float(np.max(np.abs(np.asarray(reference) - coeffs)))
+    return result
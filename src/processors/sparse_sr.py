@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Sparse Matrix Super Resolution Reconstruction
+
+For a fixed super-resolution calibration, PyBundle's triangular linear
+interpolation reconstruction is a fixed linear map from the stack of shifted
+raw images to the output image (plus a constant offset if there is a
+background). This builds that map once as a sparse matrix, including the
+extraction of core values from each image, the background subtraction and
+normalisation, so that each reconstruction is a single sparse matrix-vector
+product over the raw stack.
+
+Matrices are stored in an ArrayFileCache, so they are shared between
+processor processes and only built once per calibration.
+
+The matrix is built from the attributes of the calibration produced by
+pybundle.SuperRes.calib_multi_tri_interp, following the same steps as
+pybundle.SuperRes.recon_multi_tri_interp:
+
+    coreX, coreY               : core positions in each raw image
+    coreIdx, baryCoords        : for each output pixel, the indices of the 3
+                                 core values of its triangle (numbered over
+                                 all shifts) and their barycentric weights
+    mapping                    : triangle of each output pixel, -1 if outside
+    gridSize, nShifts          : output image size and number of raw images
+    filterSize                 : sigma of Gaussian filter applied to images
+                                 before extracting core values, or None
+    darkVals                   : dark core values, subtracted first
+    multiBackgrounds, multiBackgroundVals       : per image backgrounds
+    multiNormalisation, multiNormalisationVals  : per image normalisation
+    imageScaleFactor           : per image intensity scaling
+    background, backgroundVals : core value background
+    normalise, normaliseVals   : core value normalisation
+    postFilterSize, mask       : applied to the output image
+
+Each of these steps is a per core value scaling and offset, and so can be
+folded into the matrix. If a calibration does not have these, sr_matrix
+returns None and the processor falls back to PyBundle's own reconstruction.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import numpy as np
+import scipy.sparse
+import cv2 as cv
+
+from processors.array_cache import ArrayFileCache
+from processors.stage_cache import state_key
+
+REQUIRED_ATTRIBUTES = ['coreX', 'coreY', 'coreIdx', 'baryCoords', 'mapping', 'gridSize', 'nShifts']
+
+# Other calibration attributes which change the reconstruction
+OPTIONAL_ATTRIBUTES = ['filterSize', 'darkVals', 'multiBackgrounds', 'multiBackgroundVals', 'multiNormalisation',
+                       'multiNormalisationVals', 'imageScaleFactor', 'background', 'backgroundVals', 'normalise',
+                       'normaliseVals', 'postFilterSize', 'mask']
+
+
+def current_sr_calibration(pyb):
+    """ Returns the SR calibration PyBundle will use for the next frame:
+    the LUT entry for the current parameter value if the LUT is in use,
+    otherwise calibrationSR. Returns None if there is no calibration.
+    """
+    if pyb.srUseLut:
+        if pyb.srCalibrationLUT is None or pyb.srParamValue is None:
+            return None
+        return pyb.srCalibrationLUT.calibrationSR(pyb.srParamValue)
+    return pyb.calibrationSR
+
+
+def gaussian_filter(img, filterSize):
+    """ Gaussian filter with the same kernel size as pybundle.g_filter.
+    """
+    kernelSize = round(filterSize * 4)
+    kernelSize = kernelSize + 1 - kernelSize % 2
+    return cv.GaussianBlur(img, (kernelSize, kernelSize), filterSize)
+
+
+def output_settings(img, pyb):
+    """ Applies PyBundle's auto contrast and output type to a reconstructed
+    image, as pyb.process would.
+    """
+    if pyb.autoContrast:
+        img = img - np.min(img)
+        img = img / np.max(img)
+        if pyb.outputType == 'uint8':
+            img = img * 255
+        elif pyb.outputType == 'uint16':
+            img = img * (2**16 - 1)
+    if img.dtype != pyb.outputType:
+        img = img.astype(pyb.outputType)
+    return img
+
+
+def _core_value_scaling(calib, nCores, nImages):
+    """ Returns (scale, offset), each of length nCores * nImages, such that
+    the corrected value of each core in each image is
+    scale * raw value + offset.
+    """
+    scale = np.ones((nImages, nCores))
+    offset = np.zeros((nImages, nCores))
+    offset -= np.asarray(getattr(calib, 'darkVals', 0), dtype = 'float64')
+
+    multiBackgrounds = bool(getattr(calib, 'multiBackgrounds', False))
+    multiNormalisation = bool(getattr(calib, 'multiNormalisation', False))
+    if multiBackgrounds:
+        offset -= np.asarray(calib.multiBackgroundVals, dtype = 'float64').T
+    if multiNormalisation:
+        values = np.asarray(calib.multiNormalisationVals, dtype = 'float64').T
+        scale /= values
+        offset /= values
+    imageScaleFactor = getattr(calib, 'imageScaleFactor', None)
+    if imageScaleFactor is not None and not multiNormalisation:
+        factor = np.asarray(imageScaleFactor, dtype = 'float64')[:, None]
+        scale *= factor
+        offset *= factor
+    if getattr(calib, 'background', None) is not None and not multiBackgrounds:
+        offset -= np.asarray(calib.backgroundVals, dtype = 'float64')
+    if getattr(calib, 'normalise', None) is not None and not multiNormalisation:
+        values = np.asarray(calib.normaliseVals, dtype = 'float64')
+        scale /= values
+        offset /= values
+    return scale.ravel(), offset.ravel()
+
+
+def _by_pixel(arr, numPixels):
+    """ Returns array as (numPixels, 3) whichever way round it is stored.
+    """
+    arr = np.asarray(arr)
+    if arr.shape[0] != numPixels and arr.shape[-1] == numPixels:
+        arr = arr.T
+    return arr
+
+
+def build_sr_matrix(calib, shape):
+    """ Builds sparse reconstruction matrix for calibration calib and raw
+    stacks of shape (h, w, nImages). Returns tuple of (data, indices, indptr,
+    offset, gridSize) where the first three are the CSR arrays of the matrix,
+    of shape (gridSize**2, h * w * nImages), and offset is the constant to
+    add to the result.
+    """
+    h, w, nImages = shape
+    if nImages != calib.nShifts:
+        raise ValueError(f"Stack of {nImages} images does not match SR calibration for {calib.nShifts} images.")
+    coreX = np.asarray(calib.coreX).astype(np.int64)
+    coreY = np.asarray(calib.coreY).astype(np.int64)
+    nCores = len(coreX)
+    mapping = np.ravel(calib.mapping)
+    numPixels = len(mapping)
+    coreIdx = _by_pixel(calib.coreIdx, numPixels).astype(np.int64)
+    bary = _by_pixel(calib.baryCoords, numPixels).astype('float64')
+
+    # Core values are numbered image by image. Position of each in the
+    # flattened (h, w, nImages) stack:
+    shiftIdx = np.repeat(np.arange(nImages), nCores)
+    valueIdx = (np.tile(coreY, nImages) * w + np.tile(coreX, nImages)) * nImages + shiftIdx
+    scale, valueOffset = _core_value_scaling(calib, nCores, nImages)
+
+    valid = mapping >= 0
+    rows = np.repeat(np.nonzero(valid)[0], 3)
+    vertices = coreIdx[valid].ravel()
+    baryValid = bary[valid].ravel()
+
+    matrix = scipy.sparse.csr_matrix((baryValid * scale[vertices], (rows, valueIdx[vertices])), shape = (numPixels, h * w * nImages))
+    matrix.sum_duplicates()
+    offset = np.zeros(numPixels)
+    np.add.at(offset, rows, baryValid * valueOffset[vertices])
+
+    return (matrix.data.astype('float32'), matrix.indices.astype('int32'), matrix.indptr.astype('int64'),
+            offset.astype('float32'), int(calib.gridSize))
+
+
+class SparseSRReconstructor:
+    """ Reconstructs super-resolution images using a cached sparse matrix.
+
+    Arguments:
+        cacheFolder : str, folder to store matrices in, or None to keep them
+                      in memory only
+    """
+
+    def __init__(self, cacheFolder):
+
+        self.cache = ArrayFileCache(cacheFolder, maxInMemory = 8)
+        self.matrices = {}
+
+
+    def calibration_key(self, calib, shape):
+        return (tuple(shape),) + tuple(state_key(getattr(calib, name, None)) for name in REQUIRED_ATTRIBUTES + OPTIONAL_ATTRIBUTES)
+
+
+    def sr_matrix(self, calib, shape):
+        """ Returns tuple of (matrix, offset, gridSize) for calib and raw
+        stack shape, or None if calib cannot be converted to a matrix.
+        """
+        if calib is None or not all(getattr(calib, name, None) is not None for name in REQUIRED_ATTRIBUTES):
+            return None
+        if shape[2] != calib.nShifts:
+            return None
+        key = self.calibration_key(calib, shape)
+        if key not in self.matrices:
+            if self.cache.get((key, 'data')) is None:
+                data, indices, indptr, offset, gridSize = build_sr_matrix(calib, shape)
+                self.cache.put((key, 'indices'), indices)
+                self.cache.put((key, 'indptr'), indptr)
+                self.cache.put((key, 'offset'), offset)
+                self.cache.put((key, 'data'), data)
+            gridSize = int(calib.gridSize)
+            matrix = scipy.sparse.csr_matrix((self.cache.get((key, 'data')), self.cache.get((key, 'indices')),
+                                              self.cache.get((key, 'indptr'))),
+                                             shape = (gridSize**2, int(np.prod(shape))), copy = False)
+            self.matrices = {key: (matrix, self.cache.get((key, 'offset')), gridSize)}
+        return self.matrices[key]
+
+
+    def reconstruct(self, imgs, calib):
+        """ Returns reconstructed image from stack imgs of shape (h, w,
+        nImages), or None if calib cannot be converted to a matrix.
+        """
+        imgs = np.asarray(imgs)
+        recon = self.sr_matrix(calib, np.shape(imgs))
+        if recon is None:
+            return None
+        matrix, offset, gridSize = recon
+        filterSize = getattr(calib, 'filterSize', None)
+        if filterSize is not None:
+            imgs = np.stack([gaussian_filter(imgs[:,:,idx], filterSize) for idx in range(np.shape(imgs)[2])], axis = 2)
+        values = np.ascontiguousarray(imgs, dtype = 'float32').ravel()
+        out = matrix @ values
+        out += offset
+        out = out.reshape(gridSize, gridSize).astype('float64')
+        if getattr(calib, 'postFilterSize', None) is not None:
+            out = gaussian_filter(out, calib.postFilterSize)
+        if getattr(calib, 'mask', None) is not None:
+            out = out * calib.mask
+        return out
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Stage Cache
+
+Caches the output of each processing stage along with a key describing the
+input and settings that produced it. If a later call has the same key the
+cached output is reused. Setting a stage invalidates all stages after it, so
+that (for example) a depth change only reruns the final propagation stage,
+while a change to the core removal settings reruns everything after core
+removal.
+
+Live frames never repeat, so fingerprinting each one would be wasted work.
+FrameKeys only fingerprints a frame in full when a cheap signature of a
+sparse grid of its pixels matches the last frame, i.e. when the source is
+probably paused or a file is being reprocessed. Other frames get a unique
+LiveKey, which never matches the cache.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import zlib
+import collections
+
+import numpy as np
+
+# Processing stages in order
+STAGES = ['sorted', 'bundle', 'fft', 'field']
+
+# Largest number of array fingerprints remembered by state_key
+_FINGERPRINT_MEMO_SIZE = 256
+_fingerprintMemo = {}
+
+
+LiveKey = collections.namedtuple('LiveKey', ['count'])
+
+
+def fingerprint(arr):
+    """ Returns a key which identifies the contents of a numpy array.
+    """
+    arr = np.ascontiguousarray(arr)
+    return (arr.shape, arr.dtype.str, zlib.crc32(arr))
+
+
+def _memo_fingerprint(arr):
+    """ Fingerprint of an array which is not expected to change, such as a
+    calibration. The result is remembered so that it is only calculated once
+    for each array.
+    """
+    memo = _fingerprintMemo.get(id(arr))
+    if memo is not None and memo[0] is arr:
+        return memo[1]
+    if len(_fingerprintMemo) > _FINGERPRINT_MEMO_SIZE:
+        _fingerprintMemo.clear()
+    fp = fingerprint(arr)
+    _fingerprintMemo[id(arr)] = (arr, fp)
+    return fp
+
+
+def state_key(obj, depth = 2):
+    """ Returns a hashable key describing the attributes of an object, such as
+    a PyBundle instance, so that changes to its settings or calibration
+    can be detected. Arrays are fingerprinted by content, so that an
+    identical copy of the object (e.g. after being piped to another process)
+    gives the same key. Nested objects are followed to the given depth.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        return obj
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return _memo_fingerprint(obj)
+    if isinstance(obj, (list, tuple)):
+        return tuple(state_key(item, depth) for item in obj)
+    if isinstance(obj, dict):
+        return tuple((k, state_key(v, depth)) for k, v in sorted(obj.items(), key = lambda item: str(item[0])))
+    if depth > 0 and hasattr(obj, '__dict__'):
+        return (type(obj).__name__,) + tuple((name, state_key(value, depth - 1)) for name, value in sorted(vars(obj).items()))
+    return type(obj).__name__
+
+
+def is_live(key):
+    """ Returns True if key, or any element of key if it is a tuple, is a
+    LiveKey.
+    """
+    if isinstance(key, LiveKey):
+        return True
+    return isinstance(key, tuple) and any(isinstance(k, LiveKey) for k in key)
+
+
+class FrameKeys:
+    """ Returns keys identifying input frames, see module docstring.
+
+    Keyword Arguments:
+        sampleStep : int, spacing of pixels used for the signature, default 16
+    """
+
+    def __init__(self, sampleStep = 16):
+
+        self.sampleStep = sampleStep
+        self.signature = None
+        self.count = 0
+
+
+    def key(self, frame):
+        """ Returns fingerprint of frame if it may be a repeat of the last
+        frame, otherwise a new LiveKey.
+        """
+        signature = fingerprint(frame[::self.sampleStep, ::self.sampleStep])
+        repeat = signature == self.signature
+        self.signature = signature
+        if repeat:
+            return fingerprint(frame)
+        self.count = self.count + 1
+        return LiveKey(self.count)
+
+
+
+class StageCache:
+    """ Stores the output of each stage along with its key.
+    """
+
+    def __init__(self, stages = STAGES):
+
+        self.stages = list(stages)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, stage, key):
+        """ Returns the cached output of stage if it was produced with the
+        same key, otherwise None.
+        """
+        entry = self.entries.get(stage)
+        if entry is not None and entry[0] == key:
+            self.hits = self.hits + 1
+            return entry[1]
+        self.misses = self.misses + 1
+        return None
+
+
+    def set(self, stage, key, value):
+        """ Stores output of stage, invalidating all later stages.
+        """
+        self.invalidate(stage)
+        self.entries[stage] = (key, value)
+        return value
+
+
+    def invalidate(self, stage = None):
+        """ Removes stage and all later stages from the cache, or all stages if
+        stage is None.
+        """
+        if stage is None:
+            self.entries = {}
+            return
+        for laterStage in self.stages[self.stages.index(stage):]:
+            self.entries.pop(laterStage, None)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Synthetic Holograms and Replay Source
+
+Generates simulated raw fibre bundle inline holograms so that the processing
+pipeline can be tested, and soak and throughput tests run, without a camera
+or recorded data:
+
+    point (absorbing) and phase objects at known depths, optionally drifting
+    inline propagation to the bundle face by the angular spectrum method
+    a hexagonal pattern of Gaussian cores inside a circular bundle
+    SR sequences, with each LED illuminating at a different angle so that the
+        hologram shifts by an amount proportional to depth, preceded by a
+        blank frame as for the real LED controller
+
+ReplaySource then emits frames (e.g. read from a TIF by read_tif_frames) at a
+fixed frame rate, and soak_test passes them through a processor and reports
+throughput, optionally via a shared memory FrameRing as a camera thread would.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import math
+import time
+
+import numpy as np
+from PIL import Image
+
+from processors import fast_refocus
+from processors.frame_ring import FrameRing
+
+
+class SyntheticBundleHologram:
+    """ Simulated raw bundle holograms.
+
+    Keyword Arguments:
+        size         : int, image size in pixels, default 512
+        wavelength   : float, in m, default 0.5e-6
+        pixelSize    : float, camera pixel size at the bundle face, in m,
+                       default 1e-6
+        coreSpacing  : float, spacing of cores in pixels, default 4
+        coreSize     : float, core radius (Gaussian sigma) in pixels, default 1
+        bundleRadius : float, in pixels, default is 0.45 of size
+        numLEDs      : int, number of LEDs in SR sequences, default 8
+        ledAngle     : float, illumination angle of the LEDs, in radians,
+                       default 0.01. LEDs are spaced evenly around a circle.
+        noise        : float, standard deviation of additive noise as a
+                       fraction of the mean intensity, default 0.01
+        bitDepth     : int, 8 or 16, default 16
+        seed         : int, random seed, default 0
+    """
+
+    def __init__(self, size = 512, wavelength = 0.5e-6, pixelSize = 1e-6, coreSpacing = 4, coreSize = 1,
+                 bundleRadius = None, numLEDs = 8, ledAngle = 0.01, noise = 0.01, bitDepth = 16, seed = 0):
+
+        self.size = size
+        self.wavelength = wavelength
+        self.pixelSize = pixelSize
+        self.coreSpacing = coreSpacing
+        self.coreSize = coreSize
+        self.bundleRadius = bundleRadius or 0.45 * size
+        self.numLEDs = numLEDs
+        self.ledAngle = ledAngle
+        self.noise = noise
+        self.bitDepth = bitDepth
+        self.rng = np.random.default_rng(seed)
+        self.objects = []
+        self.propagators = {}
+        self.coreMask = self.core_pattern()
+        self.frameNumber = 0
+
+
+    def core_pattern(self):
+        """ Returns image of hexagonally packed Gaussian cores in the bundle.
+        """
+        size = self.size
+        pattern = np.zeros((size, size), dtype = 'float32')
+        rowSpacing = self.coreSpacing * math.sqrt(3) / 2
+        half = int(math.ceil(3 * self.coreSize))
+        offsets = np.arange(-half, half + 1)
+        kernel = np.exp(-(offsets[None,:]**2 + offsets[:,None]**2) / (2 * self.coreSize**2)).astype('float32')
+        centre = size / 2
+        for row in range(int(size / rowSpacing) + 1):
+            y = row * rowSpacing
+            xStart = (self.coreSpacing / 2) * (row % 2)
+            for x in np.arange(xStart, size, self.coreSpacing):
+                if (x - centre)**2 + (y - centre)**2 > self.bundleRadius**2:
+                    continue
+                cy, cx = int(round(y)), int(round(x))
+                y0, y1 = max(cy - half, 0), min(cy + half + 1, size)
+                x0, x1 = max(cx - half, 0), min(cx + half + 1, size)
+                pattern[y0:y1, x0:x1] = np.maximum(pattern[y0:y1, x0:x1],
+                                                   kernel[y0 - cy + half:y1 - cy + half, x0 - cx + half:x1 - cx + half])
+        return pattern
+
+
+    def add_point(self, x, y, depth, radius = 3, absorption = 0.8, velocity = (0, 0)):
+        """ Adds an absorbing disk at pixel position (x, y) and depth (m).
+        velocity is in pixels per frame.
+        """
+        self.objects.append({'type': 'point', 'x': x, 'y': y, 'depth': depth, 'radius': radius,
+                             'strength': absorption, 'velocity': velocity})
+
+
+    def add_phase_object(self, x, y, depth, radius = 10, phase = 1.0, velocity = (0, 0)):
+        """ Adds a transparent disk with a phase delay (radians).
+        """
+        self.objects.append({'type': 'phase', 'x': x, 'y': y, 'depth': depth, 'radius': radius,
+                             'strength': phase, 'velocity': velocity})
+
+
+    def add_random_objects(self, number, depthRange, radiusRange = (2, 6)):
+        """ Adds a number of point objects at random positions and depths.
+        """
+        for idx in range(number):
+            r = self.bundleRadius * math.sqrt(self.rng.random()) * 0.9
+            angle = self.rng.random() * 2 * math.pi
+            self.add_point(self.size / 2 + r * math.cos(angle), self.size / 2 + r * math.sin(angle),
+                           self.rng.uniform(*depthRange), self.rng.uniform(*radiusRange),
+                           velocity = tuple(self.rng.normal(0, 0.5, 2)))
+
+
+    def _propagator(self, depth):
+        key = float(depth)
+        if key not in self.propagators:
+            self.propagators[key] = fast_refocus.propagator((self.size, self.size), self.wavelength, self.pixelSize, -depth)
+        return self.propagators[key]
+
+
+    def field(self, tilt = (0, 0)):
+        """ Returns complex field at the bundle face for illumination at angle
+        tilt = (x, y) in radians. Objects at the same depth are propagated
+        together.
+        """
+        size = self.size
+        yy, xx = np.mgrid[:size, :size].astype('float32')
+        k = 2 * math.pi / self.wavelength * self.pixelSize
+        illumination = np.exp(1j * k * (math.sin(tilt[0]) * xx + math.sin(tilt[1]) * yy)).astype('complex64')
+        field = illumination.copy()
+        for depth in sorted(set(obj['depth'] for obj in self.objects), reverse = True):
+            transmission = np.ones((size, size), dtype = 'complex64')
+            for obj in self.objects:
+                if obj['depth'] != depth:
+                    continue
+                inside = (xx - obj['x'])**2 + (yy - obj['y'])**2 < obj['radius']**2
+                if obj['type'] == 'point':
+                    transmission[inside] *= 1 - obj['strength']
+                else:
+                    transmission[inside] *= np.exp(1j * obj['strength'])
+            # Scattered light from this plane propagated to the bundle face,
+            # assuming weak scattering so planes can be treated independently
+            scattered = illumination * (transmission - 1)
+            field += fast_refocus.propagate(fast_refocus.hologram_fft(scattered), self._propagator(depth))
+        return field
+
+
+    def _to_raw(self, intensity):
+        raw = intensity * self.coreMask
+        raw = raw + self.rng.normal(0, self.noise * np.mean(raw) + 1e-9, np.shape(raw))
+        maxValue = 2**self.bitDepth - 1
+        raw = np.clip(raw / 2 * maxValue * 0.8, 0, maxValue)
+        return raw.astype('uint8' if self.bitDepth == 8 else 'uint16')
+
+
+    def _move(self):
+        for obj in self.objects:
+            obj['x'] = obj['x'] + obj['velocity'][0]
+            obj['y'] = obj['y'] + obj['velocity'][1]
+        self.frameNumber = self.frameNumber + 1
+
+
+    def led_tilts(self):
+        """ Returns (x, y) illumination angle of each LED.
+        """
+        angles = np.arange(self.numLEDs) * 2 * math.pi / self.numLEDs
+        return [(self.ledAngle * math.cos(a), self.ledAngle * math.sin(a)) for a in angles]
+
+
+    def frame(self):
+        """ Returns next raw frame with on-axis illumination.
+        """
+        raw = self._to_raw(np.abs(self.field())**2)
+        self._move()
+        return raw
+
+
+    def sr_sequence(self):
+        """ Returns next SR sequence as an (h, w, numLEDs + 1) stack: a blank
+        frame followed by one frame for each LED.
+        """
+        stack = [self._to_raw(np.zeros((self.size, self.size), dtype = 'float32'))]
+        for tilt in self.led_tilts():
+            stack.append(self._to_raw(np.abs(self.field(tilt))**2))
+        self._move()
+        return np.stack(stack, axis = 2)
+
+
+    def background(self):
+        """ Returns raw frame with no objects, for calibration.
+        """
+        return self._to_raw(np.ones((self.size, self.size), dtype = 'float32'))
+
+
+    def write_tif(self, filename, numFrames = 20, sr = False):
+        """ Writes a multi-page TIF of numFrames frames (or, if sr is True,
+        numFrames SR sequences) for use by a simulated camera.
+        """
+        frames = []
+        for idx in range(numFrames):
+            if sr:
+                stack = self.sr_sequence()
+                frames.extend(stack[:,:,i] for i in range(np.shape(stack)[2]))
+            else:
+                frames.append(self.frame())
+        images = [Image.fromarray(frame) for frame in frames]
+        images[0].save(filename, save_all = True, append_images = images[1:])
+
+
+
+def read_tif_frames(filename, stackLength = None):
+    """ Returns list of the frames of a multi-page TIF. If stackLength is
+    given, consecutive frames are instead grouped into (h, w, stackLength)
+    stacks, as they are sent to the processor in SR mode.
+    """
+    frames = []
+    with Image.open(filename) as img:
+        for idx in range(getattr(img, 'n_frames', 1)):
+            img.seek(idx)
+            frames.append(np.array(img))
+    if stackLength is None or stackLength <= 1:
+        return frames
+    return [np.stack(frames[idx:idx + stackLength], axis = 2) for idx in range(0, len(frames) - stackLength + 1, stackLength)]
+
+
+
+class ReplaySource:
+    """ Emits frames at a fixed rate.
+
+    Arguments:
+        frames : list of frames, or a function returning the next frame
+
+    Keyword Arguments:
+        fps    : float, target frame rate, default 30
+        loop   : boolean, if True (default) a list of frames is repeated
+    """
+
+    def __init__(self, frames, fps = 30, loop = True):
+
+        self.frames = frames
+        self.fps = fps
+        self.loop = loop
+        self.numEmitted = 0
+        self.numLate = 0
+
+
+    def __iter__(self):
+        """ Yields frames, sleeping so that they are yielded at the target rate.
+        If the consumer falls behind, frames are yielded immediately and
+        counted as late rather than the schedule being reset.
+        """
+        interval = 1 / self.fps
+        nextTime = time.perf_counter()
+        idx = 0
+        while True:
+            if callable(self.frames):
+                frame = self.frames()
+            else:
+                if idx >= len(self.frames):
+                    if not self.loop:
+                        return
+                    idx = 0
+                frame = self.frames[idx]
+                idx = idx + 1
+            wait = nextTime - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            elif wait < -interval:
+                self.numLate = self.numLate + 1
+            nextTime = nextTime + interval
+            self.numEmitted = self.numEmitted + 1
+            yield frame
+
+
+
+def soak_test(processor, source, duration = 60, report = 10, useRing = False):
+    """ Passes frames from a ReplaySource through processor.process for
+    duration seconds, printing throughput every report seconds (or never, if
+    report is None). Returns a dictionary of statistics.
+
+    If useRing is True, each frame (or SR stack) is written into a shared
+    memory FrameRing and the processor is passed a SlotHandle instead, as it
+    would be by an acquisition thread using the ring.
+    """
+    t0 = time.perf_counter()
+    lastReport = t0
+    times = []
+    ring = None
+    try:
+        for frame in source:
+            if useRing:
+                frame = frame if np.ndim(frame) == 3 else frame[:,:,None]
+                if ring is None:
+                    ring = FrameRing.create(np.shape(frame)[:2], np.shape(frame)[2], dtype = frame.dtype)
+                frame = ring.write_batch(frame)
+            t1 = time.perf_counter()
+            if frame is not None:
+                processor.process(frame)
+                times.append(time.perf_counter() - t1)
+            now = time.perf_counter()
+            if report is not None and now - lastReport > report and len(times) > 0:
+                lastReport = now
+                print(f"{now - t0:.0f} s: {source.numEmitted / (now - t0):.1f} fps, "
+                      f"process time p50 {np.percentile(times, 50) * 1000:.1f} ms, "
+                      f"p99 {np.percentile(times, 99) * 1000:.1f} ms, late frames {source.numLate}")
+            if now - t0 > duration:
+                break
+    finally:
+        if ring is not None:
+            ring.close()
+    elapsed = time.perf_counter() - t0
+    return {'frames': source.numEmitted,
+            'fps': source.numEmitted / elapsed,
+            'late': source.numLate,
+            'dropped': 0 if ring is None else ring.dropped,
+            'processTimeP50': float(np.percentile(times, 50)) if times else 0,
+            'processTimeP99': float(np.percentile(times, 99)) if times else 0,
+            'processTimeMax': float(np.max(times)) if times else 0}
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Frame Latency Telemetry
+
+Records timestamps for each frame as it passes through the processing stages
+and provides rolling latency percentiles. Timestamps can also be streamed to
+a CSV file for offline analysis.
+
+All timestamps are from time.time() so that they can be compared between the
+processor and GUI processes.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import time
+import collections
+
+import numpy as np
+
+# Stages in order. 'acquired' is only recorded if the frame source provides
+# an acquisition time.
+STAGES = ['acquired', 'received', 'sorted', 'bundle', 'refocus', 'post', 'output', 'displayed']
+
+
+class LatencyTelemetry:
+    """ Stores timestamps of the most recent frames.
+
+    Keyword Arguments:
+        window     : int, number of frames to keep for percentiles, default 500
+        csvFile    : str, if not None, each completed frame is appended to
+                     this CSV file
+    """
+
+    flushInterval = 1         # Seconds between CSV flushes
+
+    def __init__(self, window = 500, csvFile = None):
+
+        self.history = collections.deque(maxlen = window)
+        self.current = None
+        self.frameNumber = -1
+        self.csvFile = None
+        self.csvFilename = None
+        self.lastFlush = time.perf_counter()
+        self.set_csv_file(csvFile)
+
+
+    def set_csv_file(self, csvFile):
+        """ Starts streaming to CSV file csvFile, or stops if csvFile is None.
+        """
+        if csvFile == self.csvFilename:
+            return
+        if self.csvFile is not None:
+            self.csvFile.close()
+            self.csvFile = None
+        self.csvFilename = csvFile
+        if csvFile is not None:
+            self.csvFile = open(csvFile, 'a')
+            if self.csvFile.tell() == 0:
+                self.csvFile.write('frame,' + ','.join(STAGES) + '\n')
+
+
+    def start_frame(self, frameNumber = None, timestamp = None):
+        """ Begins recording a new frame.
+
+        Keyword Arguments:
+            frameNumber : int, default is to increment previous frame number
+            timestamp   : float, time frame was received, default is now
+        """
+        if frameNumber is None:
+            frameNumber = self.frameNumber + 1
+        self.frameNumber = frameNumber
+        self.current = {'frame': frameNumber}
+        self.stamp('received', timestamp)
+
+
+    def stamp(self, stage, timestamp = None):
+        """ Records time that the current frame reached stage.
+        """
+        if self.current is None:
+            return
+        self.current[stage] = time.time() if timestamp is None else timestamp
+
+
+    def end_frame(self):
+        """ Stores the current frame in the history and CSV file.
+        """
+        if self.current is None:
+            return
+        frame = self.current
+        self.history.append(frame)
+        self.current = None
+        if self.csvFile is not None:
+            self.csvFile.write(str(frame['frame']) + ',' + ','.join(f"{frame[s]:.6f}" if s in frame else '' for s in STAGES) + '\n')
+            if time.perf_counter() - self.lastFlush > self.flushInterval:
+                self.csvFile.flush()
+                self.lastFlush = time.perf_counter()
+        return frame
+
+
+    def add_frame(self, frame):
+        """ Adds a completed frame dictionary (e.g. as received from another
+        process) directly to the history.
+        """
+        self.current = dict(frame)
+        return self.end_frame()
+
+
+    def latencies(self, fromStage = 'acquired', toStage = 'output'):
+        """ Returns array of latencies in seconds between two stages for all
+        frames in history which have both stages.
+        """
+        return np.array([f[toStage] - f[fromStage] for f in self.history if fromStage in f and toStage in f])
+
+
+    def percentiles(self, fromStage = 'acquired', toStage = 'output', q = (50, 90, 99)):
+        """ Returns rolling latency percentiles in seconds between two stages,
+        or None if no frames have been recorded.
+        """
+        lat = self.latencies(fromStage, toStage)
+        if len(lat) == 0:
+            return None
+        return np.percentile(lat, q)
+
+
+    def stage_means(self):
+        """ Returns dictionary of the mean time taken to reach each stage from
+        the previous stage recorded for that frame. Stages which are not used
+        in the current mode (e.g. 'sorted' if not in SR mode) are skipped.
+        """
+        totals = collections.defaultdict(float)
+        counts = collections.defaultdict(int)
+        for frame in self.history:
+            previous = None
+            for stage in STAGES:
+                if stage in frame:
+                    if previous is not None:
+                        totals[stage] += frame[stage] - frame[previous]
+                        counts[stage] += 1
+                    previous = stage
+        return {stage: totals[stage] / counts[stage] for stage in totals}
+
+
+    def close(self):
+        self.set_csv_file(None)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Processor Worker Pool
+
+Runs copies of a processor in several worker processes so that processing
+of large images (e.g. refocusing at large grid sizes) can use more than one
+core. Frames, or whole SR sequences, are sent to workers round-robin and the
+results are put back into acquisition order by a reorder buffer before being
+returned.
+
+Settings are sent as a pickled copy of the processor, tagged with an epoch
+number. Each worker has its own FIFO queue and the settings are put on every
+queue, so all frames submitted after a settings change are processed with the
+new settings by whichever worker receives them. Calibrations are shared by
+being part of the pickled processor, and windows through the on-disk array
+cache.
+
+@author: Mike Hughes
+Applied Optics Group
+University of Kent
+
+"""
+
+import os
+import time
+import pickle
+import queue
+import traceback
+import multiprocessing
+
+
+def _worker_main(inQueue, outQueue):
+    """ Worker process loop. Messages are ('settings', epoch, pickledProcessor),
+    ('frame', seq, frame) or None to stop. Results are (seq, epoch, output,
+    preProcessFrame, processTime), where preProcessFrame is the processor's 
+    intermediate core-removed frame, if it has one, and processTime is the
+    time in s the worker took to process the frame.
+    """
+    processor = None
+    epoch = 0
+    while True:
+        message = inQueue.get()
+        if message is None:
+            break
+        if message[0] == 'settings':
+            epoch = message[1]
+            processor = pickle.loads(message[2])
+        elif message[0] == 'frame':
+            seq, frame = message[1], message[2]
+            t0 = time.perf_counter()
+            try:
+                output = processor.process(frame)
+            except Exception:
+                traceback.print_exc()
+                output = None
+            outQueue.put((seq, epoch, output, getattr(processor, 'preProcessFrame', None), time.perf_counter() - t0))
+
+
+class ProcessorPool:
+    """ Pool of worker processes each running a copy of a processor.
+
+    Arguments:
+        processor   : processor with a process(frame) method, must be picklable
+
+    Keyword Arguments:
+        numWorkers  : int, number of worker processes, default is number of
+                      cores
+        maxInFlight : int, submit blocks if this many frames are waiting for
+                      or being processed by workers, default is 2 per worker
+    """
+
+    def __init__(self, processor, numWorkers = None, maxInFlight = None):
+
+        self.numWorkers = numWorkers or os.cpu_count()
+        self.maxInFlight = maxInFlight or 2 * self.numWorkers
+        context = multiprocessing.get_context('spawn')
+        self.inQueues = [context.Queue() for idx in range(self.numWorkers)]
+        self.outQueue = context.Queue()
+        self.workers = [context.Process(target = _worker_main, args = (inQueue, self.outQueue), daemon = True)
+                        for inQueue in self.inQueues]
+        for worker in self.workers:
+            worker.start()
+        self.epoch = 0
+        self.nextSeq = 0             # Sequence number of next frame submitted
+        self.nextOut = 0             # Sequence number of next frame to return
+        self.reorder = {}            # Results which arrived out of order
+        self.settingsKey = None
+        self.lastProcessTime = None  # Worker time for the last frame returned by get
+        self.update_settings(processor)
+
+
+    def update_settings(self, processor):
+        """ Sends a copy of processor to all workers. Frames submitted from now
+        on are processed with these settings.
+        """
+        self.processor = processor
+        data = pickle.dumps(processor)
+        self.epoch = self.epoch + 1
+        for inQueue in self.inQueues:
+            inQueue.put(('settings', self.epoch, data))
+
+
+    def set_depth(self, depth):
+        """ Sets refocus depth of all workers.
+        """
+        self.processor.set_depth(depth)
+        self.update_settings(self.processor)
+        
+        
+    def in_flight(self):
+        """ Number of frames submitted but not yet returned.
+        """
+        return self.nextSeq - self.nextOut
+
+
+    def submit(self, frame):
+        """ Sends frame to the next worker. Returns its sequence number.
+        """
+        while self.in_flight() - len(self.reorder) >= self.maxInFlight:
+            if not self._collect(timeout = 1) and not any(worker.is_alive() for worker in self.workers):
+                raise RuntimeError("All processor pool workers have stopped.")
+        seq = self.nextSeq
+        self.inQueues[seq % self.numWorkers].put(('frame', seq, frame))
+        self.nextSeq = seq + 1
+        return seq
+
+
+    def _collect(self, timeout = None):
+        """ Moves one result from the workers into the reorder buffer, waiting
+        up to timeout seconds (or not at all if timeout is None). Returns
+        True if a result was collected.
+        """
+        try:
+            if timeout is None:
+                seq, epoch, output, preProcessed, processTime = self.outQueue.get_nowait()
+            else:
+                seq, epoch, output, preProcessed, processTime = self.outQueue.get(timeout = timeout)
+        except queue.Empty:
+            return False
+        self.reorder[seq] = (output, preProcessed, processTime)
+        return True
+
+
+    def get(self, block = False):
+        """ Returns tuple of (seq, output, preProcessFrame) for the next frame
+        in order, or None if it is not ready yet. If block is True, waits for
+        it. The time the worker took to process the frame is stored in 
+        lastProcessTime.
+        """
+        while self._collect():
+            pass
+        while block and self.nextOut not in self.reorder and self.in_flight() > 0:
+            if not self._collect(timeout = 1) and not any(worker.is_alive() for worker in self.workers):
+                raise RuntimeError("All processor pool workers have stopped.")
+        if self.nextOut not in self.reorder:
+            return None
+        seq = self.nextOut
+        self.nextOut = seq + 1
+        output, preProcessed, self.lastProcessTime = self.reorder.pop(seq)
+        return (seq, output, preProcessed)
+
+
+    def map(self, frames):
+        """ Generator which processes an iterable of frames and yields the
+        outputs in order.
+        """
+        for frame in frames:
+            self.submit(frame)
+            result = self.get()
+            while result is not None:
+                yield result[1]
+                result = self.get()
+        while self.in_flight() > 0:
+            yield self.get(block = True)[1]
+
+
+    def close(self):
+        """ Stops the worker processes.
+        """
+        for inQueue in self.inQueues:
+            inQueue.put(None)
+        for worker in self.workers:
+            worker.join(timeout = 5)
+            if worker.is_alive():
+                worker.terminate()
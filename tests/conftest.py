@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+HoloBundle
+Test configuration
+
+Puts src, and PyFibreBundle, PyHoloscope and CAS if they are in the folder
+structure described in the README, on the path. Tests which need one of
+these packages are skipped if it is not available.
+
+"""
+
+import os
+import sys
+
+testDir = os.path.dirname(__file__)
+for folder in [os.path.join('..', '..', 'cas', 'src'),
+               os.path.join('..', '..', 'pyholoscope', 'src'),
+               os.path.join('..', '..', 'pyfibrebundle', 'src'),
+               os.path.join('..', 'src')]:
+    sys.path.insert(0, os.path.abspath(os.path.join(testDir, folder)))
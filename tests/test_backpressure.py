@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.backpressure and processors.metrics
+"""
+
+import os
+
+from processors import backpressure
+from processors.backpressure import BackpressurePolicy
+from processors.metrics import MetricsChannel
+
+
+def test_off_always_accepts():
+    policy = BackpressurePolicy(backpressure.OFF)
+    assert all(policy.accept(100) for _ in range(5))
+    assert policy.skipped == 0
+
+
+def test_latest_only_skips_while_frames_waiting():
+    policy = BackpressurePolicy(backpressure.LATEST_ONLY)
+    assert not policy.accept(1)
+    assert policy.accept(0)
+
+
+def test_drop_oldest_counts_complete_batches_only():
+    policy = BackpressurePolicy(backpressure.DROP_OLDEST, maxBacklog = 2)
+    assert policy.accept(7, batchSize = 4)      # One complete batch waiting
+    assert not policy.accept(8, batchSize = 4)
+    assert policy.saturated
+
+
+def test_keep_every_nth_when_saturated():
+    policy = BackpressurePolicy(backpressure.KEEP_EVERY_NTH, everyN = 3, maxBacklog = 1)
+    kept = [policy.accept(5) for _ in range(6)]
+    assert kept == [True, False, False, True, False, False]
+    assert policy.get_metrics()['skipped'] == 4
+
+
+def test_latency_estimate_includes_backlog():
+    policy = BackpressurePolicy()
+    policy.record_process_time(0.1)
+    policy.accept(4, batchSize = 2)
+    assert abs(policy.get_metrics(batchSize = 2)['latency'] - 0.3) < 1e-9
+
+
+def test_metrics_channel_shared_between_instances(tmp_path):
+    filename = str(tmp_path / 'metrics.dat')
+    writer = MetricsChannel(filename, create = True)
+    reader = MetricsChannel(filename)
+    writer.update({'queueDepth': 3, 'latency': 0.25})
+    assert reader.get('queueDepth') == 3
+    assert reader.as_dict()['latency'] == 0.25
+    writer.close()
+    reader.close()
+
+
+def test_metrics_channel_file_removed_on_close(tmp_path):
+    filename = str(tmp_path / 'metrics.dat')
+    channel = MetricsChannel(filename, create = True)
+    channel.close(remove = True)
+    assert not os.path.exists(filename)
+    channel.close(remove = True)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.calibration_cache
+"""
+
+import numpy as np
+
+from processors.calibration_cache import CalibrationCache, calibration_key
+
+
+class Bundle:
+    """ The PyBundle attributes and methods used by the cache.
+    """
+    loc = None
+    autoLoc = True
+    gridSize = 512
+    coreSize = 3
+    background = None
+
+    def __init__(self, calibImage):
+        self.calibImage = calibImage
+        self.calibration = None
+        self.numCalibrations = 0
+
+    def calibrate(self):
+        self.numCalibrations = self.numCalibrations + 1
+        self.calibration = ('calibration', self.numCalibrations)
+
+    def set_loc(self, loc):
+        self.loc = loc
+        self.autoLoc = False
+
+
+def calib_image(seed = 0):
+    return np.random.default_rng(seed).integers(0, 1000, (64, 64)).astype('uint16')
+
+
+def test_key_depends_on_calibration_image_and_settings():
+    pyb = Bundle(calib_image())
+    key = calibration_key(pyb)
+    assert calibration_key(Bundle(calib_image())) == key
+    assert calibration_key(Bundle(calib_image(seed = 1))) != key
+    pyb.gridSize = 256
+    assert calibration_key(pyb) != key
+    assert calibration_key(Bundle(None)) is None
+
+
+def test_key_includes_user_set_geometry():
+    pyb = Bundle(calib_image())
+    key = calibration_key(pyb)
+    pyb.set_loc((32, 32, 20))
+    userKey = calibration_key(pyb)
+    assert userKey != key
+    pyb.set_loc((32, 32, 25))
+    assert calibration_key(pyb) != userKey
+
+
+def test_key_includes_sr_images():
+    pyb = Bundle(calib_image())
+    pyb.srCalibImages = np.zeros((64, 64, 4))
+    key = calibration_key(pyb, sr = True)
+    pyb.srCalibImages = np.ones((64, 64, 4))
+    assert calibration_key(pyb, sr = True) != key
+    assert calibration_key(pyb, sr = True) != calibration_key(pyb)
+
+
+def test_calibration_restored_from_cache(tmp_path):
+    cache = CalibrationCache(str(tmp_path))
+    first = Bundle(calib_image())
+    assert not cache.calibrate(first)
+    second = Bundle(calib_image())
+    assert cache.calibrate(second)
+    assert second.numCalibrations == 0
+    assert second.calibration == first.calibration
+    other = Bundle(calib_image(seed = 2))
+    assert not cache.calibrate(other)
+    assert other.numCalibrations == 1
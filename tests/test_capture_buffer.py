@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.capture_buffer
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from processors.capture_buffer import CaptureBuffer
+
+
+def stacks(number, shape = (6, 5, 3)):
+    return [np.full(shape, idx, dtype = 'uint16') + np.arange(shape[2], dtype = 'uint16') for idx in range(number)]
+
+
+def test_in_memory_matches_stack_without_copy():
+    buffer = CaptureBuffer()
+    for stack in stacks(5):
+        buffer.append(stack)
+    out = buffer.as_array()
+    assert not buffer.is_spilled()
+    assert np.array_equal(out, np.stack(stacks(5), axis = 3))
+    assert np.shares_memory(out, buffer.stacks)
+
+
+def test_spills_to_disk_over_budget(tmp_path):
+    stackBytes = 6 * 5 * 3 * 2
+    buffer = CaptureBuffer(memoryBudget = 3 * stackBytes, folder = str(tmp_path))
+    for stack in stacks(7):
+        buffer.append(stack)
+    assert buffer.is_spilled()
+    assert len(buffer) == 7
+    assert np.array_equal(buffer.as_array(), np.stack(stacks(7), axis = 3))
+    filename = buffer.spillFilename
+    buffer.close()
+    assert not os.path.exists(filename) or os.name == 'nt'
+
+
+def test_rejects_mismatched_stack():
+    buffer = CaptureBuffer()
+    buffer.append(np.zeros((4, 4, 2)))
+    with pytest.raises(ValueError):
+        buffer.append(np.zeros((4, 4, 3)))
+    assert CaptureBuffer().as_array() is None
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.checkpoint
+"""
+
+import os
+
+import numpy as np
+
+from processors.checkpoint import Checkpoint, CHECKPOINT_FILE
+
+
+def test_no_checkpoint(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    assert not checkpoint.exists()
+    assert checkpoint.load() is None
+
+
+def test_save_and_load(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    background = np.arange(12, dtype = 'float32').reshape(3, 4)
+    checkpoint.save({'depth': 1e-4, 'widgets': {'check': True}},
+                    {'background': background, 'calibration': {'radius': 80}, 'missing': None})
+    savedTime, state, objects = Checkpoint(str(tmp_path)).load()
+    assert savedTime == checkpoint.lastSave
+    assert state == {'depth': 1e-4, 'widgets': {'check': True}}
+    assert np.array_equal(objects['background'], background)
+    assert objects['calibration'] == {'radius': 80}
+    assert 'missing' not in objects
+
+
+def test_unchanged_objects_not_rewritten_and_old_ones_removed(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    background = np.ones((4, 4))
+    checkpoint.save({}, {'background': background, 'calibration': [1, 2]})
+    files = set(os.listdir(tmp_path))
+    backgroundFile = [file for file in files if file.startswith('background')][0]
+    modified = os.path.getmtime(tmp_path / backgroundFile)
+    checkpoint.save({}, {'background': background, 'calibration': [1, 2, 3]})
+    newFiles = set(os.listdir(tmp_path))
+    assert backgroundFile in newFiles
+    assert os.path.getmtime(tmp_path / backgroundFile) == modified
+    assert len(newFiles) == 3 and CHECKPOINT_FILE in newFiles
+    assert newFiles != files
+
+
+def test_unreadable_object_left_out(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    checkpoint.save({}, {'calibration': [1, 2], 'background': np.zeros(3)})
+    calibrationFile = [file for file in os.listdir(tmp_path) if file.startswith('calibration')][0]
+    with open(tmp_path / calibrationFile, 'wb') as f:
+        f.write(b'')
+    savedTime, state, objects = checkpoint.load()
+    assert 'calibration' not in objects
+    assert 'background' in objects
+
+
+def test_clear(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path))
+    checkpoint.save({}, {'background': np.zeros(3)})
+    checkpoint.clear()
+    assert not checkpoint.exists()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.chunked_store
+"""
+
+import numpy as np
+import pytest
+
+from processors.chunked_store import ChunkedStore
+
+
+def test_write_and_read_region(tmp_path):
+    data = np.random.default_rng(0).random((2, 3, 20, 30)).astype('float32')
+    store = ChunkedStore.create(str(tmp_path / 'stack'), data.shape, 'float32', chunks = (1, 2, 8, 8))
+    store.write(data)
+    reopened = ChunkedStore(str(tmp_path / 'stack'))
+    assert np.array_equal(reopened[:], data)
+    assert np.array_equal(reopened[1, 2, 5:17, 3:29], data[1, 2, 5:17, 3:29])
+    assert np.array_equal(reopened.get_depth(1, timeIdx = 0), data[0, 1])
+
+
+def test_partial_write_merges_existing_chunk(tmp_path):
+    store = ChunkedStore.create(str(tmp_path / 'stack'), (1, 1, 8, 8), 'uint16', chunks = (1, 1, 8, 8))
+    store.write(np.ones((1, 1, 8, 8), dtype = 'uint16'))
+    store.write(np.full((1, 1, 2, 2), 5, dtype = 'uint16'), offset = (0, 0, 3, 3))
+    out = store[0, 0]
+    assert out[3, 3] == 5 and out[4, 4] == 5
+    assert out[0, 0] == 1 and out[5, 5] == 1
+
+
+def test_append_with_multi_frame_time_chunks(tmp_path):
+    store = ChunkedStore.create(str(tmp_path / 'stack'), (0, 2, 8, 8), 'float32', chunks = (2, 1, 4, 4))
+    volumes = [np.full((2, 8, 8), t, dtype = 'float32') for t in range(5)]
+    for volume in volumes:
+        store.append(volume)
+    reopened = ChunkedStore(str(tmp_path / 'stack'))
+    assert reopened.shape == (5, 2, 8, 8)
+    assert np.array_equal(reopened[:], np.stack(volumes))
+
+
+def test_append_rejects_wrong_shape(tmp_path):
+    store = ChunkedStore.create(str(tmp_path / 'stack'), (0, 2, 8, 8), 'float32')
+    with pytest.raises(ValueError):
+        store.append(np.zeros((3, 8, 8)))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.display_stage
+"""
+
+import numpy as np
+
+from processors.display_stage import DisplayStage, DisplayChannel
+
+
+def test_downsample_keeps_at_least_display_size():
+    stage = DisplayStage(100, 100)
+    display = stage.process(np.random.rand(512, 512).astype('float32'))
+    assert display.dtype == np.uint8
+    assert display.shape == (102, 102)
+
+
+def test_input_is_not_modified():
+    stage = DisplayStage(64, 64)
+    img = np.random.rand(256, 256).astype('float32')
+    original = img.copy()
+    stage.process(img)
+    assert np.array_equal(img, original)
+
+
+def test_changed_is_false_for_repeated_frame():
+    stage = DisplayStage()
+    img = (np.random.rand(32, 32) * 1000).astype('uint16')
+    stage.process(img)
+    assert stage.changed
+    stage.process(img)
+    assert not stage.changed
+
+
+def test_lut_not_rebuilt_for_small_limit_drift():
+    stage = DisplayStage()
+    img = (np.random.rand(64, 64) * 4000).astype('uint16')
+    stage.process(img)
+    lut = stage.lut
+    for idx in range(20):
+        stage.process((img * (1 + 0.001 * np.sin(idx))).astype('uint16'))
+    assert stage.lut is lut
+    stage.set_contrast(0, 100)
+    stage.process(img)
+    assert stage.lut is not lut
+
+
+def test_lut_matches_float_mapping():
+    stage = DisplayStage()
+    stage.set_contrast(0, 4096)
+    img = np.arange(0, 4096, 16, dtype = 'uint16').reshape(16, 16)
+    expected = np.clip(img.astype('float32') * 255 / 4096, 0, 255).astype('uint8')
+    assert np.abs(stage.process(img).astype(int) - expected).max() <= 1
+
+
+def test_channel_passes_new_images_once(tmp_path):
+    filename = str(tmp_path / 'display.dat')
+    reader = DisplayChannel(filename)
+    assert reader.read() is None
+    writer = DisplayChannel(filename, create = True)
+    img = np.arange(12, dtype = 'uint8').reshape(3, 4)
+    writer.write(img, frameNumber = 7)
+    frameNumber, read = reader.read()
+    assert frameNumber == 7 and np.array_equal(read, img)
+    assert reader.read() is None
+
+    # A new size replaces the file, the reader reopens it
+    writer.write(np.ones((5, 5), dtype = 'uint8'), frameNumber = 8)
+    assert reader.read()[1].shape == (5, 5)
+    reader.close(remove = True)
+    writer.close()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.fast_refocus and processors.array_cache
+"""
+
+import numpy as np
+import pytest
+
+from processors import fast_refocus
+from processors.array_cache import ArrayFileCache
+
+
+def test_zero_depth_returns_hologram():
+    img = np.random.default_rng(0).random((64, 64)).astype('float32')
+    field = fast_refocus.refocus(img, 0.5e-6, 1e-6, 0)
+    assert np.allclose(field.real, img, atol = 1e-5)
+    assert np.allclose(field.imag, 0, atol = 1e-5)
+
+
+def test_forward_and_back_propagation_recovers_field():
+    img = np.random.default_rng(1).random((64, 64)).astype('float32')
+    imgFFT = fast_refocus.hologram_fft(img)
+    forward = fast_refocus.propagate(imgFFT, fast_refocus.propagator((64, 64), 0.5e-6, 1e-6, 100e-6))
+    back = fast_refocus.propagate(np.fft.fft2(forward), fast_refocus.propagator((64, 64), 0.5e-6, 1e-6, -100e-6))
+    assert np.allclose(back.real, img, atol = 1e-4)
+
+
+def test_window_and_background_applied_before_fft():
+    rng = np.random.default_rng(2)
+    img = rng.random((32, 32)).astype('float32')
+    background = rng.random((32, 32)).astype('float32')
+    window = fast_refocus.circular_window((32, 32), thickness = 4)
+    expected = np.fft.fft2((img - background) * window)
+    assert np.allclose(fast_refocus.hologram_fft(img, window, background), expected, atol = 1e-3)
+
+
+def test_circular_window_taper():
+    window = fast_refocus.circular_window((64, 64), radius = 30, thickness = 10)
+    assert window[32, 32] == 1
+    assert window[0, 0] == 0
+    assert 0 < window[32, 60] < 1
+
+
+def test_matches_pyholoscope():
+    pyholoscope = pytest.importorskip('pyholoscope')
+    img = np.random.default_rng(3).random((64, 64)).astype('float32')
+    holo = pyholoscope.Holo(pyholoscope.INLINE_MODE, 0.5e-6, 1e-6, depth = 200e-6)
+    expected = holo.process(img)
+    field = fast_refocus.refocus(img, 0.5e-6, 1e-6, 200e-6)
+    assert np.allclose(field, expected, atol = 1e-3)
+
+
+def test_array_file_cache_shared_between_instances(tmp_path):
+    calls = []
+    def factory():
+        calls.append(1)
+        return np.arange(5)
+    first = ArrayFileCache(str(tmp_path))
+    assert np.array_equal(first.get_or_create(('window', 5), factory), np.arange(5))
+    second = ArrayFileCache(str(tmp_path))
+    assert np.array_equal(second.get_or_create(('window', 5), factory), np.arange(5))
+    assert len(calls) == 1
+    second.clear()
+    assert ArrayFileCache(str(tmp_path)).get(('window', 5)) is None
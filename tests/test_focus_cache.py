@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.focus_cache
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from processors import fast_refocus
+from processors.focus_cache import FocusCache, focus_metric, roi_bounds, write_stack_tif
+
+WAVELENGTH = 0.5e-6
+PIXEL_SIZE = 1e-6
+DEPTH = 200e-6
+
+
+def hologram(shape = (128, 128), centre = (64, 64)):
+    """ Inline hologram of a small, bright spot at DEPTH.
+    """
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    obj = 1 + 2 * np.exp(-((yy - centre[0])**2 + (xx - centre[1])**2) / 4)
+    field = fast_refocus.propagate(np.fft.fft2(obj), fast_refocus.propagator(shape, WAVELENGTH, PIXEL_SIZE, -DEPTH))
+    return (np.abs(field)**2).astype('float32')
+
+
+def selected_cache(img, **kwargs):
+    cache = FocusCache(**kwargs)
+    cache.select('hologram', fast_refocus.hologram_fft(img), WAVELENGTH, PIXEL_SIZE)
+    return cache
+
+
+def test_focus_metrics():
+    flat = np.ones((8, 8))
+    spot = flat.copy()
+    spot[4, 4] = 5
+    for metric in ('Brenner', 'Variance', 'Peak'):
+        assert focus_metric(spot, metric) > focus_metric(flat, metric)
+    assert focus_metric(spot, 'Peak') == 5
+    with pytest.raises(ValueError):
+        focus_metric(flat, 'Unknown')
+
+
+def test_roi_bounds():
+    assert roi_bounds(None, (10, 20)) == (0, 10, 0, 20)
+    assert roi_bounds((5, 2, 30, 4), (10, 20)) == (2, 6, 5, 20)
+
+
+def test_planes_cached_and_budget_kept():
+    img = hologram((32, 32), (16, 16))
+    cache = selected_cache(img, maxBytes = 2 * 32 * 32 * 4)
+    first = cache.plane(DEPTH)
+    assert cache.plane(DEPTH) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.stack([0, 1e-4, 2e-4, 3e-4])
+    assert len(cache.planes) == 2
+
+
+def test_select_clears_for_new_hologram():
+    img = hologram((32, 32), (16, 16))
+    cache = selected_cache(img)
+    cache.metric(DEPTH)
+    cache.select('hologram', fast_refocus.hologram_fft(img), WAVELENGTH, PIXEL_SIZE)
+    assert len(cache.planes) == 1
+    cache.select('other', fast_refocus.hologram_fft(img), WAVELENGTH, PIXEL_SIZE)
+    assert len(cache.planes) == 0 and cache.curves == {}
+
+
+@pytest.mark.parametrize('metric', ['Brenner', 'Peak'])
+def test_auto_focus_finds_depth(metric):
+    cache = selected_cache(hologram())
+    depth = cache.auto_focus((100e-6, 400e-6), numCoarse = 10, metric = metric)
+    assert depth == pytest.approx(DEPTH, abs = 10e-6)
+
+
+def test_repeat_auto_focus_reuses_evaluations():
+    cache = selected_cache(hologram())
+    cache.auto_focus((100e-6, 400e-6), roi = (48, 48, 32, 32))
+    misses = cache.misses
+    cache.auto_focus((100e-6, 400e-6), roi = (48, 48, 32, 32))
+    assert cache.misses == misses
+
+
+def test_processor_auto_focus_with_margin():
+    pytest.importorskip('cas_gui')
+    from processors.inline_bundle_processor_class import InlineBundleProcessorClass
+    processor = InlineBundleProcessorClass()
+    processor.holo.wavelength = WAVELENGTH
+    processor.holo.pixelSize = PIXEL_SIZE
+    img = hologram()
+    depth = processor.auto_focus_frame(img, (100e-6, 400e-6), 10, (48, 48, 32, 32), 'Peak', margin = 16)
+    assert depth == pytest.approx(DEPTH, abs = 10e-6)
+
+
+def test_export_after_auto_focus_reuses_planes(tmp_path):
+    pytest.importorskip('cas_gui')
+    from processors.inline_bundle_processor_class import InlineBundleProcessorClass, runtime_object
+    processor = InlineBundleProcessorClass()
+    processor.holo.wavelength = WAVELENGTH
+    processor.holo.pixelSize = PIXEL_SIZE
+    img = hologram()
+    processor.auto_focus_frame(img, (100e-6, 400e-6), 10, (48, 48, 32, 32), 'Peak')
+    misses = runtime_object('focusCache', FocusCache).misses
+    depths, stack = processor.depth_stack(img, (100e-6, 400e-6), 11)
+    assert runtime_object('focusCache', FocusCache).misses == misses
+    write_stack_tif(tmp_path / 'stack.tif', stack)
+    with Image.open(tmp_path / 'stack.tif') as tif:
+        assert tif.n_frames == 11
+        tif.seek(3)
+        plane = np.array(tif)
+    assert plane.dtype == np.uint16 and plane.shape == (128, 128)
+    assert np.argmax(plane) == np.argmax(stack[3])
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.frame_history
+"""
+
+import os
+
+import numpy as np
+
+from processors.frame_history import FrameHistory, remove_history_file
+
+
+def test_default_dtype_holds_16_bit_values(tmp_path):
+    filename = str(tmp_path / 'history.dat')
+    history = FrameHistory.create(filename, 4, (8, 8))
+    assert history.dtype == np.float32
+    img = np.full((8, 8), 100000, dtype = 'float32')
+    history.add(img, 0)
+    assert np.array_equal(FrameHistory.open(filename).get(0), img)
+    history.close()
+
+
+def test_float16_clipped_rather_than_overflowing(tmp_path):
+    history = FrameHistory.create(str(tmp_path / 'history.dat'), 4, (2, 2), dtype = 'float16')
+    history.add(np.array([[1, 70000], [-70000, 2]], dtype = 'float32'), 0)
+    img = history.get(0)
+    assert np.all(np.isfinite(img))
+    assert img[0, 1] == np.finfo('float16').max
+    assert img[1, 0] == -np.finfo('float16').max
+    history.close()
+
+
+def test_ring_overwrites_oldest(tmp_path):
+    filename = str(tmp_path / 'history.dat')
+    history = FrameHistory.create(filename, 3, (4, 4))
+    for frame in range(5):
+        history.add(np.full((4, 4), frame, dtype = 'float32'), frame, timestamp = frame)
+    reader = FrameHistory.open(filename)
+    assert [entry[0] for entry in reader.available()] == [2, 3, 4]
+    assert reader.get(1) is None
+    assert reader.latest()[0] == 4
+    assert np.all(reader.get(3) == 3)
+    reader.close()
+    history.close()
+
+
+def test_replaced_file_detected(tmp_path):
+    filename = str(tmp_path / 'history.dat')
+    history = FrameHistory.create(filename, 2, (4, 4))
+    reader = FrameHistory.open(filename)
+    assert reader.is_current()
+    FrameHistory.create(filename, 2, (8, 8)).close()
+    assert not reader.is_current()
+    history.close()
+
+
+def test_close_removes_file(tmp_path):
+    filename = str(tmp_path / 'history.dat')
+    history = FrameHistory.create(filename, 2, (4, 4))
+    history.close()
+    assert os.path.exists(filename)
+    history = FrameHistory.create(filename, 2, (4, 4))
+    history.close(remove = True)
+    assert not os.path.exists(filename)
+    remove_history_file(filename)
+    assert FrameHistory.open(filename) is None
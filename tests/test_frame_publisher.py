@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.frame_publisher
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from processors import frame_publisher
+from processors.frame_publisher import FramePublisher, FrameSubscriber
+
+
+@pytest.fixture
+def connection():
+    publisher = FramePublisher(port = 0)
+    subscribers = []
+
+    def subscribe(decimate = 1):
+        subscriber = FrameSubscriber(publisher.port, decimate = decimate, timeout = 5)
+        subscribers.append(subscriber)
+        while publisher.num_subscribers() < len(subscribers):
+            time.sleep(0.01)
+        return subscriber
+
+    yield publisher, subscribe
+    for subscriber in subscribers:
+        subscriber.close()
+    publisher.close()
+
+
+def test_header_round_trip():
+    img = np.zeros((4, 6, 2), dtype = 'complex64')
+    header = frame_publisher.unpack_header(frame_publisher.pack_header(img, 7, 1.5, 2.5, 1e-4, 2e-6, 'sr'))
+    assert header['shape'] == (4, 6, 2)
+    assert header['dtype'] == 'complex64'
+    assert header['frameNumber'] == 7
+    assert header['mode'] == 'sr'
+    assert header['depth'] == 1e-4
+    assert header['nbytes'] == img.nbytes
+
+
+def test_subscriber_receives_frames(connection):
+    publisher, subscribe = connection
+    subscriber = subscribe()
+    img = np.arange(12, dtype = 'float32').reshape(3, 4)
+    publisher.publish(img, 3, depth = 5e-5)
+    header, received = subscriber.read()
+    assert header['frameNumber'] == 3
+    assert header['depth'] == 5e-5
+    assert np.array_equal(received, img)
+
+
+def test_decimation(connection):
+    publisher, subscribe = connection
+    subscriber = subscribe(decimate = 2)
+    for idx in range(4):
+        publisher.publish(np.full((2, 2), idx, dtype = 'uint8'), idx)
+        time.sleep(0.05)
+    assert [subscriber.read()[0]['frameNumber'] for idx in range(2)] == [0, 2]
+
+
+def test_frame_modified_after_publishing_is_sent_unchanged(connection):
+    publisher, subscribe = connection
+    subscriber = subscribe()
+    img = np.zeros((1024, 1024), dtype = 'float32')
+    for idx in range(3):
+        img[:] = idx
+        publisher.publish(img, idx)
+    img[:] = -1
+    assert [subscriber.read()[1][-1, -1] for idx in range(3)] == [0, 1, 2]
+
+def test_unsupported_dtypes_are_converted(connection):
+    publisher, subscribe = connection
+    subscriber = subscribe()
+    publisher.publish(np.ones((2, 3), dtype = 'float16'), 0)
+    header, received = subscriber.read()
+    assert received.dtype == np.float32
+    assert np.all(received == 1)
+    publisher.publish(np.ones((2, 3), dtype = bool), 1)
+    header, received = subscriber.read()
+    assert received.dtype == np.uint8
+
+
+def test_unconvertible_dtype_raises():
+    with pytest.raises(ValueError):
+        frame_publisher.publishable(np.zeros((2, 2), dtype = 'uint64'))
+    with pytest.raises(ValueError):
+        frame_publisher.pack_header(np.zeros((2, 2), dtype = 'float16'))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.frame_ring
+"""
+
+import time
+
+import numpy as np
+
+from processors.frame_ring import FrameRing
+from processors.synthetic import ReplaySource, soak_test
+
+
+def test_batches_are_shared_without_copying():
+    ring = FrameRing.create((4, 5), 3, dtype = 'uint16', numSlots = 3)
+    try:
+        before = time.time()
+        for idx in range(3):
+            handle = ring.write_frame(np.full((4, 5), idx, dtype = 'uint16'))
+        assert handle is not None and handle.timestamp >= before
+        reader = FrameRing.attach(handle.name)
+        view = reader.view(handle)
+        assert view.shape == (4, 5, 3)
+        assert list(view[0, 0]) == [0, 1, 2]
+        reader.release(handle)
+        reader.close()
+    finally:
+        ring.close()
+
+
+def test_slots_reused_only_after_release():
+    ring = FrameRing.create((2, 2), 1, numSlots = 2)
+    try:
+        first = ring.write_batch(np.ones((2, 2, 1)))
+        second = ring.write_batch(np.ones((2, 2, 1)))
+        assert ring.write_batch(np.ones((2, 2, 1))) is None
+        assert ring.dropped == 1
+        ring.release(first)
+        third = ring.write_batch(np.full((2, 2, 1), 7))
+        assert third.slot == first.slot
+        assert ring.view(first) is None
+        assert ring.view(third)[0, 0, 0] == 7
+        ring.release(second)
+    finally:
+        ring.close()
+
+
+class RingConsumer:
+    """ Stands in for the processor, releasing each slot once read.
+    """
+    def __init__(self):
+        self.values = []
+
+    def process(self, handle):
+        ring = FrameRing.attach(handle.name)
+        self.values.append(int(ring.view(handle)[0, 0, 0]))
+        ring.release(handle)
+        ring.close()
+
+
+def test_soak_test_feeds_processor_through_ring():
+    frames = [np.full((8, 8, 2), idx, dtype = 'uint16') for idx in range(4)]
+    consumer = RingConsumer()
+    stats = soak_test(consumer, ReplaySource(frames, fps = 1000, loop = False), duration = 5, useRing = True)
+    assert consumer.values == [0, 1, 2, 3]
+    assert stats['frames'] == 4 and stats['dropped'] == 0
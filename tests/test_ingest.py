@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.ingest
+"""
+
+import numpy as np
+
+from processors import ingest
+
+
+def test_difference_matches_float_subtraction():
+    frames = np.random.default_rng(0).integers(0, 4096, (100, 70, 2)).astype('uint16')
+    out = ingest.difference(frames)
+    assert out.dtype == np.float32
+    assert np.array_equal(out, frames[:,:,0].astype('float32') - frames[:,:,1])
+
+
+def test_negative_difference_does_not_wrap():
+    frames = np.zeros((4, 4, 2), dtype = 'uint8')
+    frames[:,:,1] = 10
+    assert np.all(ingest.difference(frames) == -10)
+
+
+def test_difference_writes_into_out():
+    frames = np.ones((ingest.BLOCK_ROWS * 3 + 5, 8, 2), dtype = 'uint16')
+    frames[:,:,0] = 3
+    out = np.empty((ingest.BLOCK_ROWS * 3 + 5, 8), dtype = 'float32')
+    assert ingest.difference(frames, out = out) is out
+    assert np.all(out == 2)
+    assert ingest.difference(frames, out = np.empty((2, 2), dtype = 'float32')).shape == out.shape
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.mosaic
+"""
+
+import numpy as np
+
+from processors.mosaic import RefocusMosaic
+
+
+def sample(size = 512, seed = 0):
+    rng = np.random.default_rng(seed)
+    img = rng.random((size // 8, size // 8)).astype('float32')
+    return np.kron(img, np.ones((8, 8), dtype = 'float32'))
+
+
+def test_registers_shift_between_frames():
+    scene = sample()
+    mosaic = RefocusMosaic(downsample = 2)
+    assert mosaic.add(scene[100:228, 100:228])
+    assert mosaic.add(scene[100:228, 120:248])
+    assert mosaic.numFrames == 2
+    # Field of view moved 20 pixels to the right
+    assert abs(mosaic.position[0]) <= 2
+    assert abs(mosaic.position[1] - 20) <= 2
+
+
+def test_rejects_large_shift():
+    scene = sample()
+    mosaic = RefocusMosaic(downsample = 2, maxShift = 0.05)
+    mosaic.add(scene[100:228, 100:228])
+    assert not mosaic.add(scene[100:228, 140:268])
+    assert mosaic.numRejected == 1
+
+
+def test_canvas_grows_by_whole_tiles():
+    mosaic = RefocusMosaic(tileSize = 64, initialTiles = 4)
+    mosaic.add(np.ones((128, 128), dtype = 'float32'))
+    size = mosaic.canvas.shape
+    mosaic._grow(-10, -10, 128, 128)
+    assert mosaic.canvas.shape == (size[0] + 64, size[1] + 64)
+    assert mosaic.canvas.shape[0] % 64 == 0
+
+
+def test_complex_input_uses_amplitude():
+    mosaic = RefocusMosaic()
+    field = np.full((64, 64), 3 + 4j, dtype = 'complex64')
+    mosaic.add(field)
+    y, x = mosaic.origin
+    assert np.isclose(mosaic.get_mosaic()[y + 32, x + 32], 5)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.parameter_sweep
+"""
+
+import numpy as np
+import pytest
+
+from processors import fast_refocus, parameter_sweep
+
+WAVELENGTH = 0.5e-6
+PIXEL_SIZE = 1e-6
+DEPTH = 200e-6
+
+
+def hologram(pixelSize = PIXEL_SIZE, depth = DEPTH, shape = (128, 128)):
+    """ Inline hologram of a small, bright spot at depth.
+    """
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    obj = 1 + 2 * np.exp(-((yy - shape[0] / 2)**2 + (xx - shape[1] / 2)**2) / 4)
+    field = fast_refocus.propagate(np.fft.fft2(obj), fast_refocus.propagator(shape, WAVELENGTH, pixelSize, -depth))
+    return (np.abs(field)**2).astype('float32')
+
+
+def test_kz_grid_matches_propagator():
+    shape = (32, 48)
+    kz, valid = parameter_sweep.kz_grid(shape, WAVELENGTH, PIXEL_SIZE)
+    assert kz.shape == shape
+    assert kz[0, 0] == pytest.approx(1 / WAVELENGTH)
+    prop = np.where(valid, np.exp(-2j * np.pi * DEPTH * kz), 0)
+    assert np.allclose(prop, fast_refocus.propagator(shape, WAVELENGTH, PIXEL_SIZE, DEPTH), atol = 1e-3)
+
+
+def test_kz_grid_evanescent():
+    kz, valid = parameter_sweep.kz_grid((16, 16), 2e-6, 1e-6)
+    assert not np.all(valid)
+    assert np.all(kz[~valid] == 0)
+
+
+def test_peak_depth_refines_parabola():
+    depths = np.linspace(0, 10, 11)
+    values = -(depths - 4.3)**2
+    assert parameter_sweep.peak_depth(depths, values) == pytest.approx(4.3)
+    assert parameter_sweep.peak_depth(depths, -depths) == 0
+
+
+def test_sweep_recovers_pixel_size():
+    values = np.linspace(0.8e-6, 1.2e-6, 9)
+    result = parameter_sweep.sweep(hologram(), 'pixelSize', values, np.linspace(100e-6, 400e-6, 31),
+                                   WAVELENGTH, 0.9e-6, knownDepths = DEPTH, metric = 'Peak', numWorkers = 2)
+    assert result['grid'].shape == (9, 1, 31)
+    assert result['value'] == pytest.approx(PIXEL_SIZE, rel = 0.03)
+    assert np.argmin(result['error']) == 4
+
+
+def test_sweep_with_offset_fits_depth_differences():
+    holograms = [hologram(depth = DEPTH), hologram(depth = DEPTH + 100e-6)]
+    values = np.linspace(0.8e-6, 1.2e-6, 9)
+    result = parameter_sweep.sweep(holograms, 'pixelSize', values, np.linspace(100e-6, 400e-6, 31),
+                                   WAVELENGTH, 0.9e-6, knownDepths = [0, 100e-6], fitOffset = True, metric = 'Peak')
+    assert result['value'] == pytest.approx(PIXEL_SIZE, rel = 0.05)
+
+
+def test_unknown_parameter():
+    with pytest.raises(ValueError):
+        parameter_sweep.focus_grid([np.zeros((4, 4))], 'depth', [1], [0], WAVELENGTH, PIXEL_SIZE)
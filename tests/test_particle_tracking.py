@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.particle_tracking
+"""
+
+import numpy as np
+
+from processors import fast_refocus
+from processors.particle_tracking import ParticleLocator, ParticleTracker, ParticleTableWriter, PARTICLE_COLUMNS
+
+
+def particle_hologram(positions, depth, size = 256):
+    obj = np.ones((size, size), dtype = 'complex64')
+    yy, xx = np.mgrid[:size, :size]
+    for x, y in positions:
+        obj[(yy - y)**2 + (xx - x)**2 < 9] = 0
+    prop = fast_refocus.propagator((size, size), 0.5e-6, 1e-6, -depth)
+    return (np.abs(fast_refocus.propagate(np.fft.fft2(obj), prop))**2).astype('float32')
+
+
+def test_locates_particles_in_3d():
+    holo = particle_hologram([(80, 100), (170, 180)], 300e-6)
+    locator = ParticleLocator(depthRange = (100e-6, 500e-6), numDepths = 21)
+    table = locator.locate(fast_refocus.hologram_fft(holo), 0.5e-6, 1e-6, frame = 3)
+    assert table.shape[1] == len(PARTICLE_COLUMNS)
+    found = sorted((row[1], row[2]) for row in table[:2])
+    assert found == [(80, 100), (170, 180)]
+    assert np.allclose(table[:2, 3], 300e-6)
+    assert np.all(table[:, 0] == 3)
+    assert np.all(table[:, 5] == -1)
+
+
+def table(frame, positions):
+    rows = np.zeros((len(positions), len(PARTICLE_COLUMNS)))
+    rows[:, 0] = frame
+    rows[:, 1:4] = positions
+    rows[:, 5] = -1
+    return rows
+
+
+def test_tracker_links_nearest_particles():
+    tracker = ParticleTracker(maxDistance = 5, zScale = 1e6)
+    first = tracker.link(table(0, [(10, 10, 0), (50, 50, 0)]))
+    second = tracker.link(table(1, [(52, 51, 0), (12, 10, 0), (100, 100, 0)]))
+    assert list(first[:, 5]) == [0, 1]
+    assert list(second[:, 5]) == [1, 0, 2]
+
+
+def test_tracker_ends_tracks_after_gap():
+    tracker = ParticleTracker(maxDistance = 5, maxGap = 1)
+    tracker.link(table(0, [(10, 10, 0)]))
+    tracker.link(table(1, [(80, 80, 0)]))
+    later = tracker.link(table(3, [(10, 10, 0)]))
+    assert later[0, 5] == 2
+
+
+def test_table_writer_appends_rows(tmp_path):
+    filename = str(tmp_path / 'particles.csv')
+    writer = ParticleTableWriter(filename)
+    writer.write(table(0, [(1, 2, 3e-4)]))
+    writer.close()
+    writer = ParticleTableWriter(filename)
+    writer.write(table(1, [(4, 5, 6e-4)]))
+    writer.close()
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == ','.join(PARTICLE_COLUMNS)
+    assert len(lines) == 3
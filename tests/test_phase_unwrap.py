@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.phase_unwrap
+"""
+
+import numpy as np
+
+from processors.phase_unwrap import PhaseUnwrapper, unwrap_phase
+
+
+def ramp(shape = (64, 80)):
+    """ Phase ramp spanning several multiples of 2 pi, with mean zero.
+    """
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    phase = 0.4 * xx + 0.25 * yy
+    return phase - np.mean(phase)
+
+
+def test_unwraps_ramp_from_complex_field():
+    phase = ramp()
+    field = (2 * np.exp(1j * phase)).astype('complex64')
+    unwrapped = unwrap_phase(field)
+    assert unwrapped.dtype == np.float32
+    assert np.allclose(unwrapped, phase, atol = 1e-3)
+
+
+def test_unwraps_ramp_from_wrapped_phase():
+    phase = ramp()
+    wrapped = np.angle(np.exp(1j * phase)).astype('float32')
+    assert np.max(np.abs(wrapped)) <= np.pi
+    assert np.allclose(unwrap_phase(wrapped), phase, atol = 1e-3)
+
+
+def test_result_has_mean_zero():
+    phase = ramp() + 5
+    unwrapped = unwrap_phase(np.exp(1j * phase).astype('complex64'))
+    assert abs(np.mean(unwrapped)) < 1e-4
+    assert np.allclose(unwrapped, phase - np.mean(phase), atol = 1e-3)
+
+
+def test_different_image_sizes():
+    phase = ramp((32, 32))
+    first = unwrap_phase(np.exp(1j * phase))
+    assert np.allclose(unwrap_phase(np.exp(1j * ramp((16, 24)))), ramp((16, 24)), atol = 1e-3)
+    assert np.allclose(PhaseUnwrapper((32, 32)).unwrap(np.exp(1j * phase)), first)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.post_stages
+"""
+
+import time
+
+import numpy as np
+
+from processors.post_stages import PostStage, StageChain, IntensityStage, PhaseStage, InvertStage
+
+
+class MeanStage(PostStage):
+    name = 'mean'
+    measurement = True
+
+    def process(self, img):
+        return float(np.mean(img))
+
+
+class SlowMeanStage(MeanStage):
+    name = 'slowMean'
+    threaded = True
+
+    def process(self, img):
+        time.sleep(0.05)
+        return float(np.mean(img))
+
+
+class RecordingIntensityStage(IntensityStage):
+
+    def process(self, img):
+        self.output = super().process(img)
+        return self.output
+
+
+def field():
+    rng = np.random.default_rng(0)
+    return (rng.random((16, 16)) * np.exp(1j * rng.random((16, 16)))).astype('complex64')
+
+
+def test_intensity_and_phase_of_field():
+    img = field()
+    chain = StageChain()
+    chain.set_stages([IntensityStage()])
+    out = chain.run(img)
+    assert out.dtype == np.float32
+    assert np.allclose(out, np.abs(img))
+    chain.set_stages([PhaseStage()])
+    assert np.allclose(chain.run(img), np.angle(img))
+
+
+def test_in_place_stage_does_not_modify_input():
+    img = np.random.default_rng(1).random((8, 8)).astype('float32')
+    original = img.copy()
+    chain = StageChain()
+    chain.set_stages([InvertStage()])
+    out = chain.run(img)
+    assert np.array_equal(img, original)
+    assert np.allclose(out, np.max(original) - original)
+
+
+def test_in_place_stage_reuses_converted_array():
+    img = field()
+    chain = StageChain()
+    intensity = RecordingIntensityStage()
+    chain.set_stages([intensity, InvertStage()])
+    out = chain.run(img)
+    assert out is intensity.output
+    assert np.allclose(out, np.max(np.abs(img)) - np.abs(img), atol = 1e-6)
+
+
+def test_input_dtype_conversion():
+    chain = StageChain()
+    chain.set_stages([InvertStage()])
+    out = chain.run(np.array([[1, 3]], dtype = 'uint8'))
+    assert out.dtype == np.float32
+    assert np.array_equal(out, [[2, 0]])
+
+
+def test_measurement_runs_every_nth_frame_on_final_image():
+    stage = MeanStage()
+    stage.every = 2
+    chain = StageChain()
+    chain.set_stages([stage, InvertStage()])
+    img = np.array([[0, 2]], dtype = 'float32')
+    chain.run(img)
+    assert chain.results['mean'] == 1
+    chain.run(np.array([[0, 10]], dtype = 'float32'))
+    assert chain.results['mean'] == 1
+    chain.run(np.array([[0, 4]], dtype = 'float32'))
+    assert chain.results['mean'] == 2
+
+
+def test_threaded_measurement_is_skipped_while_running():
+    chain = StageChain()
+    chain.set_stages([SlowMeanStage()])
+    chain.run(np.ones((2, 2), dtype = 'float32'))
+    chain.run(np.zeros((2, 2), dtype = 'float32'))
+    chain.pending['slowMean'].result(timeout = 5)
+    assert chain.results['slowMean'] == 1
+    assert chain.total_time() == 0
+    chain.close()
+
+
+def test_times_kept_for_stages_with_same_name():
+    chain = StageChain()
+    chain.set_stages([IntensityStage(), InvertStage()])
+    chain.run(field())
+    assert set(chain.times) == {'intensity', 'invert'}
+    chain.set_stages([IntensityStage()])
+    assert set(chain.times) == {'intensity'}
+    assert chain.total_time() == chain.times['intensity']
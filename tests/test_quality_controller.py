@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.quality_controller
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from processors.quality_controller import QualityController
+
+
+def test_steps_down_after_slow_frames():
+    controller = QualityController(targetFps = 20, downFrames = 3)
+    for idx in range(2):
+        controller.accept()
+        controller.record(0.1)
+    assert controller.level == 0
+    controller.accept()
+    controller.record(0.1)
+    assert controller.level == 1
+    assert controller.settings() == (2, 1)
+
+
+def test_steps_up_after_fast_frames():
+    controller = QualityController(targetFps = 20, upFrames = 5, retryTime = 0)
+    controller.set_level(2)
+    for idx in range(4):
+        controller.record(0.001)
+    assert controller.level == 2
+    controller.record(0.001)
+    assert controller.level == 1
+
+
+def test_does_not_retry_failed_level_too_soon():
+    controller = QualityController(targetFps = 20, downFrames = 1, upFrames = 1, retryTime = 60)
+    controller.record(0.1)
+    assert controller.level == 1
+    controller.record(0.001)
+    assert controller.level == 1
+
+
+def test_stage_every_skips_frames():
+    controller = QualityController(levels = [(1, 1), (1, 3)])
+    controller.set_level(1)
+    accepted = [controller.accept() for idx in range(6)]
+    assert accepted.count(True) == 2
+
+
+def test_paused_and_idle_restore_full_quality():
+    controller = QualityController(idleTime = 0.05)
+    controller.set_level(3)
+    assert controller.accept(paused = True)
+    assert controller.level == 0
+    controller.set_level(3)
+    controller.accept()
+    time.sleep(0.1)
+    controller.accept()
+    assert controller.level == 0
+
+
+def test_reduced_refocus_scale_keeps_output_size():
+    pytest.importorskip('cas_gui')
+    from processors.inline_bundle_processor_class import InlineBundleProcessorClass
+    processor = InlineBundleProcessorClass()
+    processor.holo.wavelength = 0.5e-6
+    processor.holo.pixelSize = 1e-6
+    processor.set_depth(100e-6)
+    img = np.random.default_rng(0).random((64, 96)).astype('float32')
+    full = processor.refocus_frame(img)
+    reduced = processor.refocus_frame(img, scale = 2)
+    assert np.shape(reduced) == np.shape(full) == (64, 96)
+    assert np.iscomplexobj(reduced)
+
+
+def test_pool_skips_frames_before_submitting():
+    pytest.importorskip('cas_gui')
+    from processors.inline_bundle_processor_class import InlineBundleProcessorClass, close_runtime_object, runtime_object
+    processor = InlineBundleProcessorClass()
+    processor.pyb.set_core_method(processor.pyb.FILTER)
+    processor.pyb.set_filter_size(1)
+    processor.holo.wavelength = 0.5e-6
+    processor.holo.pixelSize = 1e-6
+    processor.refocus = True
+    processor.set_depth(100e-6)
+    processor.poolWorkers = 2
+    processor.adaptiveQuality = True
+    processor.targetFps = 10**5
+    close_runtime_object('qualityController')
+    rng = np.random.default_rng(0)
+    try:
+        for idx in range(40):
+            processor.process(rng.random((64, 64)).astype('float32'))
+        controller = processor.get_quality_controller()
+        pool = runtime_object('processorPool', None)
+        assert controller.level > 0
+        assert pool.nextSeq < 40
+        assert pool.processor.refocusScale == controller.settings()[0]
+        assert not pool.processor.adaptiveQuality
+    finally:
+        close_runtime_object('processorPool')
+        close_runtime_object('qualityController')
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.raw_archive
+"""
+
+import numpy as np
+
+from processors.raw_archive import RawArchiveWriter, RawArchive, sr_led_indices, NO_LED
+
+
+def test_frames_and_index_round_trip(tmp_path):
+    writer = RawArchiveWriter(str(tmp_path))
+    writer.set_settings({'depth': 1})
+    frames = [np.full((4, 6), i, dtype = 'uint16') for i in range(3)]
+    for frame in frames:
+        writer.add_frame(frame, timestamp = 10.0)
+    writer.close()
+
+    archive = RawArchive(str(tmp_path))
+    assert len(archive) == 3
+    for i, frame in enumerate(frames):
+        assert np.array_equal(archive.get_frame(i), frame)
+    assert archive.get_timestamp(1) == 10.0
+    assert archive.get_led(0) == NO_LED
+    assert archive.get_settings(2) == {'depth': 1}
+
+
+def test_get_sequence_returns_stack_and_bounds(tmp_path):
+    writer = RawArchiveWriter(str(tmp_path))
+    writer.add_frame(np.zeros((4, 4), dtype = 'uint8'))
+    stack = np.stack([np.full((4, 4), i, dtype = 'uint8') for i in range(3)], axis = 2)
+    writer.add_stack(stack)
+    writer.close()
+
+    archive = RawArchive(str(tmp_path))
+    sequence, start, end = archive.get_sequence(2)
+    assert (start, end) == (1, 4)
+    assert np.array_equal(sequence, stack)
+    assert [np.ndim(batch) for batch in archive.batches()] == [2, 3]
+
+
+def test_reopening_appends_after_existing_frames(tmp_path):
+    writer = RawArchiveWriter(str(tmp_path))
+    writer.add_frame(np.zeros((2, 2), dtype = 'uint8'))
+    writer.close()
+    writer = RawArchiveWriter(str(tmp_path))
+    writer.add_frame(np.ones((2, 2), dtype = 'uint8'))
+    writer.close()
+
+    archive = RawArchive(str(tmp_path))
+    assert len(archive) == 2
+    assert archive.index['sequence'][1] == 1
+
+
+def test_sr_led_indices_starts_after_blank_frame():
+    stack = np.ones((2, 2, 4))
+    stack[:, :, 2] = 0
+    assert list(sr_led_indices(stack)) == [1, 2, NO_LED, 0]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.shift_calibration
+"""
+
+import numpy as np
+import pytest
+
+pybundle = pytest.importorskip('pybundle')
+nd = pytest.importorskip('scipy.ndimage')
+
+from processors import shift_calibration
+
+from test_sparse_sr import bundle_image
+
+
+def test_batch_shifts_matches_pybundle_sign_and_axis():
+    scene = nd.gaussian_filter(np.random.default_rng(1).random((256, 256)), 4)
+    imgs = np.stack([nd.shift(scene, (sy, sx), mode = 'wrap') for sx, sy in [(0, 0), (3, 0), (0, 5), (-4, 2.5)]])
+    reference = pybundle.SuperRes.get_shifts(np.moveaxis(imgs, 0, 2))
+    shifts = shift_calibration.batch_shifts(imgs)
+    assert np.allclose(reference, [(0, 0), (-3, 0), (0, -5), (4, -2.5)])
+    assert np.allclose(shifts, reference, atol = 0.1)
+
+
+def test_batch_shifts_over_batch_dimensions():
+    scene = nd.gaussian_filter(np.random.default_rng(2).random((128, 128)), 3)
+    imgs = np.stack([[nd.shift(scene, (0, d * n), mode = 'wrap') for n in range(3)] for d in (1, 2)])
+    shifts = shift_calibration.batch_shifts(imgs)
+    assert shifts.shape == (2, 3, 2)
+    assert np.allclose(shifts[..., 0], [[0, -1, -2], [0, -2, -4]], atol = 0.1)
+    assert np.allclose(shifts[..., 1], 0, atol = 0.1)
+
+
+def test_fit_shifts_force_zero_matches_polyfit():
+    param = np.array([1., 2., 3.])
+    shifts = np.random.default_rng(3).normal(size = (3, 4, 2))
+    coeffs = shift_calibration.fit_shifts(param, shifts, forceZero = True)
+    assert coeffs.shape == (4, 2, 2)
+    for led in range(4):
+        for axis in range(2):
+            expected = np.polyfit(np.append(param, 0), np.append(shifts[:, led, axis], 0), 1)
+            assert np.allclose(coeffs[led, axis], expected)
+
+
+def test_calib_param_shift_close_to_pybundle():
+    calibImage = bundle_image()
+    calibration = pybundle.calib_tri_interp(calibImage, 3, 160, normalise = calibImage)
+    scene = nd.gaussian_filter(np.random.default_rng(0).random((200, 200)), 8)
+    scene = scene / np.max(scene)
+    cores = calibImage / np.max(calibImage)
+    depths = np.array([1., 2.])
+    movements = [(0, 0), (2.5, 0), (0, -2), (1.5, 1.5)]
+    images = np.zeros((200, 200, len(movements), len(depths)))
+    for iDepth, depth in enumerate(depths):
+        for iShift, (sx, sy) in enumerate(movements):
+            images[:, :, iShift, iDepth] = cores * nd.shift(scene, (sy * depth, sx * depth), mode = 'wrap') * 1000
+
+    reference = pybundle.SuperRes.calib_param_shift(depths, images, calibration, forceZero = True)
+    coeffs, shifts, timings = shift_calibration.calib_param_shift(depths, images, calibration, forceZero = True, numWorkers = 1)
+    assert coeffs.shape == np.shape(reference)
+    assert shifts.shape == (len(depths), len(movements), 2)
+    assert np.allclose(coeffs[:, :, 0], -np.array(movements), atol = 0.3)
+    assert np.allclose(coeffs[:, :, 0], reference[:, :, 0], atol = 0.3)
+    assert timings['total'] > 0
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.sparse_sr
+"""
+
+import numpy as np
+import pytest
+
+from processors.sparse_sr import SparseSRReconstructor, current_sr_calibration, output_settings
+
+SHIFTS = np.array([(0, 0), (2, 0), (0, 2), (2, 2)])
+
+
+def bundle_image(shift = (0, 0), scene = None, shape = (200, 200), spacing = 6):
+    yy, xx = np.mgrid[:shape[0], :shape[1]].astype('float64')
+    img = np.zeros(shape)
+    for row, y in enumerate(np.arange(spacing, shape[0] - spacing, spacing * 0.866)):
+        for x in np.arange(spacing + (spacing / 2) * (row % 2), shape[1] - spacing, spacing):
+            if (x - 100)**2 + (y - 100)**2 < 80**2:
+                img += np.exp(-((xx - x - shift[0])**2 + (yy - y - shift[1])**2) / 2)
+    if scene is not None:
+        img = img * scene
+    return (img * 1000).astype('uint16')
+
+
+@pytest.fixture(scope = "module")
+def sr_bundle():
+    pybundle = pytest.importorskip('pybundle')
+    calibImage = bundle_image()
+    pyb = pybundle.PyBundle(coreMethod = pybundle.PyBundle.TRILIN, superRes = True, calibImage = calibImage,
+                            coreSize = 3, gridSize = 128, srShifts = SHIFTS, background = calibImage,
+                            normaliseImage = calibImage, filterSize = 1, outputType = 'float32')
+    pyb.calibrate_sr()
+    scene = 1 + np.random.default_rng(0).random((200, 200))
+    imgs = np.stack([bundle_image(shift, scene) for shift in SHIFTS], axis = 2)
+    return pyb, imgs
+
+
+def test_matches_pybundle(sr_bundle, tmp_path):
+    pyb, imgs = sr_bundle
+    expected = pyb.process(imgs)
+    recon = SparseSRReconstructor(str(tmp_path)).reconstruct(imgs, current_sr_calibration(pyb))
+    out = output_settings(recon, pyb)
+    assert out.dtype == expected.dtype
+    assert np.allclose(out, expected, atol = 1e-4 * np.max(np.abs(expected)))
+
+    # A second reconstructor (e.g. in another process) loads the cached matrix
+    again = SparseSRReconstructor(str(tmp_path)).reconstruct(imgs, current_sr_calibration(pyb))
+    assert np.array_equal(again, recon)
+
+
+def test_wrong_number_of_images(sr_bundle):
+    pyb, imgs = sr_bundle
+    assert SparseSRReconstructor(None).reconstruct(imgs[:, :, :3], current_sr_calibration(pyb)) is None
+
+
+def test_lut_without_parameter_value(sr_bundle):
+    pyb, imgs = sr_bundle
+    pyb.set_sr_use_lut(True)
+    try:
+        assert current_sr_calibration(pyb) is None
+    finally:
+        pyb.set_sr_use_lut(False)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.stage_cache
+"""
+
+import numpy as np
+
+from processors.stage_cache import StageCache, FrameKeys, LiveKey, fingerprint, state_key, is_live
+
+
+def test_setting_stage_invalidates_later_stages():
+    cache = StageCache()
+    cache.set('bundle', 1, 'b')
+    cache.set('fft', 2, 'f')
+    cache.set('field', 3, 'z')
+    cache.set('fft', 4, 'g')
+    assert cache.get('bundle', 1) == 'b'
+    assert cache.get('fft', 4) == 'g'
+    assert cache.get('field', 3) is None
+
+
+def test_fingerprint_depends_on_contents():
+    a = np.arange(10)
+    assert fingerprint(a) == fingerprint(a.copy())
+    b = a.copy()
+    b[3] = 0
+    assert fingerprint(a) != fingerprint(b)
+
+
+def test_state_key_follows_attributes():
+    class Settings:
+        pass
+    settings = Settings()
+    settings.value = 1
+    settings.image = np.zeros(4)
+    key = state_key(settings)
+    copied = Settings()
+    copied.value = 1
+    copied.image = np.zeros(4)
+    assert state_key(copied) == key
+    copied.value = 2
+    assert state_key(copied) != key
+
+
+def test_live_frames_get_unique_keys():
+    keys = FrameKeys()
+    rng = np.random.default_rng(0)
+    frameKeys = [keys.key(rng.random((64, 64))) for _ in range(3)]
+    assert all(isinstance(k, LiveKey) for k in frameKeys)
+    assert len(set(frameKeys)) == 3
+    assert is_live(('standard', frameKeys[0]))
+
+
+def test_repeated_frame_is_fingerprinted():
+    keys = FrameKeys()
+    frame = np.random.default_rng(1).random((64, 64))
+    keys.key(frame)
+    first = keys.key(frame.copy())
+    assert not is_live(first)
+    assert keys.key(frame) == first
+
+
+def test_frame_differing_off_sample_grid_gets_different_key():
+    keys = FrameKeys(sampleStep = 16)
+    frame = np.zeros((64, 64))
+    keys.key(frame)
+    repeat = keys.key(frame)
+    changed = frame.copy()
+    changed[1, 1] = 1
+    assert keys.key(changed) != repeat
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.synthetic
+"""
+
+import time
+
+import numpy as np
+
+from processors.synthetic import SyntheticBundleHologram, ReplaySource, read_tif_frames, soak_test
+
+
+class CountingProcessor:
+
+    def __init__(self):
+        self.frames = []
+
+    def process(self, frame):
+        self.frames.append(frame)
+
+
+def test_replay_source_paces_frames():
+    source = ReplaySource([1, 2, 3], fps = 50, loop = False)
+    t0 = time.perf_counter()
+    frames = list(source)
+    assert frames == [1, 2, 3]
+    assert time.perf_counter() - t0 > 0.035
+    assert source.numEmitted == 3
+
+
+def test_replay_source_loops_until_stopped():
+    source = ReplaySource([1, 2], fps = 1000)
+    frames = [frame for frame, idx in zip(source, range(5))]
+    assert frames == [1, 2, 1, 2, 1]
+
+
+def test_read_tif_frames_and_stacks(tmp_path):
+    generator = SyntheticBundleHologram(size = 64, numLEDs = 3, bitDepth = 8)
+    generator.add_point(32, 32, 200e-6)
+    filename = str(tmp_path / 'sr.tif')
+    generator.write_tif(filename, numFrames = 2, sr = True)
+    frames = read_tif_frames(filename)
+    assert len(frames) == 8
+    assert frames[0].shape == (64, 64)
+    stacks = read_tif_frames(filename, 4)
+    assert len(stacks) == 2
+    assert stacks[1].shape == (64, 64, 4)
+    assert np.array_equal(stacks[1][:, :, 0], frames[4])
+
+
+def test_soak_test_reports_throughput():
+    processor = CountingProcessor()
+    frames = [np.zeros((8, 8), dtype = 'uint8')] * 5
+    stats = soak_test(processor, ReplaySource(frames, fps = 1000, loop = False), duration = 5, report = None)
+    assert len(processor.frames) == 5
+    assert stats['frames'] == 5
+    assert stats['dropped'] == 0
+    assert stats['processTimeMax'] >= stats['processTimeP50']
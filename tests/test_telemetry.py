@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.telemetry
+"""
+
+import numpy as np
+
+from processors.telemetry import LatencyTelemetry, STAGES
+
+
+def test_latency_only_from_frames_with_both_stages():
+    telemetry = LatencyTelemetry()
+    telemetry.add_frame({'frame': 0, 'received': 1.0, 'output': 1.5})
+    telemetry.add_frame({'frame': 1, 'acquired': 1.8, 'received': 2.0, 'output': 2.2})
+    assert np.allclose(telemetry.latencies('acquired', 'output'), [0.4])
+    assert np.allclose(telemetry.latencies('received', 'output'), [0.5, 0.2])
+
+
+def test_percentiles_none_without_acquisition_times():
+    telemetry = LatencyTelemetry()
+    telemetry.start_frame(timestamp = 1.0)
+    telemetry.stamp('output', 1.1)
+    telemetry.end_frame()
+    assert telemetry.percentiles('acquired', 'output') is None
+    assert telemetry.percentiles('received', 'output') is not None
+
+
+def test_stage_means_skip_unused_stages():
+    telemetry = LatencyTelemetry()
+    telemetry.add_frame({'frame': 0, 'received': 0.0, 'bundle': 0.1, 'refocus': 0.3, 'output': 0.35})
+    means = telemetry.stage_means()
+    assert 'sorted' not in means
+    assert np.isclose(means['bundle'], 0.1)
+    assert np.isclose(means['refocus'], 0.2)
+
+
+def test_csv_stream(tmp_path):
+    csvFile = str(tmp_path / 'latency.csv')
+    telemetry = LatencyTelemetry(csvFile = csvFile)
+    telemetry.add_frame({'frame': 3, 'received': 1.0, 'output': 2.0})
+    telemetry.close()
+    lines = open(csvFile).read().splitlines()
+    assert lines[0] == 'frame,' + ','.join(STAGES)
+    assert lines[1].startswith('3,,1.000000')
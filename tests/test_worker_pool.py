@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for processors.worker_pool
+"""
+
+import numpy as np
+import pytest
+
+from processors.worker_pool import ProcessorPool
+
+
+class ScaleProcessor:
+    """ Multiplies frames by a factor, keeping the input as preProcessFrame.
+    """
+    def __init__(self, factor):
+        self.factor = factor
+        self.preProcessFrame = None
+
+    def set_depth(self, depth):
+        self.factor = depth
+
+    def process(self, frame):
+        self.preProcessFrame = frame + 1
+        return frame * self.factor
+
+
+def test_outputs_in_order_with_preprocessed_frames():
+    pool = ProcessorPool(ScaleProcessor(2), numWorkers = 2)
+    try:
+        for idx in range(6):
+            pool.submit(np.full(3, idx))
+        results = [pool.get(block = True) for idx in range(6)]
+    finally:
+        pool.close()
+    assert [seq for seq, output, pre in results] == list(range(6))
+    assert [output[0] for seq, output, pre in results] == [2 * idx for idx in range(6)]
+    assert [pre[0] for seq, output, pre in results] == [idx + 1 for idx in range(6)]
+
+
+def test_settings_apply_to_later_frames():
+    pool = ProcessorPool(ScaleProcessor(2), numWorkers = 2)
+    try:
+        before = list(pool.map([np.ones(1)] * 2))
+        pool.set_depth(5)
+        after = list(pool.map([np.ones(1)] * 2))
+    finally:
+        pool.close()
+    assert [out[0] for out in before] == [2, 2]
+    assert [out[0] for out in after] == [5, 5]
+
+
+def test_processor_depth_message_reaches_workers():
+    pytest.importorskip('cas_gui')
+    from processors.inline_bundle_processor_class import InlineBundleProcessorClass, close_runtime_object
+    processor = InlineBundleProcessorClass()
+    processor.pyb.set_core_method(processor.pyb.FILTER)
+    processor.pyb.set_filter_size(1)
+    processor.holo.wavelength = 0.5e-6
+    processor.holo.pixelSize = 1e-6
+    processor.refocus = True
+    img = np.random.default_rng(0).random((64, 64)).astype('float32')
+    processor.set_depth(300e-6)
+    expected = processor.process(img).copy()
+    processor.set_depth(0)
+    processor.poolWorkers = 2
+    try:
+        processor.process(img)
+        key = processor.pool_settings_key()
+        processor.message('set_depth', 300e-6)
+        assert processor.pool_settings_key() != key
+        outputs = [processor.process(img) for idx in range(8)]
+    finally:
+        close_runtime_object('processorPool')
+    assert np.allclose(outputs[-1], expected)